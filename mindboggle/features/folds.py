@@ -147,9 +147,11 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
     vertices or fewer out of a total mesh size of over 100,000 vertices).
 
     Steps ::
-        1. Segment deep vertices as an initial set of folds.
+        1. Segment deep vertices as an initial set of folds
+           (connected components of the mesh restricted to deep vertices).
         2. Remove small folds.
-        3. Renumber folds.
+        3. Renumber folds (in order of their lowest vertex index,
+           so that numbering is deterministic).
 
     Note ::
         Removed option: Find and fill holes in the folds:
@@ -179,7 +181,7 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
 
     Returns
     -------
-    folds : list of integers
+    folds : numpy array of integers
         fold numbers for all vertices (-1 for non-fold vertices)
     n_folds :  int
         number of folds
@@ -204,8 +206,12 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
     >>> n_folds
     33
     >>> lens = [len([x for x in folds if x == y]) for y in range(n_folds)]
-    >>> lens[0:10]
-    [726, 67241, 2750, 5799, 1151, 6360, 1001, 505, 228, 198]
+    >>> set([726, 67241, 2750, 5799, 1151, 6360, 1001, 505, 228,
+    ...      198]).issubset(lens)
+    True
+    >>> firsts = [list(folds).index(y) for y in range(n_folds)]
+    >>> firsts == sorted(firsts)
+    True
 
     View folds (skip test):
 
@@ -225,9 +231,10 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
     import numpy as np
     from time import time
 
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
     from mindboggle.mio.vtks import rewrite_scalars, read_vtk
-    from mindboggle.guts.mesh import find_neighbors
-    from mindboggle.guts.segment import segment_regions
 
     if verbose:
         print("Extract folds in surface mesh")
@@ -242,22 +249,32 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
     # ------------------------------------------------------------------------
     # Find the deepest vertices
     # ------------------------------------------------------------------------
-    indices_deep = [i for i,x in enumerate(depths) if x >= depth_threshold]
-    if indices_deep:
-
-        # --------------------------------------------------------------------
-        # Find neighbors for each vertex
-        # --------------------------------------------------------------------
-        neighbor_lists = find_neighbors(faces, npoints)
+    folds = background_value * np.ones(npoints, dtype=int)
+    n_folds = 0
+    indices_deep = np.where(np.asarray(depths) >= depth_threshold)[0]
+    if indices_deep.size:
 
         # --------------------------------------------------------------------
         # Segment deep vertices as an initial set of folds
+        # (connected components of face edges between deep vertices)
         # --------------------------------------------------------------------
         if verbose:
             print("  Segment vertices deeper than {0:.2f} as folds".format(depth_threshold))
             t1 = time()
-        folds = segment_regions(indices_deep, neighbor_lists, 1, [], False,
-                                False, [], [], [], '', background_value, False)
+        local_indices = -1 * np.ones(npoints, dtype=int)
+        local_indices[indices_deep] = np.arange(indices_deep.size)
+        faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+        edges = np.vstack((faces[:, [0, 1]], faces[:, [1, 2]],
+                           faces[:, [2, 0]]))
+        edges = local_indices[edges]
+        edges = edges[np.all(edges > -1, axis=1)]
+        graph = coo_matrix((np.ones(len(edges), dtype=np.int8),
+                            (edges[:, 0], edges[:, 1])),
+                           shape=(indices_deep.size, indices_deep.size))
+        graph = (graph + graph.T).tocsr()
+
+        n_components, components = connected_components(graph,
+                                                         directed=False)
         if verbose:
             print('  ...Segmented folds ({0:.2f} seconds)'.format(time() - t1))
 
@@ -267,12 +284,10 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
         if min_fold_size > 1:
             if verbose:
                 print('  Remove folds smaller than {0}'.format(min_fold_size))
-            unique_folds = [x for x in np.unique(folds)
-                            if x != background_value]
-            for nfold in unique_folds:
-                indices_fold = [i for i,x in enumerate(folds) if x == nfold]
-                if len(indices_fold) < min_fold_size:
-                    folds[indices_fold] = background_value
+            sizes = np.bincount(components, minlength=n_components)
+            keep = sizes[components] >= min_fold_size
+            indices_deep = indices_deep[keep]
+            components = components[keep]
 
         # --------------------------------------------------------------------
         # Find and fill holes in the folds
@@ -286,14 +301,9 @@ def extract_folds(depth_file, depth_threshold=2, min_fold_size=50,
         # Renumber folds so they are sequential.
         # NOTE: All vertices are included (-1 for non-fold vertices).
         # --------------------------------------------------------------------
-        renumber_folds = background_value * np.ones(npoints)
-        fold_numbers = [x for x in np.unique(folds) if x != background_value]
-        for i_fold, n_fold in enumerate(fold_numbers):
-            fold_indices = [i for i,x in enumerate(folds) if x == n_fold]
-            renumber_folds[fold_indices] = i_fold
-        folds = renumber_folds
-        folds = [int(x) for x in folds]
-        n_folds = i_fold + 1
+        fold_numbers, renumbered = np.unique(components, return_inverse=True)
+        folds[indices_deep] = renumbered
+        n_folds = fold_numbers.size
 
         # Print statement
         if verbose:
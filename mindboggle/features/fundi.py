@@ -12,7 +12,8 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 def extract_fundi(folds, curv_file, depth_file, min_separation=10,
                   erode_ratio=0.1, erode_min_size=1, save_file=False,
-                  output_file='', background_value=-1, verbose=False):
+                  output_file='', background_value=-1, verbose=False,
+                  n_processes=1):
     """
     Extract fundi from folds.
 
@@ -52,6 +53,10 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
         3. Connect anchor points using connect_points_erosion();
            inner anchors are removed if they result in endpoints.
 
+    Folds are independent of one another, so with n_processes > 1 they are
+    distributed (largest first) to forked worker processes that share the
+    read-only mesh neighbors, depths and values of the parent process.
+
     Note ::
         Follow this with segment_by_region() to segment fundi by sulci.
 
@@ -78,6 +83,9 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
         background value
     verbose : bool
         print statements?
+    n_processes : integer
+        number of worker processes to extract fundi from folds in parallel
+        (1: extract fundi one fold at a time)
 
     Returns
     -------
@@ -122,6 +130,14 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     >>> lens[0:10] # [66, 2914, 100, 363, 73, 331, 59, 30, 1, 14] # (if not limit_folds)
     [73]
 
+    Extract fundi from folds in parallel (skip test):
+
+    >>> o3, o4, o5 = extract_fundi(folds, curv_file, depth_file,
+    ...     min_separation, erode_ratio, erode_min_size, False, '',
+    ...     background_value, verbose, n_processes=4) # doctest: +SKIP
+    >>> o3 == o1 # doctest: +SKIP
+    True
+
     View result without background (skip test):
 
     >>> from mindboggle.mio.plots import plot_surfaces # doctest: +SKIP
@@ -143,8 +159,8 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     from mindboggle.guts.paths import find_max_values
     from mindboggle.guts.mesh import find_neighbors_from_file
     #from mindboggle.guts.mesh import find_complete_faces
-    from mindboggle.guts.paths import find_outer_endpoints
-    from mindboggle.guts.paths import connect_points_erosion
+    from mindboggle.guts.utilities import map_processes
+    from mindboggle.features.fundi import _extract_fold_skeleton
 
     if isinstance(folds, list):
         folds = np.array(folds)
@@ -165,11 +181,25 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     neighbor_lists = find_neighbors_from_file(curv_file)
 
     # ------------------------------------------------------------------------
-    # Loop through folds:
+    # Find inner anchor points (the same for all folds):
+    # ------------------------------------------------------------------------
+    inner_anchors = find_max_values(points, values, min_separation, thr)
+
+    # ------------------------------------------------------------------------
+    # Loop through folds (largest first, if in parallel):
     # ------------------------------------------------------------------------
     t1 = time()
     skeletons = []
-    unique_fold_IDs = [x for x in np.unique(folds) if x != background_value]
+    Ifolds = np.where(folds != background_value)[0]
+    Ifolds = Ifolds[np.argsort(folds[Ifolds], kind='stable')]
+    unique_fold_IDs, starts, sizes = np.unique(folds[Ifolds],
+                                               return_index=True,
+                                               return_counts=True)
+    fold_lists = [Ifolds[i:i + n].tolist() for i, n in zip(starts, sizes)]
+    if n_processes > 1:
+        order = np.argsort(-sizes, kind='stable')
+    else:
+        order = np.arange(len(fold_lists))
 
     if verbose:
         if len(unique_fold_IDs) == 1:
@@ -178,43 +208,21 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
             print("Extract a fundus from each of {0} folds...".
                   format(len(unique_fold_IDs)))
 
-    for fold_ID in unique_fold_IDs:
-        indices_fold = [i for i,x in enumerate(folds) if x == fold_ID]
-        if indices_fold:
-            if verbose:
-                print('  Fold {0}:'.format(int(fold_ID)))
-
-            # ----------------------------------------------------------------
-            # Find outer anchor points on the boundary of the surface region,
-            # to serve as fundus endpoints:
-            # ----------------------------------------------------------------
-            outer_anchors, tracks = find_outer_endpoints(indices_fold,
-                neighbor_lists, values, depths, min_separation,
-                background_value, verbose)
-
-            # ----------------------------------------------------------------
-            # Find inner anchor points:
-            # ----------------------------------------------------------------
-            inner_anchors = find_max_values(points, values, min_separation,
-                                            thr)
-
-            # ----------------------------------------------------------------
-            # Connect anchor points to create skeleton:
-            # ----------------------------------------------------------------
-            B = background_value * np.ones(npoints)
-            B[indices_fold] = 1
-            skeleton = connect_points_erosion(B, neighbor_lists,
-                outer_anchors, inner_anchors, values, erode_ratio,
-                erode_min_size, [], '', background_value, verbose)
-            if skeleton:
-                skeletons.extend(skeleton)
-
-            ## ---------------------------------------------------------------
-            ## Remove fundus vertices if they make complete triangle faces:
-            ## ---------------------------------------------------------------
-            #Iremove = find_complete_faces(skeletons, faces)
-            #if Iremove:
-            #    skeletons = list(frozenset(skeletons).difference(Iremove))
+    shared = dict(neighbor_lists=neighbor_lists, values=values,
+                  depths=depths, inner_anchors=inner_anchors,
+                  npoints=npoints, min_separation=min_separation,
+                  erode_ratio=erode_ratio, erode_min_size=erode_min_size,
+                  background_value=background_value, verbose=verbose)
+    fold_skeletons = [[] for x in fold_lists]
+    tasks = [(unique_fold_IDs[ifold], fold_lists[ifold]) for ifold in order]
+    for itask, skeleton in map_processes(_extract_fold_skeleton, tasks,
+                                         shared, n_processes):
+        fold_skeletons[order[itask]] = skeleton
+
+    # Merge skeletons in order of fold IDs:
+    for skeleton in fold_skeletons:
+        if skeleton:
+            skeletons.extend(skeleton)
 
     indices_skel = [x for x in skeletons if folds[x] != background_value]
     fundus_per_fold = background_value * np.ones(npoints)
@@ -249,6 +257,51 @@ def extract_fundi(folds, curv_file, depth_file, min_separation=10,
     return fundus_per_fold,  n_fundi_in_folds, fundus_per_fold_file
 
 
+def _extract_fold_skeleton(fold_ID, indices_fold, neighbor_lists, values,
+                           depths, inner_anchors, npoints, min_separation,
+                           erode_ratio, erode_min_size, background_value,
+                           verbose):
+    """
+    Connect the outer and inner anchor points of one fold with a skeleton.
+
+    See extract_fundi() for a description of the parameters.
+
+    """
+    import numpy as np
+
+    from mindboggle.guts.paths import find_outer_endpoints
+    from mindboggle.guts.paths import connect_points_erosion
+
+    if verbose:
+        print('  Fold {0}:'.format(int(fold_ID)))
+
+    # ------------------------------------------------------------------------
+    # Find outer anchor points on the boundary of the surface region,
+    # to serve as fundus endpoints:
+    # ------------------------------------------------------------------------
+    outer_anchors, tracks = find_outer_endpoints(indices_fold,
+        neighbor_lists, values, depths, min_separation,
+        background_value, verbose)
+
+    # ------------------------------------------------------------------------
+    # Connect anchor points to create skeleton:
+    # ------------------------------------------------------------------------
+    B = background_value * np.ones(npoints)
+    B[indices_fold] = 1
+    skeleton = connect_points_erosion(B, neighbor_lists,
+        outer_anchors, inner_anchors, values, erode_ratio,
+        erode_min_size, [], '', background_value, verbose)
+
+    ## ------------------------------------------------------------------------
+    ## Remove fundus vertices if they make complete triangle faces:
+    ## ------------------------------------------------------------------------
+    #Iremove = find_complete_faces(skeletons, faces)
+    #if Iremove:
+    #    skeletons = list(frozenset(skeletons).difference(Iremove))
+
+    return skeleton
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
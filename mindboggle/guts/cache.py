@@ -0,0 +1,256 @@
+#!/usr/bin/python
+"""
+Content-addressed cache for results computed on surface meshes.
+
+Results such as Laplace-Beltrami spectra, Zernike descriptors, and label
+boundary indices are expensive to compute, and depend only on a (sub)mesh
+and on the parameters of the computation. Results are stored in a local
+directory as pickle files named by a hash of those arrays and parameters,
+so that unchanged meshes are read from disk rather than recomputed when a
+subject is run again. The least recently used files are removed when the
+directory grows beyond a size limit.
+
+Authors:
+    - Arno Klein, 2016  (arno@mindboggle.info)  http://binarybottle.com
+
+Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
+
+"""
+
+# Default size limit for a cache directory (bytes):
+_max_cache_size = 500 * 2**20
+
+
+def cache_key(arrays, parameters):
+    """
+    Hash arrays and parameters to a key for a cached result.
+
+    Parameters
+    ----------
+    arrays : list of numpy arrays, lists, strings, or None
+        arrays defining the submesh (strings such as a key from an earlier
+        call are hashed as is, to avoid rehashing a large array)
+    parameters : dictionary
+        parameters of the computation
+
+    Returns
+    -------
+    key : string
+        md5 hex digest
+
+    Examples
+    --------
+    >>> from mindboggle.guts.cache import cache_key
+    >>> points = [[0,0,0], [1,0,0], [0,0,1], [0,1,1]]
+    >>> faces = [[0,1,2], [0,2,3]]
+    >>> key = cache_key([points, faces], {'order': 3})
+    >>> len(key)
+    32
+    >>> key == cache_key([points, faces], {'order': 3})
+    True
+    >>> key == cache_key([points, faces], {'order': 4})
+    False
+    >>> key == cache_key([points, faces[0:1]], {'order': 3})
+    False
+
+    """
+    import hashlib
+    import numpy as np
+
+    hasher = hashlib.md5()
+    for array in arrays:
+        if array is None:
+            hasher.update(b'None')
+        elif isinstance(array, str):
+            hasher.update(array.encode())
+        else:
+            array = np.ascontiguousarray(array)
+            hasher.update(str((array.dtype.str, array.shape)).encode())
+            hasher.update(array.tobytes())
+    hasher.update(repr(sorted(parameters.items())).encode())
+
+    return hasher.hexdigest()
+
+
+def load_cached(key, cache_directory):
+    """
+    Load a cached result.
+
+    Parameters
+    ----------
+    key : string
+        key from cache_key()
+    cache_directory : string
+        cache directory
+
+    Returns
+    -------
+    found : bool
+        was the result found in the cache?
+    result : object
+        cached result (None if not found)
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from mindboggle.guts.cache import load_cached, save_cached
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> load_cached('0123', cache_directory)
+    (False, None)
+    >>> save_cached('0123', [0.0, 0.5], cache_directory)
+    >>> load_cached('0123', cache_directory)
+    (True, [0.0, 0.5])
+
+    """
+    import os
+    import pickle
+
+    cache_file = os.path.join(cache_directory, key + '.pkl')
+    try:
+        with open(cache_file, 'rb') as f:
+            result = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return False, None
+
+    # Mark the file as recently used:
+    try:
+        os.utime(cache_file, None)
+    except OSError:
+        pass
+
+    return True, result
+
+
+def save_cached(key, result, cache_directory, max_size=None):
+    """
+    Save a result to the cache, and evict old files if the cache is too big.
+
+    The file is written under a temporary name and then renamed, so that
+    concurrent processes never read a partially written result.
+
+    Parameters
+    ----------
+    key : string
+        key from cache_key()
+    result : object
+        result to store (must be picklable)
+    cache_directory : string
+        cache directory (created if missing)
+    max_size : integer
+        maximum total size of the cache directory in bytes
+        (None for the default)
+
+    Examples
+    --------
+    >>> import os
+    >>> import tempfile
+    >>> from mindboggle.guts.cache import save_cached
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> save_cached('0123', [0.0, 0.5], cache_directory)
+    >>> os.listdir(cache_directory)
+    ['0123.pkl']
+
+    """
+    import os
+    import pickle
+    import tempfile
+
+    from mindboggle.guts.cache import evict_cached, _max_cache_size
+
+    if max_size is None:
+        max_size = _max_cache_size
+
+    if not os.path.isdir(cache_directory):
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            if not os.path.isdir(cache_directory):
+                raise
+
+    handle, temporary_file = tempfile.mkstemp(suffix='.tmp',
+                                              dir=cache_directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file, os.path.join(cache_directory,
+                                                key + '.pkl'))
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+    evict_cached(cache_directory, max_size)
+
+
+def evict_cached(cache_directory, max_size=None):
+    """
+    Remove least recently used results until the cache fits a size limit.
+
+    Parameters
+    ----------
+    cache_directory : string
+        cache directory
+    max_size : integer
+        maximum total size of the cache directory in bytes
+        (None for the default)
+
+    Returns
+    -------
+    removed : integer
+        number of files removed
+
+    Examples
+    --------
+    >>> import os
+    >>> import tempfile
+    >>> from mindboggle.guts.cache import save_cached, evict_cached
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> for key in ['a', 'b', 'c']:
+    ...     save_cached(key, list(range(100)), cache_directory)
+    >>> os.utime(os.path.join(cache_directory, 'a.pkl'), (0, 0))
+    >>> size = os.path.getsize(os.path.join(cache_directory, 'b.pkl'))
+    >>> evict_cached(cache_directory, 2 * size)
+    1
+    >>> sorted(os.listdir(cache_directory))
+    ['b.pkl', 'c.pkl']
+
+    """
+    import os
+
+    from mindboggle.guts.cache import _max_cache_size
+
+    if max_size is None:
+        max_size = _max_cache_size
+
+    files = []
+    total_size = 0
+    for name in os.listdir(cache_directory):
+        if name.endswith('.pkl'):
+            try:
+                stat = os.stat(os.path.join(cache_directory, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+            total_size += stat.st_size
+
+    # Remove the least recently used files first:
+    removed = 0
+    for mtime, name, size in sorted(files):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_directory, name))
+            removed += 1
+        except OSError:
+            pass
+        total_size -= size
+
+    return removed
+
+
+# ============================================================================
+# Doctests
+# ============================================================================
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod(verbose=True)  # py.test --doctest-modules
@@ -5,6 +5,7 @@ Graph operations:
     - Diagonal degree matrix
     - Matrix weights and affinity matrix
     - Graph Laplacian
+    - Harmonic label propagation
 
 Authors:
     - Eliezer Stavsky, 2012 (eli.stavsky@gmail.com)
@@ -13,8 +14,6 @@ Authors:
 Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 """
-import networkx as nx
-
 from mindboggle.guts.kernels import rbf_kernel
 
 
@@ -65,30 +64,35 @@ def diagonal_degree_matrix(W, inverse=False, square_root=False):
 
 
 def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
-                 G=nx.Graph(), sigma=20, verbose=False):
+                 G=None, sigma=20, verbose=False):
     """
     Construct weighted edges of a graph and compute an affinity matrix.
 
+    The kernel is evaluated on arrays of all edge endpoints at once, and the
+    symmetric sparse affinity matrix is built directly from (row, column,
+    weight) triplets, keeping one weight per edge.
+
     Parameters
     ----------
     Nodes : numpy array
     Indices : list of integers
     Meshes : numpy array
     kernel : function which determines weights of edges
+        (evaluated on two arrays with one node per row, with axis=1)
         - rbf_kernel: Gaussian kernel, with parameter sigma
         - cotangent_kernel: weight calculation for Laplace_Beltrami_Operator
           (NOTE: option removed until it can be tested)
         - inverse_distance: additional kernel where the weight is the inverse
           of the distance between two nodes
-    add_to_graph :  boolean (add to graph?)
-    G :  networkx graph
+    add_to_graph :  boolean (add to networkx graph?)
+    G :  networkx graph (None: a new graph)
     sigma :  float (parameter for rbf_kernel)
     verbose : bool
         print statements?
 
     Returns
     -------
-    G :  networkx graph
+    G :  networkx graph (if add_to_graph)
     affinity_matrix :  numpy array (sparse affinity matrix)
 
     Examples
@@ -111,46 +115,66 @@ def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
     9
     >>> sorted(dict(G.degree()).items())
     [(0.0, 4), (1.0, 4), (2.0, 3), (3.0, 4), (4.0, 3)]
+    >>> affinity_matrix = weight_graph(Nodes, Indices, Meshes, kernel,
+    ...                                add_to_graph=False, sigma=sigma)
+    >>> affinity_matrix.nnz
+    18
+    >>> print('{0:0.5f}'.format(affinity_matrix[0, 4]))
+    0.98020
 
     """
     import numpy as np
-    from scipy.sparse import lil_matrix
+    from scipy.sparse import csr_matrix
     from mindboggle.guts.kernels import rbf_kernel, inverse_distance
                                         #cotangent_kernel
 
-    if kernel is rbf_kernel or kernel is inverse_distance:
-        if verbose:
-            if kernel is rbf_kernel:
-                print('Compute weights using rbf kernel (sigma={0})'.
-                      format(sigma))
-            else:
-                print('Compute weights using inverse distance kernel '
-                      '(sigma={0})'.format(sigma))
-
-        # Construct matrix of edge lines by breaking triangle into three edges.
-        if Meshes.shape[1] == 3:
-            edge_mat = np.vstack((Meshes.T[0:2].T, Meshes.T[1:3].T, Meshes.T[:3:2].T))
-        elif Meshes.shape[1] == 2:
-            edge_mat = Meshes
-        # Augment matrix to contain edge weight in the third column
-        weighted_edges = np.asarray([[Indices[np.int(i)], Indices[np.int(j)],
-            kernel(Nodes[np.int(Indices[np.int(i)])],
-                   Nodes[np.int(Indices[np.int(j)])], sigma)]
-                   for [i, j] in edge_mat])
-
-        # Add weights to graph
-        if add_to_graph:
-            if verbose:
-                print('Add weighted edges to the graph')
-            G.add_weighted_edges_from(weighted_edges)
-
-        # Construct affinity matrix
+    if verbose:
+        if kernel is rbf_kernel:
+            print('Compute weights using rbf kernel (sigma={0})'.
+                  format(sigma))
+        elif kernel is inverse_distance:
+            print('Compute weights using inverse distance kernel '
+                  '(sigma={0})'.format(sigma))
+
+    # Construct matrix of edge lines by breaking triangle into three edges.
+    Meshes = np.asarray(Meshes)
+    if Meshes.shape[1] == 3:
+        edge_mat = np.vstack((Meshes[:, [0, 1]], Meshes[:, [1, 2]],
+                              Meshes[:, [0, 2]]))
+    else:
+        edge_mat = Meshes[:, 0:2]
+    edge_mat = edge_mat.astype(int)
+
+    # Compute edge weights from the kernel for all edges at once:
+    Nodes = np.asarray(Nodes)
+    Nodes = Nodes.reshape(Nodes.shape[0], -1)
+    Indices = np.asarray(Indices).astype(int)
+    rows = Indices[edge_mat[:, 0]]
+    cols = Indices[edge_mat[:, 1]]
+    edge_weights = kernel(Nodes[rows], Nodes[cols], sigma, axis=1)
+
+    # Add weights to graph
+    if add_to_graph:
+        import networkx as nx
+        if G is None:
+            G = nx.Graph()
         if verbose:
-            print('Construct sparse affinity matrix of size {0}'.
-                format(Nodes.shape[0]))
-        affinity_matrix = lil_matrix((Nodes.shape[0], Nodes.shape[0]))
-        for [i, j, edge_weight] in weighted_edges:
-            affinity_matrix[i, j] = affinity_matrix[j, i] = edge_weight
+            print('Add weighted edges to the graph')
+        G.add_weighted_edges_from(np.column_stack((rows, cols,
+                                                   edge_weights)))
+
+    # Construct symmetric affinity matrix, with one weight per edge:
+    if verbose:
+        print('Construct sparse affinity matrix of size {0}'.
+            format(Nodes.shape[0]))
+    npoints = Nodes.shape[0]
+    rows, cols = np.concatenate((rows, cols)), np.concatenate((cols, rows))
+    edge_weights = np.concatenate((edge_weights, edge_weights))
+    keys, Iunique = np.unique(rows * npoints + cols, return_index=True)
+    affinity_matrix = csr_matrix((edge_weights[Iunique],
+                                  (rows[Iunique], cols[Iunique])),
+                                 shape=(npoints, npoints))
+    affinity_matrix.eliminate_zeros()
 
     # elif kernel is cotangent_kernel:
     #     if verbose:
@@ -173,9 +197,9 @@ def weight_graph(Nodes, Indices, Meshes, kernel=rbf_kernel, add_to_graph=True,
     # Return the affinity matrix as a "compressed sparse row" matrix
     # (http://docs.scipy.org/doc/scipy/reference/sparse.html)
     if add_to_graph:
-        return G, affinity_matrix.tocsr()
+        return G, affinity_matrix
     else:
-        return affinity_matrix.tocsr()
+        return affinity_matrix
 
 
 def graph_laplacian(W, type_of_laplacian='norm1', verbose=False):
@@ -262,6 +286,108 @@ def graph_laplacian(W, type_of_laplacian='norm1', verbose=False):
     return Laplacian
 
 
+def harmonic_labels(W, Y, clamped, solver='direct', tol=0.000001,
+                    max_iters=1000, verbose=False):
+    """
+    Propagate labels by solving for harmonic functions on a graph.
+
+    Each column of the label matrix is clamped at the labeled vertices,
+    and the unlabeled vertices take the weighted average of their
+    neighbors (Zhu, Ghahramani, and Lafferty, 2003), which is the
+    fixed point of iterative label propagation. With the graph Laplacian
+    L = D - W partitioned into labeled (l) and unlabeled (u) vertices,
+    all columns are solved at once from the sparse system::
+
+        L_uu X_u = W_ul Y_l
+
+    Unlabeled vertices that are not connected to any labeled vertex
+    are assigned zeros.
+
+    Parameters
+    ----------
+    W : N x N sparse matrix in csr format (affinity matrix)
+    Y : N x C numpy array
+        label assignment values (only rows of clamped vertices are used)
+    clamped : numpy array of booleans
+        clamp (keep the label values of) each vertex?
+    solver : string
+        'direct' (sparse LU factorization shared by all columns)
+        or 'cg' (conjugate gradient with a Jacobi preconditioner per column)
+    tol : float
+        relative residual tolerance (for 'cg')
+    max_iters : integer
+        maximum number of iterations (for 'cg')
+    verbose : bool
+        print statements?
+
+    Returns
+    -------
+    X : N x C numpy array
+        harmonic label values for all vertices
+
+    Examples
+    --------
+    >>> # Two seeds at either end of a path of five vertices:
+    >>> import numpy as np
+    >>> from scipy.sparse import csr_matrix
+    >>> from mindboggle.guts.graph import harmonic_labels
+    >>> W = csr_matrix(np.diag(np.ones(4), 1) + np.diag(np.ones(4), -1))
+    >>> Y = np.zeros((5, 2))
+    >>> Y[0] = [1, -1]
+    >>> Y[4] = [-1, 1]
+    >>> clamped = np.array([True, False, False, False, True])
+    >>> X = harmonic_labels(W, Y, clamped)
+    >>> X[:, 0].tolist()
+    [1.0, 0.5, 0.0, -0.5, -1.0]
+    >>> X = harmonic_labels(W, Y, clamped, solver='cg')
+    >>> np.allclose(X[:, 1], [-1, -0.5, 0, 0.5, 1])
+    True
+
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix, diags
+    from scipy.sparse.csgraph import connected_components
+    from scipy.sparse.linalg import splu, cg
+
+    W = csr_matrix(W)
+    clamped = np.asarray(clamped, dtype=bool)
+    X = np.zeros(np.shape(Y))
+    X[clamped] = Y[clamped]
+
+    # Only solve for unlabeled vertices connected to labeled vertices:
+    ncomponents, components = connected_components(W, directed=False)
+    solvable = np.zeros(ncomponents, dtype=bool)
+    solvable[components[clamped]] = True
+    Iu = np.where(~clamped & solvable[components])[0]
+    Il = np.where(clamped)[0]
+    if not Iu.size:
+        return X
+
+    # Partition the graph Laplacian:
+    degrees = np.asarray(W.sum(axis=1)).ravel()
+    L_uu = diags(degrees[Iu]) - W[Iu][:, Iu]
+    B = W[Iu][:, Il] * Y[Il]
+
+    if verbose:
+        print('Solve for {0} unlabeled vertices and {1} labels ({2})'.
+              format(len(Iu), np.shape(Y)[1], solver))
+    if solver == 'direct':
+        X[Iu] = splu(L_uu.tocsc()).solve(B)
+    elif solver == 'cg':
+        M = diags(1.0 / degrees[Iu])
+        for icolumn in range(np.shape(Y)[1]):
+            b = B[:, icolumn]
+            X[Iu, icolumn], info = cg(L_uu, b, M=M, maxiter=max_iters,
+                                      atol=tol * np.linalg.norm(b))
+            if verbose and info > 0:
+                print('  Label {0} did not converge in {1} iterations'.
+                      format(icolumn, max_iters))
+    else:
+        raise IOError("Solver '{0}' is not available.".format(solver))
+
+    return X
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
@@ -11,19 +11,22 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 """
 
 
-def rbf_kernel(x1, x2, sigma):
+def rbf_kernel(x1, x2, sigma, axis=None):
     """
     Compute normalized and unnormalized graph Laplacians.
 
     Parameters
     ----------
-    x1 : Nx1 numpy array
-    x2 : Nx1 numpy array
+    x1 : Nx1 numpy array (or MxN array with one point per row if axis=1)
+    x2 : Nx1 numpy array (or MxN array with one point per row if axis=1)
     sigma : float
+    axis : integer or None
+        axis of x1 and x2 along which to compute distances
+        (None: x1 and x2 are single points; 1: one point per row)
 
     Returns
     -------
-    rbf : float
+    rbf : float (or M numpy array of floats if axis=1)
 
     Examples
     --------
@@ -35,11 +38,20 @@ def rbf_kernel(x1, x2, sigma):
     >>> rbf = rbf_kernel(x1, x2, sigma)
     >>> print('{0:0.5f}'.format(rbf))
     0.96079
+    >>> rbf = rbf_kernel(x1[:, np.newaxis], x2[:, np.newaxis], sigma)
+    >>> print('{0:0.5f}'.format(rbf))
+    0.96079
+    >>> rbfs = rbf_kernel(np.array([x1, x1]), np.array([x2, x1]), sigma,
+    ...                   axis=1)
+    >>> print(np.array_str(rbfs, precision=5))
+    [0.96079 1.     ]
 
     """
     import numpy as np
 
-    return np.exp(-np.linalg.norm(x1 - x2) ** 2 / (2 * sigma ** 2))
+    distances = np.linalg.norm(x1 - x2, axis=axis)
+
+    return np.exp(-distances ** 2 / (2 * sigma ** 2))
 
 
 # def cotangent_kernel(Nodes, Meshes):
@@ -92,20 +104,23 @@ def rbf_kernel(x1, x2, sigma):
 #     return W
 
 
-def inverse_distance(x1, x2, epsilon):
+def inverse_distance(x1, x2, epsilon, axis=None):
     """
     This function constructs weighted edges of a graph,
     where the weight is the inverse of the distance between two nodes.
 
     Parameters
     ----------
-    x1 : Nx1 numpy array
-    x2 : Nx1 numpy array
+    x1 : Nx1 numpy array (or MxN array with one point per row if axis=1)
+    x2 : Nx1 numpy array (or MxN array with one point per row if axis=1)
     epsilon : float
+    axis : integer or None
+        axis of x1 and x2 along which to compute distances
+        (None: x1 and x2 are single points; 1: one point per row)
 
     Returns
     -------
-    d : float
+    d : float (or M numpy array of floats if axis=1)
 
     Examples
     --------
@@ -117,11 +132,20 @@ def inverse_distance(x1, x2, epsilon):
     >>> d = inverse_distance(x1, x2, epsilon)
     >>> print('{0:0.5f}'.format(d))
     5.22408
+    >>> d = inverse_distance(x1[:, np.newaxis], x2[:, np.newaxis], epsilon)
+    >>> print('{0:0.5f}'.format(d))
+    5.22408
+    >>> ds = inverse_distance(np.array([x1, x1]), np.array([x2, x1]), epsilon,
+    ...                       axis=1)
+    >>> print(np.array_str(ds, precision=5))
+    [ 5.22408 20.     ]
 
     """
     import numpy as np
 
-    return 1.0/(np.linalg.norm(x1 - x2) + epsilon)
+    distances = np.linalg.norm(x1 - x2, axis=axis)
+
+    return 1.0/(distances + epsilon)
 
 
 # ============================================================================
@@ -240,6 +240,204 @@ def find_neighborhood(neighbor_lists, indices, nedges=1):
     return neighborhood
 
 
+def find_neighborhoods(neighbor_lists, indices, nedges=1):
+    """
+    Find the neighborhood of each of a set of surface mesh vertices.
+
+    This is a batched version of find_neighborhood() for one index at a time:
+    all neighborhoods are propagated together by sparse matrix products,
+    one edge at a time, using only the neighbor lists of vertices reached.
+
+    Parameters
+    ----------
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    indices : list of integers
+        indices of surface vertices
+    nedges : integer
+        number of edges to propagate from indices
+
+    Returns
+    -------
+    neighborhoods : len(indices) x N sparse boolean matrix in csr format
+        True at [i, j] if vertex j is in the neighborhood of indices[i]
+        (not including indices[i] itself)
+
+    Examples
+    --------
+    >>> from mindboggle.guts.mesh import find_neighborhoods
+    >>> neighbor_lists = [[0,1],[0,2],[1,4,5],[2],[],[0,1,4,5]]
+    >>> indices = [1,3,4]
+    >>> neighborhoods = find_neighborhoods(neighbor_lists, indices, 2)
+    >>> [row.indices.tolist() for row in neighborhoods]
+    [[0, 2, 4, 5], [1, 2, 4, 5], []]
+
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix
+
+    from mindboggle.guts.mesh import neighbor_lists_to_csr
+
+    indices = np.asarray(indices, dtype=int).ravel()
+    npoints = len(neighbor_lists)
+
+    # Propagate nedges away from each index, through the neighbor lists of
+    # the vertices reached so far (rather than of all vertices):
+    seeds = csr_matrix((np.ones(len(indices), dtype=bool),
+                        (np.arange(len(indices)), indices)),
+                       shape=(len(indices), npoints))
+    neighborhoods = seeds
+    for iedge in range(nedges):
+        reached = np.unique(neighborhoods.indices)
+        adjacency = neighbor_lists_to_csr(neighbor_lists,
+                                          reached).astype(bool)
+        neighborhoods = (neighborhoods + neighborhoods * adjacency).tocsr()
+
+    # Remove each index from its own neighborhood:
+    neighborhoods = (neighborhoods > seeds).tocsr()
+    neighborhoods.sort_indices()
+
+    return neighborhoods
+
+
+def neighbor_lists_to_csr(neighbor_lists, indices=None):
+    """
+    Convert neighbor lists to a sparse adjacency matrix.
+
+    Parameters
+    ----------
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    indices : list (or array) of integers (or None for all vertices)
+        indices to vertices whose neighbor lists to include as matrix rows
+        (rows for all other vertices are left empty)
+
+    Returns
+    -------
+    adjacency : N x N sparse matrix in csr format (N = number of vertices)
+        ones at [i, j] for each neighbor j in the neighbor list of vertex i
+
+    Examples
+    --------
+    >>> from mindboggle.guts.mesh import neighbor_lists_to_csr
+    >>> neighbor_lists = [[1,2],[0,3],[0,3],[1,2,4],[3],[]]
+    >>> A = neighbor_lists_to_csr(neighbor_lists)
+    >>> A.indptr.tolist()
+    [0, 2, 4, 6, 9, 10, 10]
+    >>> A.indices.tolist()
+    [1, 2, 0, 3, 0, 3, 1, 2, 4, 3]
+    >>> A = neighbor_lists_to_csr(neighbor_lists, [3, 4])
+    >>> A.indptr.tolist()
+    [0, 0, 0, 0, 3, 4, 4]
+
+    """
+    import numpy as np
+    from scipy.sparse import csr_matrix
+
+    npoints = len(neighbor_lists)
+    if indices is None:
+        indices = np.arange(npoints)
+    else:
+        indices = np.unique(np.asarray(indices, dtype=int))
+
+    sizes = np.array([len(neighbor_lists[x]) for x in indices], dtype=int)
+    indptr = np.zeros(npoints + 1, dtype=int)
+    indptr[indices + 1] = sizes
+    indptr = np.cumsum(indptr)
+    neighbors = np.fromiter((x for i in indices for x in neighbor_lists[i]),
+                            dtype=int, count=int(np.sum(sizes)))
+    data = np.ones(len(neighbors), dtype=np.int8)
+
+    adjacency = csr_matrix((data, neighbors, indptr), shape=(npoints, npoints))
+
+    return adjacency
+
+
+def find_hop_distances(seeds, neighbor_lists, indices=None, max_hops=None,
+                       background_value=-1):
+    """
+    Find the number of edges from a set of seed vertices to other vertices.
+
+    A single multi-source breadth-first search propagates outward from
+    all seeds at once over a compressed sparse row (CSR) copy of the
+    neighbor lists, so the cost is proportional to the number of vertices
+    and edges visited rather than to the number of concentric rings.
+
+    Parameters
+    ----------
+    seeds : list (or array) of integers
+        indices to seed vertices (distance zero)
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+    indices : list (or array) of integers (or None for all vertices)
+        indices to vertices through which to propagate
+    max_hops : integer (or None for no limit)
+        maximum number of edges to propagate from the seeds
+    background_value : integer
+        value for vertices not reached from the seeds
+
+    Returns
+    -------
+    hops : numpy array of integers
+        number of edges to the nearest seed for all vertices
+
+    Examples
+    --------
+    >>> from mindboggle.guts.mesh import find_hop_distances
+    >>> neighbor_lists = [[1,2],[0,3],[0,3],[1,2,4],[3,5],[4],[]]
+    >>> find_hop_distances([0], neighbor_lists)
+    array([ 0,  1,  1,  2,  3,  4, -1])
+    >>> find_hop_distances([0, 5], neighbor_lists, max_hops=1)
+    array([ 0,  1,  1, -1,  1,  0, -1])
+    >>> find_hop_distances([0], neighbor_lists, indices=[1,3,4])
+    array([ 0,  1, -1,  2,  3, -1, -1])
+
+    """
+    import numpy as np
+    from mindboggle.guts.mesh import neighbor_lists_to_csr
+
+    npoints = len(neighbor_lists)
+    seeds = np.unique(np.asarray(seeds, dtype=int))
+    hops = background_value * np.ones(npoints, dtype=int)
+    if not seeds.size:
+        return hops
+
+    # Vertices through which to propagate (seeds are always included):
+    if indices is None:
+        allowed = np.ones(npoints, dtype=bool)
+    else:
+        allowed = np.zeros(npoints, dtype=bool)
+        allowed[np.asarray(indices, dtype=int)] = True
+        allowed[seeds] = True
+    vertices = np.where(allowed)[0]
+
+    # Compressed sparse row arrays of the neighbor lists of these vertices:
+    adjacency = neighbor_lists_to_csr(neighbor_lists, vertices)
+    indptr = adjacency.indptr
+    csr_indices = adjacency.indices
+
+    # Propagate from all seeds, one ring of vertices at a time:
+    visited = np.zeros(npoints, dtype=bool)
+    visited[seeds] = True
+    hops[seeds] = 0
+    frontier = seeds
+    nhops = 0
+    while frontier.size and (max_hops is None or nhops < max_hops):
+        starts = indptr[frontier]
+        counts = indptr[frontier + 1] - starts
+        ends = np.cumsum(counts)
+        gather = np.arange(ends[-1]) + np.repeat(starts - ends + counts,
+                                                 counts)
+        neighbors = csr_indices[gather]
+        neighbors = neighbors[allowed[neighbors] & ~visited[neighbors]]
+        frontier = np.unique(neighbors)
+        nhops += 1
+        visited[frontier] = True
+        hops[frontier] = nhops
+
+    return hops
+
+
 def find_endpoints(indices, neighbor_lists):
     """
     Extract endpoints from connected set of vertices.
@@ -1550,6 +1748,104 @@ def topo_test(index, values, neighbor_lists):
     return sp, n_inside
 
 
+def topo_tests(indices, values, neighbor_lists):
+    """
+    Test to see if each of a set of vertices is a "simple point".
+
+    This is a batched version of topo_test(): every vertex is tested against
+    the same values, and the inside neighbors of all the vertices are grouped
+    at once as connected components of a sparse graph.
+
+    Parameters
+    ----------
+    indices : list (or array) of integers
+        indices of vertices
+    values : numpy array of integers or floats
+        values for all vertices
+    neighbor_lists : list of lists of integers
+        each list contains indices to neighboring vertices for each vertex
+
+    Returns
+    -------
+    sps : numpy array of bools
+        simple point or not, for each index
+    n_insides : numpy array of integers
+        number of neighboring vertices with a value greater than threshold
+
+    Examples
+    --------
+    >>> # Square with a center vertex:
+    >>> # indices [[0,1,2],[3,4,6],[7,8,9]] = 0 and indices [2,4,6] = 1:
+    >>> import numpy as np
+    >>> from mindboggle.guts.mesh import topo_tests
+    >>> values = np.array([0,0,1,0,1,0,1,0,0])
+    >>> neighbor_lists = [[1,3],[0,2,3,4],[1,4,5],
+    ...                   [0,1,4,6],[1,2,3,5,6,7],[2,4,7,8],
+    ...                   [3,4,7],[4,5,6,8],[5,7]]
+    >>> sps, n_insides = topo_tests(range(9), values, neighbor_lists)
+    >>> sps.tolist()
+    [False, True, True, True, False, True, True, True, False]
+    >>> n_insides.tolist()
+    [0, 2, 1, 2, 2, 2, 1, 2, 0]
+
+    """
+    import numpy as np
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    # Make sure arguments are numpy arrays:
+    if not isinstance(values, np.ndarray):
+        values = np.array(values)
+    indices = np.asarray(indices, dtype=int).ravel()
+    npoints = len(values)
+    inside = values > 0.5
+
+    # Count inside and outside neighbors of each vertex:
+    sizes = np.array([len(neighbor_lists[x]) for x in indices], dtype=int)
+    rows = np.repeat(np.arange(len(indices)), sizes)
+    neighbors = np.fromiter((x for i in indices for x in neighbor_lists[i]),
+                            dtype=int, count=int(np.sum(sizes)))
+    is_in = inside[neighbors]
+    n_insides = np.bincount(rows[is_in], minlength=len(indices))
+    n_outsides = sizes - n_insides
+
+    # A vertex IS NOT a simple point if it has no inside or outside neighbors,
+    # and IS a simple point if it has one inside or one outside neighbor:
+    sps = (n_insides * n_outsides != 0) & \
+          ((n_insides == 1) | (n_outsides == 1))
+
+    # Otherwise, a vertex is a simple point if all of its inside neighbors
+    # are connected by sharing inside neighbors (other than the vertex):
+    test = (n_insides > 1) & (n_outsides > 1)
+    keep = is_in & test[rows]
+    if np.any(keep):
+        rows1 = rows[keep]
+        inner = neighbors[keep]
+        sizes2 = np.array([len(neighbor_lists[x]) for x in inner], dtype=int)
+        rows2 = np.repeat(rows1, sizes2)
+        inner2 = np.repeat(inner, sizes2)
+        outer2 = np.fromiter((x for i in inner for x in neighbor_lists[i]),
+                             dtype=int, count=int(np.sum(sizes2)))
+        keep2 = inside[outer2] & (outer2 != indices[rows2])
+        keys1 = rows1 * npoints + inner
+        keys2 = rows2[keep2] * npoints + inner2[keep2]
+        keys3 = rows2[keep2] * npoints + outer2[keep2]
+        nodes, inverse = np.unique(np.concatenate((keys1, keys2, keys3)),
+                                   return_inverse=True)
+        n1, n2 = len(keys1), len(keys2)
+        graph = coo_matrix((np.ones(n2, dtype=np.int8),
+                            (inverse[n1:n1 + n2], inverse[n1 + n2:])),
+                           shape=(len(nodes), len(nodes)))
+        ncomponents, components = connected_components(graph, directed=False)
+
+        # Count the groups of inside neighbors for each vertex:
+        groups = np.unique(rows1 * ncomponents + components[inverse[:n1]])
+        ngroups = np.bincount(groups // ncomponents, minlength=len(indices))
+        sps[test] = ngroups[test] == 1
+
+    return sps, n_insides
+
+
 # def fill_holes(regions, neighbor_lists, values=[], exclude_range=[],
 #                background_value=-1):
 #     """
@@ -19,7 +19,12 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
     Connect mesh vertices with a skeleton of 1-vertex-thick curves by erosion.
 
     This algorithm iteratively removes simple topological points and endpoints,
-    optionally in order of lowest to highest values.
+    optionally in order of lowest to highest values. Each pass tests the
+    frontier of the region: vertices on its edge, excluding points found
+    not to be simple in earlier passes. Since the region only shrinks, the
+    frontier and the candidate endpoints are updated around each removed
+    vertex, so a pass costs time proportional to the frontier rather than
+    to the region.
 
     Parameters
     ----------
@@ -50,7 +55,7 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
     Returns
     -------
     skeleton : list of integers
-        indices to vertices of skeleton
+        indices to vertices of skeleton (sorted)
 
     Examples
     --------
@@ -121,9 +126,10 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
 
     """
     import numpy as np
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
 
-    from mindboggle.guts.mesh import topo_test, extract_edge, find_endpoints
-    from mindboggle.guts.segment import segment_regions
+    from mindboggle.guts.mesh import topo_test
 
     # Make sure arguments are numpy arrays:
     if not isinstance(S, np.ndarray):
@@ -134,21 +140,62 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
         if not isinstance(values, np.ndarray):
             values = np.array(values)
 
-    keep = outer_anchors[:]
-    keep.extend(inner_anchors)
+    keep = np.zeros(len(S), dtype=bool)
+    keep[outer_anchors] = True
+    keep[inner_anchors] = True
+    is_outer = np.zeros(len(S), dtype=bool)
+    is_outer[outer_anchors] = True
     remove_endpoints = True
 
     if save_steps:
         from mindboggle.mio.vtks import rewrite_scalars
         S0 = S.copy()
 
+    # ------------------------------------------------------------------------
+    # Count each region vertex's neighbors in the region. The region only
+    # shrinks, so the frontier (edge vertices not known to be complex) and
+    # the candidate endpoints (vertices whose counts changed) are updated
+    # around each removed vertex rather than recomputed over the region:
+    # ------------------------------------------------------------------------
+    inside = S != background_value
+    region = np.where(inside)[0]
+    nneighbors = np.array([len(x) for x in neighbor_lists])
+    ninside = np.zeros(len(S), dtype=int)
+    for index in region:
+        ninside[index] = np.sum(inside[neighbor_lists[index]])
+    frontier = set(region[ninside[region] < nneighbors[region]].tolist())
+    changed = set(region.tolist())
+    complex = np.zeros(len(S), dtype=bool)
+
+    def remove(indices):
+        """Remove vertices from the region and update the frontier."""
+        S[indices] = background_value
+        for index in indices:
+            inside[index] = False
+            frontier.discard(index)
+            for neighbor in neighbor_lists[index]:
+                ninside[neighbor] -= 1
+                if inside[neighbor]:
+                    changed.add(neighbor)
+                    if not complex[neighbor]:
+                        frontier.add(neighbor)
+
+    def test(index):
+        """Remove a simple point, or else mark it as complex."""
+        simple, d = topo_test(index, S, neighbor_lists)
+        if simple:
+            remove([index])
+        else:
+            complex[index] = True
+            frontier.discard(index)
+        return simple
+
     # ------------------------------------------------------------------------
     # Iteratively remove simple points:
     # ------------------------------------------------------------------------
     if verbose:
         print('  Remove up to {0} of edge vertices per iteration'.
             format(erode_ratio))
-    complex = []
     count = -1
     exist_simple = True
     while exist_simple:
@@ -157,103 +204,91 @@ def connect_points_erosion(S, neighbor_lists, outer_anchors, inner_anchors=[],
             count += 1
 
         # --------------------------------------------------------------------
-        # Only consider updating vertices that are on the edge of the
-        # region and are not among the indices to keep or known simple points:
+        # Only consider updating vertices on the frontier (on the edge of the
+        # region and not known to be complex), except for indices to keep:
         # --------------------------------------------------------------------
-        indices = np.where(S != background_value)[0].tolist()
-        edge = extract_edge(indices, neighbor_lists)
-        if edge:
-            edge = np.array(list(set(edge).difference(complex)))
-            len_edge = np.shape(edge)[0]
-            if len_edge:
-
-                # ------------------------------------------------------------
-                # Segment edge vertices into separate connected groups:
-                # ------------------------------------------------------------
-                edge_segs = segment_regions(edge, neighbor_lists, 1, [],
-                                            False, False, [], [], [], '',
-                                            background_value, verbose)
-
-                edge_seg_numbers = [x for x in np.unique(edge_segs)
-                                    if x != background_value]
-                if verbose:
-                    len_numbers = len(edge_seg_numbers)
-                    if len_numbers > 1:
-                        print('    {0}: {1} edge points in {2} segments'.
-                              format(count, len_edge, len_numbers))
-                    else:
-                        print('    {0}: {1} edge points'.format(count, len_edge))
-                first_seg = True
-                for edge_seg_number in edge_seg_numbers:
-                    edge_seg = np.where(edge_segs == edge_seg_number)[0]
-                    edge_seg = np.array(list(set(edge_seg).difference(keep)))
-                    len_edge_seg = np.shape(edge_seg)[0]
-                    if len_edge_seg:
-
-                        # ----------------------------------------------------
-                        # Remove topologically simple points
-                        # in order of lowest to highest values:
-                        # ----------------------------------------------------
-                        ntests = len_edge_seg
-                        if erode_by_value and ntests > erode_min_size:
-                            Isort = np.argsort(values[edge_seg])
-                            edge_seg = edge_seg[Isort]
-                            if erode_ratio > 0:
-                                ntests = int(len_edge_seg * erode_ratio) + 1
-
-                        for index in edge_seg[0:ntests]:
-
-                            # Test to see if each index is a simple point:
-                            simple, d = topo_test(index, S, neighbor_lists)
-
-                            # If a simple point, remove and run again:
-                            # (Note: Must remove at each iteration)
-                            if simple:
-                                S[index] = background_value
+        edge = np.array(sorted(frontier), dtype=int)
+        len_edge = np.shape(edge)[0]
+        if len_edge:
+
+            # ----------------------------------------------------------------
+            # Segment edge vertices into separate connected groups:
+            # ----------------------------------------------------------------
+            local_indices = -1 * np.ones(len(S), dtype=int)
+            local_indices[edge] = np.arange(len_edge)
+            pairs = np.array([(local_indices[index], local_indices[x])
+                              for index in edge for x in neighbor_lists[index]
+                              if local_indices[x] > -1],
+                             dtype=int).reshape(-1, 2)
+            graph = coo_matrix((np.ones(len(pairs), dtype=np.int8),
+                                (pairs[:, 0], pairs[:, 1])),
+                               shape=(len_edge, len_edge))
+            len_numbers, edge_segs = connected_components(graph,
+                                                          directed=False)
+            order = np.argsort(edge_segs, kind='mergesort')
+            bounds = np.cumsum(np.bincount(edge_segs))[:-1]
+            if verbose:
+                if len_numbers > 1:
+                    print('    {0}: {1} edge points in {2} segments'.
+                          format(count, len_edge, len_numbers))
+                else:
+                    print('    {0}: {1} edge points'.format(count, len_edge))
+            first_seg = True
+            for edge_seg in np.split(edge[order], bounds):
+                edge_seg = edge_seg[~keep[edge_seg]]
+                len_edge_seg = np.shape(edge_seg)[0]
+                if len_edge_seg:
+
+                    # --------------------------------------------------------
+                    # Remove topologically simple points
+                    # in order of lowest to highest values:
+                    # --------------------------------------------------------
+                    ntests = len_edge_seg
+                    if erode_by_value and ntests > erode_min_size:
+                        Isort = np.argsort(values[edge_seg], kind='mergesort')
+                        edge_seg = edge_seg[Isort]
+                        if erode_ratio > 0:
+                            ntests = int(len_edge_seg * erode_ratio) + 1
+
+                    # (Note: Must remove at each iteration)
+                    for index in edge_seg[0:ntests]:
+                        if test(index):
+                            exist_simple = True
+
+                    # If no simple points, test all of the indices:
+                    if not exist_simple and erode_by_value:
+                        if verbose:
+                            print('    No simple points')
+                        for index in edge_seg[ntests::]:
+                            if test(index):
                                 exist_simple = True
-                            # Else store to exclude in future:
-                            else:
-                                complex.append(index)
-
-                        # If no simple points, test all of the indices:
-                        if not exist_simple and erode_by_value:
-                            if verbose:
-                                print('    No simple points')
-                            for index in edge_seg[ntests::]:
-                                simple, d = topo_test(index, S, neighbor_lists)
-                                # If a simple point, remove and run again:
-                                if simple:
-                                    S[index] = background_value
-                                    exist_simple = True
-                                # Else store to exclude in future:
-                                else:
-                                    complex.append(index)
-
-                        # Save incremental VTK files for debugging:
-                        if count in save_steps and first_seg:
-                            IDs = background_value * np.ones(len(values))
-                            IDs[indices] = values[indices]
-                            rewrite_scalars(save_vtk,
-                                            'edge'+str(count)+'.vtk',
-                                            IDs, 'edges', S0,
-                                            background_value)
-                        first_seg = False
-
-                # ------------------------------------------------------------
-                # Remove branches by iteratively removing endpoints:
-                # ------------------------------------------------------------
-                if remove_endpoints:
-                    indices = np.where(S != background_value)[0].tolist()
-                    endpts = True
-                    while endpts:
-                        endpts = find_endpoints(indices, neighbor_lists)
-                        if endpts:
-                            endpts = [x for x in endpts if x not in outer_anchors]
-                            if endpts:
-                                S[endpts] = background_value
-                                indices = list(set(indices).difference(endpts))
-
-    skeleton = indices
+
+                    # Save incremental VTK files for debugging:
+                    if count in save_steps and first_seg:
+                        indices = np.where(inside)[0]
+                        IDs = background_value * np.ones(len(values))
+                        IDs[indices] = values[indices]
+                        rewrite_scalars(save_vtk,
+                                        'edge'+str(count)+'.vtk',
+                                        IDs, 'edges', S0,
+                                        background_value)
+                    first_seg = False
+
+            # ----------------------------------------------------------------
+            # Remove branches by iteratively removing endpoints
+            # (vertices with one neighbor in the region), except for
+            # outer anchors; only vertices with a removed neighbor can
+            # become endpoints:
+            # ----------------------------------------------------------------
+            if remove_endpoints:
+                endpts = True
+                while endpts:
+                    endpts = sorted(x for x in changed if inside[x] and
+                                    ninside[x] == 1 and not is_outer[x])
+                    changed.clear()
+                    remove(endpts)
+
+    skeleton = np.where(inside)[0].tolist()
 
     return skeleton
 
@@ -367,12 +402,13 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
 
     """
     import numpy as np
-    from mindboggle.guts.mesh import topo_test
+    from mindboggle.guts.mesh import topo_test, topo_tests
     from mindboggle.guts.paths import connect_points_erosion
 
-    # Make sure argument is a numpy array
+    # Make sure arguments are numpy arrays
     if not isinstance(L, np.ndarray):
         L = np.array(L)
+    indices = np.asarray(indices, dtype=int)
 
     # ------------------------------------------------------------------------
     # Parameters:
@@ -459,38 +495,35 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
     # (to guarantee correct topology). Assign a 1 for each anchor point.
     # This influences surrounding vertex neighborhoods.
     # Note: 0.5 is the class boundary threshold for the HMMF values.
-    H = np.zeros(len(L))
+    # The extra (last) HMMF value of 0 is gathered for padded neighbors.
+    npoints_mesh = len(L)
+    H = np.zeros(npoints_mesh + 1)
     H_new = (L + 1.000001) / 2
     H_new[L == 0.0] = 0
     H_new[H_new > 1.0] = 1
-    H[H_new > 0.5] = H_new[H_new > 0.5]
+    H[:-1][H_new > 0.5] = H_new[H_new > 0.5]
     H[indices_points] = 1
     H_new = H.copy()
     H_tests = H.copy()
+    anchors = np.zeros(npoints_mesh, dtype=bool)
+    anchors[indices_points] = True
 
-    # Find the HMMF values for the neighbors of each vertex:
+    # Padded neighbor matrix (one column per index), with padded
+    # neighborhood elements pointing to the extra HMMF value:
     N = neighbor_lists
     N_sizes = np.array([len(x) for x in N])
     max_num_neighbors = max(N_sizes[indices])
-    N_array = np.zeros((max_num_neighbors, len(L)))
-    for index in indices:
-        N_array[0:N_sizes[index], index] = N[index]
-    N_array_shape = np.shape(N_array)
-    N_flat = np.ravel(N_array)
-    N_flat_list = N_flat.tolist()
-    H_N = np.reshape(H[[np.int(x) for x in N_flat_list]], N_array_shape)
-    ind_flat = [i for i,x in enumerate(N_flat_list) if x > 0]
-    len_flat = len(N_flat_list)
-
-    # A zero in N calls H[0], so remove zero-padded neighborhood elements:
-    Z = np.zeros((max_num_neighbors, len(L)))
-    for index in indices:
-        Z[0:N_sizes[index], index] = 1
+    N_array = npoints_mesh * np.ones((max_num_neighbors, len(indices)),
+                                     dtype=np.int32)
+    Z = np.zeros((max_num_neighbors, len(indices)))
+    for i, index in enumerate(indices):
+        N_array[0:N_sizes[index], i] = N[index]
+        Z[0:N_sizes[index], i] = 1
 
     # Assign cost values to each vertex (for indices):
-    C = np.zeros(len(L))
-    C[indices] = compute_costs(L[indices], H[indices], H_N[:,indices],
-                               N_sizes[indices], wN_max, Z[:,indices])
+    C = np.zeros(npoints_mesh)
+    C[indices] = compute_costs(L[indices], H[indices], H[N_array],
+                               N_sizes[indices], wN_max, Z)
     npoints = len(indices)
 
     # Loop until count reaches max_count or until end_flag equals zero
@@ -502,48 +535,62 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
     while end_flag < n_tries_no_change and count < max_count:
 
         # Select indices with a positive HMMF value:
-        V = [indices[i] for i,x in enumerate(H[indices]) if x > 0.0]
+        IV = np.where(H[indices] > 0.0)[0]
+        V = indices[IV]
 
         # Update neighborhood H values:
-        #H_N = np.reshape(H[N_flat_list], N_array_shape)
-        H_N = np.zeros(len_flat)
-        H_N[ind_flat] = H[[np.int(x) for x in N_flat[ind_flat]]]
-        H_N = np.reshape(H_N, N_array_shape)
+        H_N = H[N_array[:, IV]]
 
         # Compute the cost gradient for the HMMF values:
         H_decr = H - H_step
         H_decr[H_decr < 0] = 0.0
-        C_decr = compute_costs(L[V], H_decr[V], H_N[:,V], N_sizes[V], wN, Z[:,V])
+        C_decr = compute_costs(L[V], H_decr[V], H_N, N_sizes[V], wN, Z[:, IV])
         H_tests[V] = H[V] - gradient_factor * (C[V] - C_decr)
         H_tests[H_tests < 0] = 0.0
         H_tests[H_tests > 1] = 1.0
 
-        # For each index:
-        for index in V:
-
-            # Do not update anchor point costs:
-            if index not in indices_points:
-
-                # Update a vertex HMMF value if it is away from the threshold:
-                update = True
-                # Or if it crosses the threshold and is a topologically
-                # "simple point" (0.5 not considered part of the fundus):
-                if H[index] > 0.5 >= H_tests[index]:
-                    update, n_in = topo_test(index, H_new, N)
-                elif H[index] <= 0.5 < H_tests[index]:
-                    update, n_in = topo_test(index, 1 - H_new, N)
+        # Do not update anchor point costs.
+        # Update HMMF values that do not cross the threshold:
+        free = ~anchors[V]
+        down = free & (H[V] > 0.5) & (H_tests[V] <= 0.5)
+        up = free & (H[V] <= 0.5) & (H_tests[V] > 0.5)
+        stay = V[free & ~down & ~up]
+        H_new[stay] = H_tests[stay]
+
+        # Update HMMF values that cross the threshold if they are
+        # topologically "simple points" (0.5 not considered part of the
+        # fundus), in order, retesting a vertex if a previously updated
+        # vertex is within two edges of it (and could alter the test):
+        cross = V[down | up]
+        if cross.size:
+            is_down = down[down | up]
+            sps = np.zeros(cross.size, dtype=bool)
+            if np.any(is_down):
+                sps[is_down] = topo_tests(cross[is_down], H_new, N)[0]
+            if not np.all(is_down):
+                sps[~is_down] = topo_tests(cross[~is_down], 1 - H_new, N)[0]
+            near_update = np.zeros(npoints_mesh, dtype=bool)
+            for index, index_down, update in zip(cross, is_down, sps):
+                if near_update[index]:
+                    if index_down:
+                        update, n_in = topo_test(index, H_new, N)
+                    else:
+                        update, n_in = topo_test(index, 1 - H_new, N)
                 if update:
                     H_new[index] = H_tests[index]
+                    near_update[N[index]] = True
+                    for neighbor in N[index]:
+                        near_update[N[neighbor]] = True
 
         # Update the cost values:
-        C[V] = compute_costs(L[V], H_new[V], H_N[:,V], N_sizes[V], wN, Z[:,V])
+        C[V] = compute_costs(L[V], H_new[V], H_N, N_sizes[V], wN, Z[:, IV])
 
         # Sum the cost values across all vertices and tally the number
         # of HMMF values greater than the threshold.
         # After iteration 1, compare current and previous values.
         # If the values are similar, increment end_flag:
-        costs = sum(C[V].tolist())
-        npoints_thr = len([x for x in H[V].tolist() if x > 0.5])
+        costs = np.sum(C[V])
+        npoints_thr = np.sum(H[V] > 0.5)
 
         # Terminate the loop if there are insufficient changes:
         if count > 0:
@@ -576,6 +623,7 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
         H = H_new
 
         count += 1
+    H = H[:-1]
 
     if verbose:
         print('      Updated hidden Markov measure field (HMMF) values')
@@ -616,7 +664,8 @@ def connect_points_hmmf(indices_points, indices, L, neighbor_lists,
 
 def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
                      do_erode=True, save_file=False, output_file='',
-                     background_value=-1, verbose=False):
+                     background_value=-1, verbose=False, neighbor_lists=None,
+                     n_processes=1):
     """
     Smooth skeleton by dilation followed by connect_points_hmmf().
 
@@ -627,6 +676,11 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         4. Connect endpoints through dilated segment by connect_points_hmmf().
         5. Store smoothed output from #4.
 
+    Skeleton segments are independent of one another, so with
+    n_processes > 1 steps 2-4 are distributed (largest segment first)
+    to forked worker processes that share the read-only neighbor lists
+    and likelihoods of the parent process.
+
     Parameters
     ----------
     skeletons : list of integers
@@ -635,6 +689,7 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         region number for each vertex; constrains smoothed skeletons
     vtk_file : string
         file from which to extract neighboring vertices for each vertex
+        (if neighbor_lists not given), and to save output (if save_file)
     likelihoods : list of integers
         fundus likelihood value for each vertex
     wN_max : float
@@ -649,6 +704,12 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         background value
     verbose : bool
         print statements?
+    neighbor_lists : list of lists of integers (or None)
+        indices to neighboring vertices for each vertex
+        (None: find neighbors from vtk_file)
+    n_processes : integer
+        number of worker processes to smooth skeleton segments in parallel
+        (1: smooth one segment at a time)
 
     Returns
     -------
@@ -717,21 +778,25 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
     import os
     import numpy as np
     from time import time
+    from scipy.sparse.csgraph import connected_components
 
     from mindboggle.mio.vtks import rewrite_scalars
-    from mindboggle.guts.mesh import find_neighbors_from_file, find_endpoints
-    from mindboggle.guts.segment import segment_regions
-    from mindboggle.guts.mesh import dilate
-    from mindboggle.guts.paths import connect_points_hmmf
+    from mindboggle.guts.mesh import find_neighbors_from_file
+    from mindboggle.guts.mesh import neighbor_lists_to_csr
+    from mindboggle.guts.utilities import map_processes
+    from mindboggle.guts.paths import _smooth_skeleton_segment
 
     t0 = time()
 
-    neighbor_lists = find_neighbors_from_file(vtk_file)
-    indices = np.where(bounds != background_value)[0]
+    if neighbor_lists is None:
+        neighbor_lists = find_neighbors_from_file(vtk_file)
+    skeletons = np.asarray(skeletons)
+    bounds = np.asarray(bounds)
+    likelihoods = np.asarray(likelihoods)
     npoints = len(bounds)
 
     # ------------------------------------------------------------------------
-    # Loop through skeletons:
+    # Group skeleton vertices by ID in one pass:
     # ------------------------------------------------------------------------
     unique_IDs = [x for x in np.unique(skeletons) if x != background_value]
     n_skeletons = len(unique_IDs)
@@ -741,69 +806,48 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
         sdum = 's'
     if verbose:
         print("Smooth {0} skeleton{1}...".format(n_skeletons, sdum))
-    Z = background_value * np.ones(npoints)
-    smoothed_skeletons = Z.copy()
-    for ID in unique_IDs:
-        skeleton = [i for i,x in enumerate(skeletons) if x == ID]
-        if verbose:
-            print('  Skeleton {0}:'.format(int(ID)))
 
-        # --------------------------------------------------------------------
-        # Segment skeleton vertices into separate connected groups:
-        # --------------------------------------------------------------------
-        skel_segs = segment_regions(skeleton, neighbor_lists, 1, [], False,
-                                    False, [], [], [], '', background_value,
-                                    verbose)
-
-        skel_seg_numbers = [x for x in np.unique(skel_segs)
-                            if x != background_value]
-        len_numbers = len(skel_seg_numbers)
-        if verbose and len_numbers > 1:
-            print('    {0} segments'.format(len_numbers))
-        for skel_seg_number in skel_seg_numbers:
-            skel_seg = np.where(skel_segs == skel_seg_number)[0].tolist()
+    # ------------------------------------------------------------------------
+    # Segment skeleton vertices into separate connected groups
+    # (connected components of edges between vertices of the same skeleton):
+    # ------------------------------------------------------------------------
+    Iskel = np.where(skeletons != background_value)[0]
+    graph = neighbor_lists_to_csr(neighbor_lists, Iskel).tocoo()
+    same = skeletons[graph.row] == skeletons[graph.col]
+    graph.data[~same] = 0
+    graph.eliminate_zeros()
+    ncomponents, components = connected_components(graph, directed=False)
+    Iskel = Iskel[np.lexsort((components[Iskel], skeletons[Iskel]))]
+    keys = np.vstack((skeletons[Iskel], components[Iskel]))
+    starts = np.where(np.any(keys[:, 1:] != keys[:, :-1], axis=0))[0] + 1
+    skel_segs = [x.tolist() for x in np.split(Iskel, starts)] \
+        if Iskel.size else []
+    segment_IDs = [skeletons[x[0]] for x in skel_segs]
 
-            # ----------------------------------------------------------------
-            # Find endpoints:
-            # ----------------------------------------------------------------
-            endpoints = find_endpoints(skel_seg, neighbor_lists)
-    
-            # ----------------------------------------------------------------
-            # Dilate the skeleton within the bounds:
-            # ----------------------------------------------------------------
-            nedges = 2
-            if verbose:
-                print('    Dilate skeleton within bounds...')
-            dilated = dilate(skel_seg, nedges, neighbor_lists)
-            dilated = list(set(dilated).intersection(indices))
-            if dilated:
-    
-                # ------------------------------------------------------------
-                # Set undilated likelihoods to background to keep neighbors:
-                # ------------------------------------------------------------
-                L = Z.copy()
-                L[dilated] = likelihoods[dilated]
-    
-                # ------------------------------------------------------------
-                # Smoothly re-skeletonize the dilated skeleton:
-                # ------------------------------------------------------------
-                if verbose:
-                    print('    Smoothly re-skeletonize dilated skeleton...')
-                new_skeleton = connect_points_hmmf(endpoints, dilated, L,
-                    neighbor_lists, wN_max, do_erode, background_value,
-                    verbose)
-
-                ## Plot overlap of dilated and pre-/post-smoothed skeleton:
-                #from mindboggle.mio.plots import plot_surfaces
-                #D = background_value * np.ones(npoints)
-                #D[dilated]=1; D[skel_seg]=2; D[new_skeleton]=3
-                #rewrite_scalars(vtk_file, 'test.vtk', D, 'D', bounds)
-                #plot_surfaces('test.vtk')
-    
-                # ------------------------------------------------------------
-                # Store skeleton:
-                # ------------------------------------------------------------
-                smoothed_skeletons[new_skeleton] = ID
+    # ------------------------------------------------------------------------
+    # Smooth each skeleton segment (largest first, if in parallel):
+    # ------------------------------------------------------------------------
+    shared = dict(neighbor_lists=neighbor_lists, likelihoods=likelihoods,
+                  in_bounds=bounds != background_value, wN_max=wN_max,
+                  do_erode=do_erode, background_value=background_value,
+                  verbose=verbose)
+    new_skeletons = [[] for x in skel_segs]
+    if n_processes > 1:
+        order = np.argsort([-len(x) for x in skel_segs], kind='stable')
+    else:
+        order = np.arange(len(skel_segs))
+    tasks = [(segment_IDs[iseg], skel_segs[iseg]) for iseg in order]
+    for itask, new_skeleton in map_processes(_smooth_skeleton_segment, tasks,
+                                             shared, n_processes):
+        new_skeletons[order[itask]] = new_skeleton
+
+    # ------------------------------------------------------------------------
+    # Store skeletons (in order of skeleton IDs):
+    # ------------------------------------------------------------------------
+    smoothed_skeletons = background_value * np.ones(npoints)
+    for ID, new_skeleton in zip(segment_IDs, new_skeletons):
+        if len(new_skeleton):
+            smoothed_skeletons[new_skeleton] = ID
     if verbose:
         print('  ...Smoothed {0} skeleton{1} ({2:.2f} seconds)'.
               format(n_skeletons, sdum, time() - t0))
@@ -818,14 +862,64 @@ def smooth_skeletons(skeletons, bounds, vtk_file, likelihoods, wN_max=1.0,
             skeletons_file = output_file
         else:
             skeletons_file = os.path.join(os.getcwd(), 'smooth_skeletons.vtk')
-            rewrite_scalars(vtk_file, skeletons_file, smoothed_skeletons,
-                            'smoothed_skeletons', [], background_value)
+        rewrite_scalars(vtk_file, skeletons_file, smoothed_skeletons,
+                        'smoothed_skeletons', [], background_value)
     else:
         skeletons_file = None
 
     return smoothed_skeletons, n_skeletons, skeletons_file
 
 
+def _smooth_skeleton_segment(segment_ID, skel_seg, neighbor_lists,
+                             likelihoods, in_bounds, wN_max, do_erode,
+                             background_value, verbose):
+    """
+    Smoothly re-skeletonize one dilated skeleton segment.
+
+    See smooth_skeletons() for a description of the parameters.
+
+    """
+    import numpy as np
+
+    from mindboggle.guts.mesh import find_endpoints, dilate
+    from mindboggle.guts.paths import connect_points_hmmf
+
+    if verbose:
+        print('  Skeleton {0} segment:'.format(int(segment_ID)))
+
+    # ------------------------------------------------------------------------
+    # Find endpoints:
+    # ------------------------------------------------------------------------
+    endpoints = find_endpoints(skel_seg, neighbor_lists)
+
+    # ------------------------------------------------------------------------
+    # Dilate the skeleton within the bounds:
+    # ------------------------------------------------------------------------
+    nedges = 2
+    if verbose:
+        print('    Dilate skeleton within bounds...')
+    dilated = np.unique(dilate(skel_seg, nedges, neighbor_lists))
+    dilated = dilated[in_bounds[dilated]].tolist()
+    new_skeleton = []
+    if dilated:
+
+        # --------------------------------------------------------------------
+        # Set undilated likelihoods to background to keep neighbors:
+        # --------------------------------------------------------------------
+        L = background_value * np.ones(len(likelihoods))
+        L[dilated] = likelihoods[dilated]
+
+        # --------------------------------------------------------------------
+        # Smoothly re-skeletonize the dilated skeleton:
+        # --------------------------------------------------------------------
+        if verbose:
+            print('    Smoothly re-skeletonize dilated skeleton...')
+        new_skeleton = connect_points_hmmf(endpoints, dilated, L,
+            neighbor_lists, wN_max, do_erode, background_value, verbose)
+
+    return new_skeleton
+
+
 def track_segments(seed, segments, neighbor_lists, values, sink,
                    background_value=-1):
     """
@@ -839,8 +933,9 @@ def track_segments(seed, segments, neighbor_lists, values, sink,
     ----------
     seed : integer
         index to initial seed vertex from which to grow a track
-    segments : list of lists of integers
-        indices to vertices for each concentric segment
+    segments : list of lists of integers, or numpy array of integers
+        indices to vertices for each concentric segment,
+        or segment number for all vertices (background_value elsewhere)
     neighbor_lists : list of lists of integers
         indices to neighboring vertices for each vertex
     values : numpy array of floats
@@ -912,18 +1007,30 @@ def track_segments(seed, segments, neighbor_lists, values, sink,
     """
     import numpy as np
 
-    if not sink:
+    if not len(sink):
         import sys
         sys.exit('Missing sink vertices.')
+    sink = set(sink)
+
+    # Segment number for each vertex (one pass through the segments):
+    if isinstance(segments, np.ndarray):
+        rings = segments
+    else:
+        rings = background_value * np.ones(len(neighbor_lists), dtype=int)
+        for isegment, segment in enumerate(segments):
+            rings[segment] = isegment
+    if np.any(rings != background_value):
+        nsegments = int(np.max(rings[rings != background_value])) + 1
+    else:
+        nsegments = 0
 
     track = [seed]
-    for isegment, segment in enumerate(segments):
+    for isegment in range(nsegments):
 
         # Find the seed's neighborhood N in the segment:
         N = neighbor_lists[seed]
         N = [x for x in N if values[x] != background_value]
-        segment_set = set(segment)
-        N_segment = list(segment_set.intersection(frozenset(N)))
+        N_segment = [x for x in N if rings[x] == isegment]
         if N:
 
             # Add the neighborhood vertex with the maximum value to the track:
@@ -932,7 +1039,6 @@ def track_segments(seed, segments, neighbor_lists, values, sink,
                 track.append(seed)
 
                 # If the track has run into the region's border, return the track:
-                #if list(set(N_segment).intersection(sink)):
                 if seed in sink:
                     return track
 
@@ -941,9 +1047,10 @@ def track_segments(seed, segments, neighbor_lists, values, sink,
             elif isegment > 0:
                 bridge = []
                 max_bridge = 0
-                N_previous = list(set(N).intersection(segments[isegment-1]))
+                N_previous = [x for x in N if rings[x] == isegment - 1]
                 for Np in N_previous:
-                    N_next = list(segment_set.intersection(neighbor_lists[Np]))
+                    N_next = [x for x in neighbor_lists[Np]
+                              if rings[x] == isegment]
                     if N_next:
                         if np.max(values[N_next]) > max_bridge:
                             seed = N_next[np.argmax(values[N_next])]
@@ -1052,9 +1159,8 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     import numpy as np
 
     from mindboggle.guts.segment import extract_borders
-    from mindboggle.guts.segment import segment_rings
     from mindboggle.guts.paths import track_segments
-    from mindboggle.guts.mesh import find_neighborhood
+    from mindboggle.guts.mesh import find_neighborhoods, find_hop_distances
 
     # ------------------------------------------------------------------------
     # Settings:
@@ -1065,7 +1171,7 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     do_filter_tracks = True
 
     # Initialize R, T, S, V:
-    R = indices[:]
+    indices = np.asarray(indices, dtype=int)
     T = []
     S = np.array(values_seeding)
     V = np.array(values)
@@ -1083,9 +1189,8 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     # ------------------------------------------------------------------------
     if do_threshold:
         thresholdS = np.median(S[indices]) #+ np.std(S[indices])
-        indices_high = [x for x in indices if S[x] >= thresholdS]
         # Make sure threshold is within the maximum values of the boundary:
-        if list(frozenset(indices_high).intersection(borders)):
+        if np.any(S[np.intersect1d(borders, indices)] >= thresholdS):
             do_threshold = False
         else:
             if verbose:
@@ -1101,7 +1206,7 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
                 format(1-remove_fraction))
 
     # Extract threshold boundary vertices as seeds:
-    indices_high = [x for x in indices if S[x] >= thresholdS]
+    indices_high = indices[S[indices] >= thresholdS]
     B = np.ones(len(S))
     B[indices_high] = 2
     seeds, foo1, foo2 = extract_borders(list(range(len(S))), B,
@@ -1110,14 +1215,21 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
     # ------------------------------------------------------------------------
     # Segment the mesh from the seeds iteratively toward the boundary:
     # ------------------------------------------------------------------------
-    R = list(frozenset(R).difference(indices_high))
-    R = list(frozenset(R).difference(seeds))
-    segments = segment_rings(R, seeds, neighbor_lists, 1, background_value)
+    in_R = np.zeros(len(S), dtype=bool)
+    in_R[indices] = True
+    in_R[indices_high] = False
+    in_R[seeds] = False
+    R = np.where(in_R)[0]
+    hops = find_hop_distances(seeds, neighbor_lists, R, background_value=-1)
+    segments = hops - 1
+    segments[hops < 1] = background_value
+    nsegments = np.max(hops) if len(seeds) else 0
 
     # Run tracks from the seeds through the segments toward the boundary:
     if verbose:
         print('    Track through {0} concentric segments ({1} vertices) '
-            'from threshold {2:0.2f}'.format(len(segments), len(R), thresholdS))
+            'from threshold {2:0.2f}'.format(nsegments, len(R), thresholdS))
+    borders = set(borders)
     for seed in seeds:
         track = track_segments(seed, segments, neighbor_lists, V, borders,
                                background_value)
@@ -1137,49 +1249,44 @@ def find_outer_endpoints(indices, neighbor_lists, values, values_seeding,
             print('    Filter {0} tracks'.format(len(T)))
 
         # Compute median track values:
-        Tvalues = [np.median(V[x]) for x in T]
+        Tvalues = np.array([np.median(V[x]) for x in T])
 
         # Keep tracks with a high median track value:
         #background = np.median(V[indices])
         #background = np.median(Tvalues) + np.std(Tvalues)
         background = np.median(V[R]) + np.std(V[R])
-        Ihigh = [i for i,x in enumerate(T) if Tvalues[i] > background]
+        Ihigh = np.where(Tvalues > background)[0]
         T = [T[i] for i in Ihigh]
-        Tvalues = [Tvalues[i] for i in Ihigh]
+        Tvalues = Tvalues[Ihigh]
 
-        # Gather endpoint vertex indices:
-        E = [x[-1] for x in T]
+        # Gather endpoint vertex indices, and find the endpoints
+        # within min_separation edges of each (unique) endpoint:
+        E = np.array([x[-1] for x in T], dtype=int)
+        unique_E, IE = np.unique(E, return_inverse=True)
+        near = find_neighborhoods(neighbor_lists, unique_E, min_separation)
+        near = near[:, unique_E].toarray()
 
-        # Loop through endpoints:
+        # Loop through endpoints, clustering each remaining endpoint
+        # with remaining endpoints close to it:
         E2 = []
         T2 = []
-        while E:
-
-            # Find endpoints close to the first endpoint:
-            near = find_neighborhood(neighbor_lists, [E[0]], min_separation)
-            Isame = [i for i,x in enumerate(E) if x == E[0]]
-            Inear = [i for i,x in enumerate(E) if x in near]
-            if Inear or len(Isame) > 1:
-                Inear.extend(Isame)
-
-                # Select endpoint with the maximum median track value:
-                Imax = Inear[np.argmax([Tvalues[i] for i in Inear])]
-                E2.append(E[Imax])
-                T2.append(T[Imax])
-
-                # Keep data for points that are not nearby for the next loop:
-                Ikeep = [i for i in range(len(E)) if i not in Inear]
-                E = [E[i] for i in Ikeep]
-                T = [T[i] for i in Ikeep]
-                Tvalues = [Tvalues[i] for i in Ikeep]
-
-            # If nothing nearby, simply keep the endpoint:
-            else:
-                E2.append(E[0])
-                T2.append(T[0])
-                del(E[0])
-                del(T[0])
-                del(Tvalues[0])
+        remaining = np.ones(len(E), dtype=bool)
+        while np.any(remaining):
+            i0 = np.argmax(remaining)
+
+            # Find endpoints close to (or the same as) the first endpoint:
+            Inear = np.where(remaining & near[IE[i0], IE])[0]
+            Isame = np.where(remaining & (IE == IE[i0]))[0]
+            Icluster = np.concatenate((Inear, Isame))
+
+            # Select endpoint with the maximum median track value
+            # (simply keep the endpoint if nothing is nearby):
+            Imax = Icluster[np.argmax(Tvalues[Icluster])]
+            E2.append(int(E[Imax]))
+            T2.append(T[Imax])
+
+            # Keep data for points that are not nearby for the next loop:
+            remaining[Icluster] = False
 
         endpoints = E2
         endtracks = T2
@@ -1211,7 +1318,8 @@ def find_max_values(points, values, min_separation=10, thr=0.5):
            remove this value, and loop through the remaining high values.
 
         3. If there are no nearby special points,
-           assign the maximum value vertex as a special point.
+           assign the maximum value vertex as a special point
+           (and suppress high values near to it, found with a k-d tree).
 
     Parameters
     ----------
@@ -1264,52 +1372,41 @@ def find_max_values(points, values, min_separation=10, thr=0.5):
 
     """
     import numpy as np
-    from operator import itemgetter
+    from scipy.spatial import cKDTree
 
     # Make sure arguments are numpy arrays:
     if not isinstance(points, np.ndarray):
         points = np.array(points)
+    values = np.asarray(values)
 
-    # Sort values and find indices for values above the threshold:
-    L_table = [[i,x] for i,x in enumerate(values)]
-    L_table_sort = np.transpose(sorted(L_table, key=itemgetter(1)))[:, ::-1]
-    IL = [int(L_table_sort[0,i]) for i,x in enumerate(L_table_sort[1,:])
-          if x > thr]
+    # Sort values (highest first, ties broken by highest index)
+    # and find indices for values above the threshold:
+    IL = np.argsort(values, kind='stable')[::-1]
+    IL = IL[values[IL] > thr]
 
     # Initialize special points list with the index of the maximum value,
-    # remove this value, and loop through the remaining high values:
-    if IL:
-        highest = [IL.pop(0)]
-        for imax in IL:
-
-            # Determine if there are any special points
-            # near to the current maximum value vertex:
-            i = 0
-            found = 0
-            while i < len(highest) and found == 0:
-
-                # Compute Euclidean distance between points:
-                D = np.linalg.norm(points[highest[i]] - points[imax])
-
-                # If distance less than threshold, consider the point found:
-                if D < min_separation:
-                    found = 1
-                ## Compute directional distance between points if close:
-                #elif D < max_distance:
-                #    dirV = np.dot(points[indices_special[i]] - points[imax],
-                #               min_directions[highest[i]])
-                #    # If distance less than threshold, consider point found:
-                #    if np.linalg.norm(dirV) < min_separation:
-                #        found = 1
-
-                i += 1
+    # and loop through the remaining high values, suppressing those
+    # near to each new special point (found with a k-d tree):
+    highest = []
+    if IL.size:
+        IL_points = points[IL]
+        tree = cKDTree(IL_points)
+        suppressed = np.zeros(IL.size, dtype=bool)
+        for i, imax in enumerate(IL):
 
             # If there are no nearby special points,
             # assign the maximum value vertex as a special point:
-            if not found:
-                highest.append(imax)
-    else:
-        highest = []
+            if not suppressed[i]:
+                highest.append(int(imax))
+
+                # Suppress points closer than min_separation
+                # (Euclidean distance between points):
+                near = np.array(tree.query_ball_point(IL_points[i],
+                                                      min_separation),
+                                dtype=int)
+                near = near[near > i]
+                D = np.linalg.norm(IL_points[near] - IL_points[i], axis=1)
+                suppressed[near[D < min_separation]] = True
 
     return highest
 
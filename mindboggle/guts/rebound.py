@@ -17,9 +17,11 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 import os
 import numpy as np
 from time import time
-from scipy.sparse import csr_matrix, lil_matrix
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import cdist
 
 from mindboggle.mio.vtks import write_vtk
+from mindboggle.guts.cache import cache_key, load_cached, save_cached
 import mindboggle.guts.graph as go
 import mindboggle.guts.kernels as kernels
 
@@ -142,24 +144,26 @@ class Bounds:
 
         """
 
+        seed_labels = np.asarray(self.seed_labels)
+
         # Get the unique (sorted) set of labels
-        self.unique_labels = np.sort(np.asarray(list(set(self.seed_labels))))
+        self.unique_labels = np.unique(seed_labels)
 
         # Number of labels and vertices
-        self.unique_labels = [x for x in self.unique_labels if x >= self.min_label]
+        self.unique_labels = self.unique_labels[self.unique_labels >=
+                                                self.min_label]
         C = len(self.unique_labels)
         n = len(self.Labels)
 
         # Construct n x C matrix
         self.label_matrix = np.zeros((n, C))
 
-        # Populate the label assignment matrix with -1s and 1s for seed labels
-        # For each row...
-        for i in range(n):
-            if self.seed_labels[i] >= self.min_label:
-                self.label_matrix[i, :] = -1
-                unique_label_index = np.where(self.unique_labels == self.seed_labels[i])[0]
-                self.label_matrix[i, unique_label_index] = 1
+        # Populate the label assignment matrix with -1s and 1s for seed labels:
+        # rows of seed vertices get -1s, and a 1 in the column of their label
+        seeds = np.flatnonzero(seed_labels >= self.min_label)
+        columns = np.searchsorted(self.unique_labels, seed_labels[seeds])
+        self.label_matrix[seeds, :] = -1
+        self.label_matrix[seeds, columns] = 1
 
         self.num_labels = C
 
@@ -248,13 +252,10 @@ class Bounds:
                 print('First call graph_based_learning().')
             return
 
-        # Define an array called max_prob_label to store the final values
-        self.max_prob_labels = np.zeros(self.num_points)
-
         # Use the array of unique, sorted labels to convert this matrix
         # back to the original labeling; max_col[i] is the temporary label number
-        for i in range(self.num_points):
-            self.max_prob_labels[i] = self.unique_labels[max_col[i]]
+        self.max_prob_labels = np.asarray(self.unique_labels,
+                                          dtype=float)[max_col]
 
         return self.max_prob_labels
 
@@ -345,110 +346,83 @@ class Bounds:
         """ We will later change the -1s to 0s.
         As vertices get labeled, we assign a confidence measure to the labeling
         and store the value in this matrix.
-        Now, let us go column by column, and run the weighted averaging algorithm.
-        For each column, you're studying one label. Therefore, when updating
-        self.learned_matrix, you'll be working with one column at a time too.
+        Now, let us run the weighted averaging algorithm on all columns at
+        once. Each column still studies one label independently of the others,
+        but because every column is updated by the same transition matrix,
+        P = D^-1 W, we compute P once and update the whole n x C matrix with
+        a single sparse-dense product per iteration. A column that has
+        converged is frozen, so each label stops after the same number of
+        iterations as it would on its own.
         If a label gets vertex, keep the fractional value, do not simply round
         to 1 to assign membership."""
 
-        i = 0 # record of label number
-        for column in self.learned_matrix.T:
+        t0 = time()
+        self.learned_matrix = np.asarray(self.learned_matrix, dtype=float)
+        npoints, C = self.learned_matrix.shape
+        P = csr_matrix(self.DDM * self.affinity_matrix)
 
-            t0 = time()
-            if verbose:
+        # Set up indices and values to be clamped during propagation
+        if not realign:
+            restore_indices = self.seed_labels >= self.min_label
+        else:
+            restore_indices = np.hstack((self.label_boundary,
+                                         self.polyline_elements)).astype(int)
+        restore_values = self.learned_matrix[restore_indices, :]
+
+        if verbose:
+            nmembers = np.sum(self.learned_matrix == 1, axis=0)
+            for i in range(C):
                 print('Number of initial members for label {0}: {1}'.format(
-                    i, np.nonzero(column==1)[0].size))
+                    i, nmembers[i]))
 
-            # Set up indices and values to be clamped during propagation
-            if not realign:
-                restore_indices = self.seed_labels >= self.min_label
-                restore_values = column[restore_indices]
-            else:
-                restore_indices = np.hstack((self.label_boundary,self.polyline_elements))
-                restore_values = column[restore_indices]
-
-            Y_hat_now = csr_matrix(column).transpose()
-            converged = False
-            counter = 0
-            while not converged and counter < max_iters:
-                """ The option will exist to visualize the proceedings of the algorithm.
-                The results of a number of the iterations will be sent to vtk
-                files which can then be visualized.
-                For the visualization, we will construct two types of vtk files.
-                The first will be the actual (manual) labels, as found in
-                self.Labels, with the label of interest highlighted (=1),
-                and the others blanked out (=-1).
-                The other vtk files will be the result of the algorithm."""
-                if vis and not realign:
-                    """First, we'll find out which label we're working with,
-                    by calling label_mapping. We'll then send that label to the
-                    method highlight() which will do the actual work of
-                    creating the vtk."""
+        Y_hat_now = self.learned_matrix
+        active = np.ones(C, dtype=bool)
+        counters = np.zeros(C, dtype=int)
+        counter = 0
+        while active.any() and counter < max_iters:
+            """ The option will exist to visualize the proceedings of the algorithm.
+            The results of a number of the iterations will be sent to vtk
+            files which can then be visualized.
+            For the visualization, we will construct two types of vtk files.
+            The first will be the actual (manual) labels, as found in
+            self.Labels, with the label of interest highlighted (=1),
+            and the others blanked out (=-1).
+            The other vtk files will be the result of the algorithm,
+            one per label, written every 1000 iterations."""
+            if vis and not realign and not np.mod(counter, 1000):
+                for i in np.flatnonzero(active):
                     label = self.unique_labels[i]
-
                     if not counter: # No need to do this more than once :-)
                         self.highlight(label)
-
-                    """ Next, we'll construct vtk files, assuming that the
-                    iteration step is one we care about.
-                    For our purposes, let's see the early iterations in high
-                    density, once low density in the middle,
-                    and the last iteration before convergence or max_iters.
-                    So, the numbers of interest will be when counter is between
-                    0 and 10, and at 100.
-                    We'll also see max_iters/2, and max_iters (or convergence).
-                    """
-                    # Actually, just see if counter is a multiple of a number of interest.
-                    # set_of_interest = np.array([0,101,202,max_iters-2,max_iters-1])
-
-                    """ Let's define a file for output.
-                    We have the vertices and faces, and we have the labels
-                    which are found in column.todense().flatten()."""
-
                     filename = str(label)+'_'+str(counter)+'.vtk'
+                    LABELS = np.zeros(self.num_points)
+                    LABELS[:] = Y_hat_now[:, i]
+                    write_vtk(filename, self.Points, self.Vertices,
+                              [], self.Faces, [LABELS], scalar_type='int')
+
+            # Update only columns that have not yet converged
+            icols = np.flatnonzero(active)
+            Y_hat_next = P.dot(Y_hat_now[:, icols])
+            # reset
+            Y_hat_next[restore_indices, :] = restore_values[:, icols]
+            # check convergence per column
+            changes = np.sum(np.abs(Y_hat_now[:, icols] - Y_hat_next), axis=0)
+            Y_hat_now[:, icols] = Y_hat_next
+            counters[icols] += 1
+            active[icols[changes < tol]] = False
+            counter += 1
 
-                    if not np.mod(counter,1000):
-                        LABELS = np.zeros(self.num_points)
-                        LABELS[:] = Y_hat_now.todense().T.flatten()
-                        write_vtk(filename, self.Points, self.Vertices,
-                                  [], self.Faces, [LABELS], scalar_type='int')
-
-                # column matrix
-                Y_hat_next = (self.DDM * self.affinity_matrix * Y_hat_now).todense()
-                # reset
-                Y_hat_next[restore_indices, 0] = restore_values
-                # check convergence
-                converged = (np.sum(np.abs(Y_hat_now.todense() - Y_hat_next)) < tol)
-                # if verbose:
-                # print('Iteration number {0}, convergence = {1}'.
-                # format(counter,np.sum(np.abs(column.todense() - tmp)))
-                Y_hat_now = csr_matrix(Y_hat_next)
-                counter += 1
-
-            # Print out the number of iterations, so that we get a sense for future runs.
-            # It is also an indication of whether the algorithm converged.
+        # Print out the number of iterations, so that we get a sense for future runs.
+        # It is also an indication of whether the algorithm converged.
+        if verbose:
+            if active.any():
+                print('Done in {0:.2f} seconds ({1} of {2} labels did not '
+                      'converge)'.format(time()-t0, np.sum(active), C))
+            else:
+                print('Done in {0:.2f} seconds ({1} iterations)'.
+                      format(time()-t0, counter))
 
-            if verbose:
-                if counter == max_iters:
-                    print('Done in {0:.2f} seconds (the algorithm did not '
-                          'converge)'.format(time()-t0))
-                else:
-                    print('Done in {0:.2f} seconds ({1} iterations)'.
-                        format(time()-t0, counter))
-
-            self.learned_matrix[:,i] = Y_hat_now.todense().flatten()
-
-            #if verbose:
-            #print('There were {0} initial seed vertices for this label'.
-            #format(self.count_assigned_members(i))
-            #print('The file actually had {0} vertices for this label'.
-            #format(self.count_real_members(self.label_mapping[i]))
-            #print('Using only those vertices which crossed the threshold,
-            # there are now: '.format(self.count_real_members(i))
-            #pylab.plot(self.learned_matrix[:,i])
-            #pylab.show()
-
-            i += 1
+        self.learned_matrix = Y_hat_now
 
         """ Before reporting the probabilistic assignment, we change all -1's,
         which indicates 0 probability that the vertex has that label.
@@ -499,26 +473,19 @@ class Bounds:
         else:
             self.Rlabel_boundary = np.zeros(self.num_points)
 
-        # Loop through triangles
-        for triangle in self.Faces:
-            v0, v1, v2 = triangle[0], triangle[1], triangle[2]
-            # If they are not all the same...
-            if not realigned_labels:
-                same_labels = [self.Labels[v1]==self.Labels[v2],
-                               self.Labels[v0]==self.Labels[v2],
-                               self.Labels[v0]==self.Labels[v1]]
-            else:
-                same_labels = [self.RLabels[v1]==self.RLabels[v2],
-                               self.RLabels[v0]==self.RLabels[v2],
-                               self.RLabels[v0]==self.RLabels[v1]]
-
-            # Did it this way for option to modify it later. Perhaps reconsider 'not all' statement.
-            if not all(same_labels):
-                # Then label those vertices as part of the boundary.
-                if not realigned_labels:
-                    self.label_boundary[triangle] = 1
-                else:
-                    self.Rlabel_boundary[triangle] = 1
+        # Find triangles whose vertices do not all have the same label
+        faces = np.asarray(self.Faces, dtype=int)
+        if not realigned_labels:
+            face_labels = np.asarray(self.Labels)[faces]
+        else:
+            face_labels = np.asarray(self.RLabels)[faces]
+        mixed = np.any(face_labels != face_labels[:, [0]], axis=1)
+
+        # Then label those vertices as part of the boundary.
+        if not realigned_labels:
+            self.label_boundary[faces[mixed].ravel()] = 1
+        else:
+            self.Rlabel_boundary[faces[mixed].ravel()] = 1
 
         # We can now output a file to show the boundary.
         if not realigned_labels:
@@ -545,7 +512,84 @@ class Bounds:
         else:
             return self.Rlabel_boundary, self.Rlabel_boundary_file
 
-    def find_label_boundary_per_label(self):
+    def find_label_boundary_index(self, cache_directory='', verbose=False):
+        """
+        Index label boundary vertices and segments by (unordered) label pair.
+
+        The index is computed in one pass over the mesh edges: every edge
+        whose endpoints have different labels contributes each endpoint to
+        the segment of its own label facing the other label.
+        If cache_directory is given, indices are cached on disk by a hash of
+        the faces and labels (see mindboggle.guts.cache), so the same
+        surface and labels are only indexed once.
+
+        Parameters
+        ----------
+        cache_directory: string (directory for cached indices; '' for none)
+
+        Returns
+        -------
+        self.label_boundary_index: dict
+            key:  2-tuple of labels (a, b) with a < b
+            value:  2-tuple of arrays of vertices labeled a adjacent to b,
+                    and of vertices labeled b adjacent to a
+        self.label_boundary: numpy array (of indices of vertices which comprise the label boundary)
+
+        """
+        faces = np.asarray(self.Faces, dtype=int)
+        labels = np.asarray(self.Labels)
+
+        # Content-addressed key for the index
+        found = False
+        if cache_directory:
+            key = cache_key([faces, labels], {'index': 'label_boundary'})
+            found, index = load_cached(key, cache_directory)
+        if found:
+            vertices, own, other = index
+            if verbose:
+                print('Label boundary index loaded from {0}'.
+                      format(cache_directory))
+        else:
+            # Directed edges between vertices with different labels
+            edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+            edges = np.vstack((edges, edges[:, ::-1]))
+            edges = edges[labels[edges[:, 0]] != labels[edges[:, 1]]]
+
+            # Unique (own label, other label, vertex) records, sorted
+            unique_labels, codes = np.unique(labels, return_inverse=True)
+            nlabels = unique_labels.size
+            records = np.unique((codes[edges[:, 0]].astype(np.int64) *
+                                 nlabels + codes[edges[:, 1]]) *
+                                labels.size + edges[:, 0])
+            vertices = records % labels.size
+            pairs = records // labels.size
+            own = unique_labels[pairs // nlabels]
+            other = unique_labels[pairs % nlabels]
+
+            if cache_directory:
+                save_cached(key, (vertices, own, other), cache_directory)
+                if verbose:
+                    print('Label boundary index saved to {0}'.
+                          format(cache_directory))
+
+        # Split the records into segments, one per ordered label pair
+        self.label_boundary_index = {}
+        if vertices.size:
+            starts = np.flatnonzero(np.hstack((True,
+                (own[1:] != own[:-1]) | (other[1:] != other[:-1]))))
+            for segment, a, b in zip(np.split(vertices, starts[1:]),
+                                     own[starts].tolist(),
+                                     other[starts].tolist()):
+                pair = (min(a, b), max(a, b))
+                sides = self.label_boundary_index.setdefault(pair, [None, None])
+                sides[int(a > b)] = segment
+        for pair, sides in list(self.label_boundary_index.items()):
+            self.label_boundary_index[pair] = tuple(sides)
+        self.label_boundary = np.unique(vertices).astype(int)
+
+        return self.label_boundary_index, self.label_boundary
+
+    def find_label_boundary_per_label(self, cache_directory=''):
         """
         Find label boundary for each label.
 
@@ -553,30 +597,26 @@ class Bounds:
 
         Parameters
         ----------
+        cache_directory: string (see find_label_boundary_index)
 
         Returns
         -------
         self.label_boundary_per_label: dict (key: int label, value: list of vertices)
 
         """
-
-        try:
-            self.label_boundary
-        except AttributeError:
-            self.find_label_boundary() # get the boundaries between all labels
+        self.find_label_boundary_index(cache_directory=cache_directory)
 
         self.label_boundary_per_label = {}
-        setA = set(self.label_boundary)
-
-        for Class in self.set_manual_labels:
-            setB = set(np.nonzero(self.Labels==Class)[0])
-            setC = setA.intersection(setB)
-
-            self.label_boundary_per_label[Class] = list(setC)
+        for (a, b), (side_a, side_b) in list(self.label_boundary_index.items()):
+            self.label_boundary_per_label.setdefault(a, []).append(side_a)
+            self.label_boundary_per_label.setdefault(b, []).append(side_b)
+        for Class, value in list(self.label_boundary_per_label.items()):
+            self.label_boundary_per_label[Class] = \
+                np.unique(np.hstack(value)).tolist()
 
         return self.label_boundary_per_label
 
-    def find_label_boundary_segments(self, verbose=False):
+    def find_label_boundary_segments(self, cache_directory='', verbose=False):
         """
         Break up the label boundaries into segments (corresponding to same-label pairs).
 
@@ -589,38 +629,23 @@ class Bounds:
         two thick, following from the (>=2 label neighborhood) definition,
         so we call these "label cosegments".
 
+        Parameters
+        ----------
+        cache_directory: string (see find_label_boundary_index)
+
         Returns
         -------
-        self.label_boundary_segments: dict (key: tuple of labels, value: set of vertices)
-        self.segment_file: string (pickled file containing the dictionary, for future, and faster, use)
+        self.label_boundary_segments: dict (key: tuple of labels, value: list of vertices)
         self.highlighted_segment_file: string (VTK file with boundary segments highlighted according to label)
 
         """
-        self.find_label_boundary_per_label()
+        self.find_label_boundary_index(cache_directory=cache_directory)
 
-        # Initialize dictionary for later ease of use;
-        # there's probably a simpler way to do the concatenation
+        # Each unordered label pair of the index holds both cosegments
         self.label_boundary_segments = {}
-        for a in self.set_manual_labels:
-            for b in self.set_manual_labels:
-                self.label_boundary_segments[(a,b)]=[]
-
-        # Populate the dictionary with vertices
-        for Class in self.set_manual_labels:
-            if verbose:
-                print(Class)
-            for vertex in self.label_boundary_per_label[Class]:
-                neighbors = self.neighbors(vertex)
-                A = set(self.Labels[neighbors])
-                B = set(list([self.Labels[vertex]]))
-                neighbor_labels = set.difference(A,B)
-                for c in neighbor_labels:
-                    self.label_boundary_segments[(Class,c)] += [vertex]
-
-        # Trim results - delete any dict entry which has no vertices
-        for key, value in list(self.label_boundary_segments.items()):
-            if value == []:
-                self.label_boundary_segments.pop(key)
+        for (a, b), (side_a, side_b) in sorted(self.label_boundary_index.items()):
+            self.label_boundary_segments[(a, b)] = side_a.tolist()
+            self.label_boundary_segments[(b, a)] = side_b.tolist()
 
         # Print results
         if verbose:
@@ -663,15 +688,16 @@ class Bounds:
         if verbose:
             print('Finding intersection of segment with polylines...')
         intersection = [0,0]
+        segment_set = set(np.asarray(segment).tolist())
+        polyline_set = set(np.asarray(self.polyline_elements).ravel().tolist())
 
         for i in range(2):
             pointer = endpoint[i]
-            used_vertices = [pointer]
+            used_vertices = set([pointer])
             neighbors = []
-            while pointer not in self.polyline_elements:
-                tmp0 = np.intersect1d(self.neighbors(pointer),segment)
-                tmp1 = np.setdiff1d(tmp0,used_vertices)
-                neighbors = neighbors + list(tmp1)
+            while pointer not in polyline_set:
+                tmp0 = segment_set.intersection(self.neighbors(pointer).tolist())
+                neighbors = neighbors + sorted(tmp0.difference(used_vertices))
 
                 if not neighbors:
                     pointer = -1
@@ -680,7 +706,7 @@ class Bounds:
                     break
 
                 pointer = neighbors.pop()
-                used_vertices.append(pointer)
+                used_vertices.add(pointer)
 
             intersection[i] = pointer
 
@@ -740,13 +766,20 @@ class Bounds:
         # and produce label mapping dictionary
         self.label_segment_matrix = np.zeros((self.num_points,self.num_segments))
 
-        self.realignment_mapping = {}
-        label = 0
-        for key, value in list(self.label_boundary_segments.items()):
-            self.realignment_mapping[label] = key
-            self.label_segment_matrix[value,:] = -1
-            self.label_segment_matrix[value,label] = 1
-            label += 1
+        self.realignment_mapping = dict(enumerate(self.label_boundary_segments))
+
+        # Each vertex gets -1s and a 1 in the column of its segment;
+        # a vertex listed in several segments keeps the last one
+        segments = list(self.label_boundary_segments.values())
+        if segments:
+            rows = np.concatenate([np.asarray(x, dtype=int).ravel()
+                                   for x in segments])
+            columns = np.repeat(np.arange(self.num_segments),
+                                [np.size(x) for x in segments])
+            rows, ilast = np.unique(rows[::-1], return_index=True)
+            columns = columns[::-1][ilast]
+            self.label_segment_matrix[rows, :] = -1
+            self.label_segment_matrix[rows, columns] = 1
 
         if verbose:
             print('Mapping is: {0}'.format(self.realignment_mapping))
@@ -791,7 +824,6 @@ class Bounds:
         dist_threshold: float (threshold of absolute distance between polylines and boundary, above which propagation is prohibited)
         num_good_vertices: int (threshold above which a label boundary segment will be preserved)
         eps: float (numerical stability - avoid division by zero)
-        pickled_filename: str (pkl file storing the distance matrix. Saves time.)
 
         Returns
         -------
@@ -816,11 +848,9 @@ class Bounds:
             print(self.polyline_elements.shape)
             print(self.label_boundary.shape)
 
-        distance_matrix = np.asarray([np.linalg.norm(self.Points[x1] -
-                                                     self.Points[x2])
-            for x1 in self.polyline_elements
-            for x2 in self.label_boundary]).\
-            reshape((self.polyline_elements.size, -1))
+        points = np.asarray(self.Points)
+        distance_matrix = cdist(points[self.polyline_elements],
+                                points[self.label_boundary])
 
         if verbose:
             print('Distance Matrix has been constructed in {0}. '
@@ -852,8 +882,8 @@ class Bounds:
                   'First few values are {1}'.format(closest_distances.shape,
                                                     closest_distances[:10]))
 
-        second_closest_distances = np.asarray([distance_matrix[i,sorted_distances[i,1]]
-                                               for i in range(self.polyline_elements.size)])
+        second_closest_distances = distance_matrix[
+            np.arange(self.polyline_elements.size), sorted_distances[:,1]]
         if verbose:
             print('Got second closest distances. Bounds is {0}. '
                   'First few values are {1}'.format(
@@ -864,13 +894,13 @@ class Bounds:
         # We will have one which maps polylines vertices to nearest label boundary vertices.
         # And we'll have one which maps lb vertices to nearest polylines vertices.
 
-        polylines_lb = dict((self.polyline_elements[i],
-                             (self.label_boundary[closest_label_boundary[i]],
-                              distance_matrix[i,closest_label_boundary[i]]))
-                                              for i in range(self.polyline_elements.size))
-        lb_polylines = dict((self.label_boundary[i],
-                             (self.polyline_elements[closest_polylines[i]],
-                              distance_matrix[closest_polylines[i],i])) for i in range(self.label_boundary.size))
+        polylines_lb = dict(zip(self.polyline_elements,
+            zip(self.label_boundary[closest_label_boundary],
+                closest_distances)))
+        lb_polylines = dict(zip(self.label_boundary,
+            zip(self.polyline_elements[closest_polylines],
+                distance_matrix[closest_polylines,
+                                np.arange(self.label_boundary.size)])))
 
         if verbose:
             print('The polylines to label boundary mapping is: {0}'.format(polylines_lb))
@@ -916,25 +946,22 @@ class Bounds:
         # For augmenting, we will add any vertex which maps to a fundus which maps to a qualified lb vertex on the same label boundary.
 
         # Pruning...
-        for lbvertex in satisfy_distances:
-            fundus_vertex = lb_polylines[lbvertex][0]
-            fundus_index = np.nonzero(self.polyline_elements == fundus_vertex)[0]
-            top_five_indices = sorted_distances[fundus_index,:5].flatten()
-            top_five_lbvertices = self.label_boundary[top_five_indices]
-            spread_matrix = np.zeros((top_five_lbvertices.size,top_five_lbvertices.size))
-            for i in range(top_five_lbvertices.size):
-                for j in range(top_five_lbvertices.size):
-                    v1 = top_five_lbvertices[i]
-                    v2 = top_five_lbvertices[j]
-                    spread_matrix[i,j] = np.linalg.norm(self.Points[v1] - self.Points[v2])
-
-            spread = np.max(spread_matrix)
-            if spread > spread_tol:
-                satisfy_distances = np.delete(satisfy_distances,np.nonzero(satisfy_distances == lbvertex))
-                if verbose:
-                    print('deleted vertex: {0}'.format(lbvertex))
-
-                #### AH! I'm changing that over which I'm iterating! Fix.
+        # The spread of each fundus vertex is the largest distance
+        # between its five closest label boundary vertices
+        top_five_points = points[self.label_boundary[sorted_distances[:,:5]]]
+        spreads = np.max(np.linalg.norm(top_five_points[:,:,np.newaxis] -
+                                        top_five_points[:,np.newaxis,:],
+                                        axis=-1), axis=(1,2))
+        fundus_rows = dict((v,i) for i,v in
+                           reversed(list(enumerate(self.polyline_elements))))
+        spread = np.array([spreads[fundus_rows[lb_polylines[lbvertex][0]]]
+                           for lbvertex in satisfy_distances])
+        deleted = satisfy_distances[spread > spread_tol]
+        if verbose:
+            for lbvertex in deleted:
+                print('deleted vertex: {0}'.format(lbvertex))
+        satisfy_distances = satisfy_distances[
+            np.logical_not(np.in1d(satisfy_distances, deleted))]
 
         self.highlight_vtk_vertices(satisfy_distances, dir + '/satisfy_distance_pruned.vtk')
 
@@ -943,14 +970,25 @@ class Bounds:
                   format(satisfy_distances.size))
 
         # Augmenting...
+        # (map each vertex to its label boundary segments, as in same_boundary)
+        segments_per_vertex = {}
+        for key, value in list(self.label_boundary_segments.items()):
+            for vertex in value:
+                segments_per_vertex.setdefault(vertex, set()).add(key)
+        satisfy_set = set(satisfy_distances.tolist())
+        added = []
         for lbvertex in self.label_boundary:
             fundus_vertex, distance = lb_polylines[lbvertex]
             if distance < lb_fundus_threshold:
                 mapped_lbvertex = polylines_lb[fundus_vertex][0]
-                if mapped_lbvertex in satisfy_distances and self.same_boundary(mapped_lbvertex,lbvertex):
-                    satisfy_distances = np.append(satisfy_distances,lbvertex)
+                if mapped_lbvertex in satisfy_set and \
+                        segments_per_vertex.get(mapped_lbvertex, set()).\
+                        intersection(segments_per_vertex.get(lbvertex, ())):
+                    satisfy_set.add(lbvertex)
+                    added.append(lbvertex)
                     if verbose:
                         print('added vertex: {0}'.format(lbvertex))
+        satisfy_distances = np.append(satisfy_distances, added).astype(int)
 
         self.highlight_vtk_vertices(satisfy_distances, dir + '/satisfy_distance_pruned_augmented.vtk')
         if verbose:
@@ -965,9 +1003,13 @@ class Bounds:
         # Let's include some information as to which label boundaries will propagate their labels...
         vertices_to_highlight = np.zeros(self.Labels.shape)
 
+        satisfy_mask = np.zeros(self.num_points, dtype=bool)
+        satisfy_mask[satisfy_distances] = True
+
         for key, value in list(self.label_boundary_segments.items()):
             # num_intersections = np.intersect1d(satisfy_distances, value).size + np.intersect1d(satisfy_distances, self.label_boundary_segments[key[::-1]]).size
-            num_intersections = np.intersect1d(satisfy_distances, value).size
+            num_intersections = np.count_nonzero(
+                satisfy_mask[np.unique(np.asarray(value, dtype=int))])
             if verbose:
                 print('Number of intersections is: {0}'.
                       format(num_intersections))
@@ -1070,14 +1112,13 @@ class Bounds:
             if verbose:
                 print('Constructing neighborhood function.')
 
-            self.Neighbors = lil_matrix((self.num_points, self.num_points))
-
-            for row in self.Faces:
-                self.Neighbors[row[0], row[1]] = self.Neighbors[row[1], row[0]] = 1
-                self.Neighbors[row[0], row[2]] = self.Neighbors[row[2], row[0]] = 1
-                self.Neighbors[row[1], row[2]] = self.Neighbors[row[2], row[1]] = 1
-
-            self.Neighbors = self.Neighbors.tocsr()
+            faces = np.asarray(self.Faces, dtype=int)
+            edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+            edges = np.vstack((edges, edges[:, ::-1]))
+            self.Neighbors = csr_matrix((np.ones(len(edges)),
+                                         (edges[:, 0], edges[:, 1])),
+                                        shape=(self.num_points, self.num_points))
+            self.Neighbors.data[:] = 1
             self.found_neighbors = 1
 
         return np.nonzero(self.Neighbors[vertex])[1]
@@ -1091,7 +1132,7 @@ class Bounds:
     def realign_label_boundary(self, surface_file, polylines_file,
                                label_boundary_filename, output_file_regions,
                                output_file_boundaries, max_iters,
-                               verbose=False):
+                               cache_directory='', verbose=False):
         """
         Complete method to realign the label boundaries.
         Calls all necessary subroutines.
@@ -1104,6 +1145,7 @@ class Bounds:
         label_boundary_filename: string (vtk file with initial label boundaries)
         output_file_regions: string (vtk file to contain new labels)
         max_iters: int (maximum number of iterations)
+        cache_directory: string (directory for cached label boundary indices)
 
         Returns
         -------
@@ -1120,7 +1162,7 @@ class Bounds:
 
         self.initialize_seed_labels(init='label_boundary',
                                     output_filename = label_boundary_filename)
-        self.find_label_boundary_segments()
+        self.find_label_boundary_segments(cache_directory=cache_directory)
         self.graph_based_learning(realign=True, max_iters=max_iters)
         self.assign_realigned_labels(filename = output_file_regions)
         self.find_label_boundary(realigned_labels=True,
@@ -13,12 +13,12 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 def propagate(points, faces, region, seeds, labels,
               max_iters=500, tol=0.001, sigma=10, background_value=-1,
-              verbose=False):
+              verbose=False, solver='iterative'):
     """
     Propagate labels to segment a surface into contiguous regions,
     starting from seed vertices.
 
-    Imports : mindboggle.guts.rebound
+    Imports : mindboggle.guts.rebound, mindboggle.guts.graph
 
     Parameters
     ----------
@@ -42,6 +42,11 @@ def propagate(points, faces, region, seeds, labels,
         background value
     verbose : bool
         print statements?
+    solver : string
+        'iterative' (rebound.Bounds weighted averaging of each seed ID),
+        'direct' or 'cg' (solve the clamped graph Laplacian system for all
+        seed IDs at once by sparse LU factorization or conjugate gradients;
+        see mindboggle.guts.graph.harmonic_labels)
 
     Returns
     -------
@@ -100,6 +105,14 @@ def propagate(points, faces, region, seeds, labels,
     >>> len_segments[0:10]
     [1152, 388, 116]
 
+    Solve for the converged values of all seed IDs at once:
+
+    >>> segments2 = propagate(points, faces, region, seeds, labels,
+    ...                       max_iters, tol, sigma, background_value, verbose,
+    ...                       solver='direct')
+    >>> np.unique(segments2)[0:10]
+    array([-1.,  3., 12., 22.])
+
     Write results to vtk file and view (skip test):
 
     >>> from mindboggle.mio.plots import plot_surfaces # doctest: +SKIP
@@ -111,6 +124,7 @@ def propagate(points, faces, region, seeds, labels,
     """
     import numpy as np
     from mindboggle.guts.mesh import keep_faces
+    from mindboggle.guts.graph import weight_graph, harmonic_labels
     import mindboggle.guts.kernels as kernels
     import mindboggle.guts.rebound as rebound
 
@@ -143,9 +157,28 @@ def propagate(points, faces, region, seeds, labels,
             # Remove faces whose 3 vertices are not among specified indices:
             refaces = keep_faces(faces, indices_region)
 
+            # Solve for all seed IDs at once:
+            if refaces and solver != 'iterative':
+                W = weight_graph(points[indices_region], local_indices_region,
+                                 np.array(refaces), kernel=kernels.rbf_kernel,
+                                 add_to_graph=False, sigma=sigma)
+                seed_labels = seeds[indices_region]
+                clamped = seed_labels != background_value
+                unique_labels = np.unique(seed_labels[clamped])
+                if unique_labels.size:
+                    Y = -1 * np.ones((len(indices_region), len(unique_labels)))
+                    Y[np.where(clamped)[0],
+                      np.searchsorted(unique_labels, seed_labels[clamped])] = 1
+                    X = harmonic_labels(W, Y, clamped, solver=solver, tol=tol,
+                                        max_iters=max_iters, verbose=verbose)
+
+                    # Assign maximum value seed IDs to each point of region:
+                    segments[indices_region] = \
+                        unique_labels[np.argmax(X, axis=1)]
+
             # Set up rebound Bounds class instance:
-            B = rebound.Bounds()
-            if refaces:
+            elif refaces:
+                B = rebound.Bounds()
                 B.Faces = np.array(refaces)
                 B.Indices = local_indices_region
                 B.Points = points[indices_region]
@@ -632,7 +665,7 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
     Steps ::
         1. Extract region borders (assumed to be closed contours)
         2. Segment borders into separate, contiguous borders
-        3. For each boundary
+        3. For all boundaries at once (as connected components of sparse graphs)
             4. Find the neighbors to either side of the boundary
             5. Segment the neighbors into exterior and interior sets of neighbors
             6. Find the interior (smaller) sets of neighbors
@@ -691,14 +724,23 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
 
     """
     import numpy as np
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components
+    from mindboggle.guts.mesh import neighbor_lists_to_csr
     from mindboggle.guts.segment import extract_borders
-    from mindboggle.guts.segment import segment_regions
-
-    include_boundary = False
 
     # Make sure arguments are numpy arrays
     if not isinstance(regions, np.ndarray):
         regions = np.array(regions)
+    npoints = len(regions)
+
+    def label_components(nnodes, nodes1, nodes2, keep):
+        """Number connected nodes of a graph, in order of lowest node."""
+        graph = csr_matrix((np.ones(np.sum(keep), dtype=np.int8),
+                            (nodes1[keep], nodes2[keep])),
+                           shape=(nnodes, nnodes))
+        foo, components = connected_components(graph, directed=False)
+        return components
 
     if verbose:
         print('Segment vertices using region borders')
@@ -706,78 +748,78 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
     # Extract region borders (assumed to be closed contours)
     if verbose:
         print('  Extract region borders (assumed to be closed contours)')
-    indices_borders, foo1, foo2 = extract_borders(list(range(len(regions))),
+    indices_borders, foo1, foo2 = extract_borders(list(range(npoints)),
                                                   regions, neighbor_lists)
-    # Extract background
-    indices_background = list(frozenset(list(range(len(regions)))).
-    difference(indices_borders))
+    is_border = np.zeros(npoints, dtype=bool)
+    is_border[indices_borders] = True
+    segments = background_value * np.ones(npoints)
+    if not indices_borders:
+        return segments
+    adjacency = neighbor_lists_to_csr(neighbor_lists)
+    edge1 = np.repeat(np.arange(npoints), np.diff(adjacency.indptr))
+    edge2 = adjacency.indices
 
     # Segment borders into separate, contiguous borders
     if verbose:
         print('  Segment borders into separate, contiguous borders')
-    borders = segment_regions(indices_borders, neighbor_lists, 1, [], False,
-                              False, [], [], [], '', background_value,
-                              verbose)
-
-    # For each boundary
-    unique_borders = [x for x in np.unique(borders) if x != background_value]
-    segments = background_value * np.ones(len(regions))
-    for boundary_number in unique_borders:
-
-        if verbose:
-            print('  Boundary {0} of {1}:'.format(int(boundary_number),
-                                                  len(unique_borders)))
-        border_indices = [i for i,x in enumerate(borders)
-                          if x == boundary_number]
-        # Find the neighbors to either side of the boundary
-        indices_neighbors = []
-        [indices_neighbors.extend(neighbor_lists[i]) for i in border_indices]
-        #indices_neighbors2 = indices_neighbors[:]
-        #[indices_neighbors2.extend(neighbor_lists[i]) for i in indices_neighbors]
-        indices_neighbors = list(frozenset(indices_neighbors).
-        difference(indices_borders))
-
-        # Segment the neighbors into exterior and interior sets of neighbors
-        if verbose:
-            print('    Segment the neighbors into exterior and interior sets '
-                  'of neighbors')
-        neighbors = segment_regions(indices_neighbors, neighbor_lists, 1, [],
-                                    False, False, [], [], [], '',
-                                    background_value, verbose)
-
-        # Find the interior (smaller) sets of neighbors
-        if verbose:
-            print('    Find the interior (smaller) sets of neighbors')
-        seed_lists = []
-        unique_neighbors = [x for x in np.unique(neighbors)
-                            if x != background_value]
-        max_neighbor = 0
-        max_len = 0
-        for ineighbor, neighbor in enumerate(unique_neighbors):
-            indices_neighbor = [i for i,x in enumerate(neighbors)
-                                if x == neighbor]
-            seed_lists.append(indices_neighbor)
-            if len(indices_neighbor) > max_len:
-                max_len = len(indices_neighbor)
-                max_neighbor = ineighbor
-        seed_lists = [x for i,x in enumerate(seed_lists) if i != max_neighbor]
-        seed_list = []
-        [seed_list.extend(x) for x in seed_lists if len(x) > 2]
-
-        # Fill the contours formed by the interior neighbors
-        if verbose:
-            print('    Fill the contour formed by the interior neighbors')
-        vertices_to_segment = list(frozenset(indices_background).
-        difference(indices_borders))
-        segmented_regions = segment_regions(vertices_to_segment,
-                                            neighbor_lists, 1, [seed_list],
-                                            False, False, [], [], [], '',
-                                            background_value, verbose)
-
-        if include_boundary:
-            segmented_regions[border_indices] = 1
-
-        segments[segmented_regions != background_value] = boundary_number
+    components = label_components(npoints, edge1, edge2,
+                                  is_border[edge1] & is_border[edge2])
+    foo, borders = np.unique(components[is_border], return_inverse=True)
+    border_numbers = -1 * np.ones(npoints, dtype=int)
+    border_numbers[is_border] = borders
+
+    # Find the neighbors to either side of each boundary
+    # (one node per boundary and neighbor vertex):
+    if verbose:
+        print('  Find the neighbors to either side of {0} borders'.
+              format(len(foo)))
+    Iedges = np.where(is_border[edge1] & ~is_border[edge2])[0]
+    nodes = np.unique(border_numbers[edge1[Iedges]] * npoints + edge2[Iedges])
+    node_borders = nodes // npoints
+    node_vertices = nodes % npoints
+
+    # Segment the neighbors into exterior and interior sets of neighbors
+    # (connect nodes of the same boundary whose vertices are neighbors):
+    if verbose:
+        print('  Segment the neighbors into exterior and interior sets '
+              'of neighbors')
+    counts = np.diff(adjacency.indptr)[node_vertices]
+    node1 = np.repeat(np.arange(len(nodes)), counts)
+    starts = np.repeat(adjacency.indptr[node_vertices] - np.cumsum(counts) +
+                       counts, counts)
+    neighbor_keys = node_borders[node1] * npoints + \
+        edge2[np.arange(len(node1)) + starts]
+    node2 = np.minimum(np.searchsorted(nodes, neighbor_keys), len(nodes) - 1)
+    neighbors = label_components(len(nodes), node1, node2,
+                                 nodes[node2] == neighbor_keys)
+
+    # Find the interior (smaller) sets of neighbors, removing the largest
+    # (exterior) set and sets of two or fewer vertices for each boundary:
+    if verbose:
+        print('  Find the interior (smaller) sets of neighbors')
+    sizes = np.bincount(neighbors)
+    neighbor_borders = np.zeros(len(sizes), dtype=int)
+    neighbor_borders[neighbors] = node_borders
+    Isort = np.lexsort((-sizes, neighbor_borders))
+    first = np.ones(len(Isort), dtype=bool)
+    first[1:] = np.diff(neighbor_borders[Isort]) != 0
+    interior = sizes > 2
+    interior[Isort[first]] = False
+    Iseeds = np.where(interior[neighbors])[0]
+
+    # Fill the contours formed by the interior neighbors
+    # (grow from all seeds at once through non-border vertices;
+    # a contour filled from more than one boundary takes the last number):
+    if verbose:
+        print('  Fill the contours formed by the interior neighbors')
+    fills = label_components(npoints, edge1, edge2,
+                             ~is_border[edge1] & ~is_border[edge2])
+    fill_numbers = -1 * np.ones(npoints, dtype=int)
+    np.maximum.at(fill_numbers, fills[node_vertices[Iseeds]],
+                  node_borders[Iseeds])
+    fill_numbers = fill_numbers[fills]
+    fill_numbers[is_border] = -1
+    segments[fill_numbers > -1] = fill_numbers[fill_numbers > -1]
 
     return segments
 
@@ -785,7 +827,12 @@ def segment_by_filling_borders(regions, neighbor_lists, background_value=-1,
 def segment_rings(region, seeds, neighbor_lists, step=1, background_value=-1,
                   verbose=False):
     """
-    Iteratively segment a region of surface mesh as concentric segments.
+    Segment a region of surface mesh as concentric segments.
+
+    Each segment contains the region vertices that are the next step number
+    of edges away from the seeds, as computed by a single breadth-first
+    search from all of the seeds (see find_hop_distances()). Segments are
+    ordered from the seeds outward, and each segment's vertices are sorted.
 
     Parameters
     ----------
@@ -805,10 +852,20 @@ def segment_rings(region, seeds, neighbor_lists, step=1, background_value=-1,
     Returns
     -------
     segments : list of lists of integers
-        indices to vertices for each concentric segment
+        sorted indices to vertices for each concentric segment
 
     Examples
     --------
+    >>> # Simple example:
+    >>> from mindboggle.guts.segment import segment_rings
+    >>> neighbor_lists = [[1,2],[0,3],[0,3],[1,2,4],[3,5],[4],[]]
+    >>> segment_rings([1,2,3,4,5,6], [0], neighbor_lists)
+    [[1, 2], [3], [4], [5]]
+    >>> segment_rings([1,2,3,4,5,6], [0], neighbor_lists, step=2)
+    [[1, 2, 3], [4, 5]]
+
+    Real example:
+
     >>> import numpy as np
     >>> from mindboggle.mio.vtks import read_scalars
     >>> from mindboggle.guts.mesh import find_neighbors_from_file
@@ -855,8 +912,8 @@ def segment_rings(region, seeds, neighbor_lists, step=1, background_value=-1,
     56
     >>> [len(x) for x in segments][0:10]
     [5540, 5849, 6138, 5997, 4883, 3021, 1809, 1165, 842, 661]
-    >>> segments[0][0:10]
-    [65539, 65540, 98308, 98316, 131112, 131121, 131122, 131171, 131175, 131185]
+    >>> all(x == sorted(x) for x in segments)
+    True
 
     Write results to vtk file and view (skip test):
 
@@ -869,27 +926,22 @@ def segment_rings(region, seeds, neighbor_lists, step=1, background_value=-1,
     >>> plot_surfaces('segment_rings.vtk') # doctest: +SKIP
 
     """
-    from mindboggle.guts.segment import segment_regions
-
-    segments = []
-    while seeds:
-
-        # Segment step-wise starting from seeds and through the region:
-        seeds_plus_new = segment_regions(region, neighbor_lists, 1, [seeds],
-                                         False, False, [], [], [],
-                                         step, background_value, verbose)
-
-        seeds_plus_new = [i for i,x in enumerate(seeds_plus_new)
-                          if x != background_value]
-
-        # Store the new segment after removing the previous segment:
-        region = list(frozenset(region).difference(seeds))
-        seeds = list(frozenset(seeds_plus_new).difference(seeds))
-        if seeds:
-
-            # Add the new segment and remove it from the region:
-            segments.append(seeds)
-            region = list(frozenset(region).difference(seeds))
+    import numpy as np
+    from mindboggle.guts.mesh import find_hop_distances
+
+    # Number of edges from the seeds through the region (seeds are zero):
+    hops = find_hop_distances(seeds, neighbor_lists, region,
+                              background_value=-1)
+
+    # Group every step number of hops into a concentric segment:
+    I = np.where(hops > 0)[0]
+    if not I.size:
+        return []
+    rings = (hops[I] - 1) // step
+    # (I is sorted, so a stable sort keeps each segment's vertices sorted):
+    I = I[np.argsort(rings, kind='stable')]
+    nrings = np.bincount(rings)
+    segments = [ring.tolist() for ring in np.split(I, np.cumsum(nrings)[:-1])]
 
     return segments
 
@@ -1450,6 +1502,9 @@ def extract_borders(indices, labels, neighbor_lists,
     Label borders are the set of all vertices
     whose neighbors do not share the same label.
 
+    Labels are gathered across all mesh edges at once
+    (see neighbor_lists_to_csr()), so the cost scales with mesh size.
+
     Parameters
     ----------
     indices : list of integers
@@ -1528,41 +1583,48 @@ def extract_borders(indices, labels, neighbor_lists,
 
     """
     import numpy as np
+    from mindboggle.guts.mesh import neighbor_lists_to_csr
 
     # Make sure arguments are numpy arrays:
     if not isinstance(labels, np.ndarray):
         labels = np.array(labels)
-
-    # Construct an array of labels corresponding to the neighbor lists:
-    L = np.array([list(set(labels[lst])) for lst in neighbor_lists])
-
-    # Find indices to sets of two labels:
-    border_indices = [indices[y] for y in
-                      [i for i,x in enumerate(L[indices])
-                       if len(set(x)) >= 2]]
-
-    if return_label_pairs:
-        border_label_tuples = [np.sort(L[indices[j]]).tolist() for j in
-                                [i for i,x in enumerate(L[indices])
-                                 if len(set(x)) >= 2]]
+    indices = np.asarray(indices, dtype=int)
+    npoints = len(neighbor_lists)
+
+    # Find the unique labels across the edges from each vertex
+    # (sorted by vertex, then by label):
+    adjacency = neighbor_lists_to_csr(neighbor_lists, indices)
+    unique_labels, label_numbers = np.unique(labels[adjacency.indices],
+                                             return_inverse=True)
+    nlabels = max(len(unique_labels), 1)
+    edge_vertices = np.repeat(np.arange(npoints), np.diff(adjacency.indptr))
+    vertex_labels = np.unique(edge_vertices * nlabels + label_numbers)
+    vertex_of_label = vertex_labels // nlabels
+    vertex_labels = unique_labels[vertex_labels % nlabels]
+
+    # Find indices to vertices whose neighbors have two or more labels:
+    counts = np.bincount(vertex_of_label, minlength=npoints)
+    starts = np.cumsum(counts) - counts
+    Iborders = indices[counts[indices] >= 2]
+
+    if return_label_pairs or ignore_values:
+        border_label_tuples = [vertex_labels[starts[i]:starts[i] + counts[i]].
+                               tolist() for i in Iborders]
     else:
         border_label_tuples = []
 
     if ignore_values:
         Ikeep = [i for i,x in enumerate(border_label_tuples)
                  if not len(set(x).intersection(ignore_values))]
-        border_indices = [x for i,x in enumerate(border_indices)
-                            if i in Ikeep]
-        if return_label_pairs:
-            border_label_tuples = [x for i,x in enumerate(border_label_tuples)
-                                    if i in Ikeep]
+        Iborders = Iborders[Ikeep]
+        border_label_tuples = [border_label_tuples[i] for i in Ikeep]
+    border_indices = Iborders.tolist()
 
     if return_label_pairs:
-        unique_border_label_tuples = []
-        for pair in border_label_tuples:
-            if pair not in unique_border_label_tuples:
-                unique_border_label_tuples.append(pair)
+        unique_border_label_tuples = [list(x) for x in
+            dict.fromkeys(tuple(x) for x in border_label_tuples)]
     else:
+        border_label_tuples = []
         unique_border_label_tuples = []
 
     return border_indices, border_label_tuples, unique_border_label_tuples
@@ -1658,7 +1720,7 @@ def extract_borders_2nd_surface(labels_file, values_file='',
 
 
 def combine_2labels_in_2volumes(file1, file2, label1=3, label2=2,
-                                output_file=''):
+                                output_file='', slab_size=0):
     """
     Combine the voxels of one label from two files and overlay them
     on the second label combined from the two files.
@@ -1699,6 +1761,9 @@ def combine_2labels_in_2volumes(file1, file2, label1=3, label2=2,
         target label number (to be overwritten by label1 where they intersect)
     output_file : string
         output file name
+    slab_size : integer
+        number of slices (along the third axis) to load at a time
+        (0: load whole volumes)
 
     Returns
     -------
@@ -1732,31 +1797,33 @@ def combine_2labels_in_2volumes(file1, file2, label1=3, label2=2,
     import nibabel as nb
 
     # ------------------------------------------------------------------------
-    # Load labeled image volume and extract data as 1-D array:
+    # Load labeled image volume headers (data are read slab by slab):
     # ------------------------------------------------------------------------
     vol1 = nb.load(file1)
     vol2 = nb.load(file2)
-    data1 = vol1.get_data().ravel()
-    data2 = vol2.get_data().ravel()
-    xfm = vol1.get_affine()
+    if vol1.shape != vol2.shape:
+        raise IOError(file1 + " and " + file2 + " differ in shape")
+    xfm = vol1.affine
+    nslices = vol1.shape[2]
+    if not slab_size:
+        slab_size = nslices
     # ------------------------------------------------------------------------
-    # Indices to voxels with label1 or label2 in two files:
+    # Assign new labels to voxels with label1 or label2 in either file:
     # ------------------------------------------------------------------------
     label1 = int(label1)
     label2 = int(label2)
-    Ilabel1_vol1 = np.where(data1 == label1)[0]
-    Ilabel1_vol2 = np.where(data2 == label1)[0]
-    Ilabel2_vol1 = np.where(data1 == label2)[0]
-    Ilabel2_vol2 = np.where(data2 == label2)[0]
-    Ilabel1 = Ilabel1_vol1.tolist() + Ilabel1_vol2.tolist()
-    Ilabel2 = Ilabel2_vol1.tolist() + Ilabel2_vol2.tolist()
-    # ------------------------------------------------------------------------
-    # Assign new labels and reshape to original dimensions:
-    # ------------------------------------------------------------------------
-    new_data = data1.copy()
-    new_data[Ilabel2] = label2
-    new_data[Ilabel1] = label1
-    new_data = np.reshape(new_data, vol1.shape)
+    new_data = None
+    for k0 in range(0, nslices, slab_size):
+        k1 = min(k0 + slab_size, nslices)
+        data1 = np.asanyarray(vol1.dataobj[:, :, k0:k1])
+        data2 = np.asanyarray(vol2.dataobj[:, :, k0:k1])
+        if new_data is None:
+            new_data = np.empty(vol1.shape, dtype=data1.dtype)
+        slab = new_data[:, :, k0:k1]
+        slab[...] = data1
+        slab[data2 == label2] = label2
+        slab[data1 == label1] = label1
+        slab[data2 == label1] = label1
     # ------------------------------------------------------------------------
     # Save relabeled file:
     # ------------------------------------------------------------------------
@@ -1772,7 +1839,8 @@ def combine_2labels_in_2volumes(file1, file2, label1=3, label2=2,
     return output_file
 
 
-def split_brain(image_file, label_file, left_labels, right_labels):
+def split_brain(image_file, label_file, left_labels, right_labels,
+                slab_size=0):
     """
     Split a brain using left/right labels.
 
@@ -1786,6 +1854,9 @@ def split_brain(image_file, label_file, left_labels, right_labels):
         left label numbers
     right_labels : list of integers
         right label numbers
+    slab_size : integer
+        number of slices (along the third axis) to load at a time
+        (0: load whole volumes)
 
     Returns
     -------
@@ -1818,43 +1889,42 @@ def split_brain(image_file, label_file, left_labels, right_labels):
     import numpy as np
     import nibabel as nb
 
-    from mindboggle.guts.relabel import keep_volume_labels
-
     left_brain = os.path.join(os.getcwd(),
                               'left_' + os.path.basename(image_file))
     right_brain = os.path.join(os.getcwd(),
                                'right_' + os.path.basename(image_file))
     # ------------------------------------------------------------------------
-    # Split brain labels by masking with left or right labels:
-    # ------------------------------------------------------------------------
-    left_brain = keep_volume_labels(label_file, left_labels, left_brain)
-    right_brain = keep_volume_labels(label_file, right_labels, right_brain)
-    # ------------------------------------------------------------------------
-    # Load labeled image volumes and extract data as 1-D array:
+    # Load image volume headers (data are read slab by slab):
     # ------------------------------------------------------------------------
     vol = nb.load(image_file)
-    volL = nb.load(left_brain)
-    volR = nb.load(right_brain)
-    data = vol.get_data().ravel()
-    dataL = volL.get_data().ravel()
-    dataR = volR.get_data().ravel()
-    dataL[np.where(dataL != 0)[0]] = 1
-    dataR[np.where(dataR != 0)[0]] = 1
-    xfm = vol.get_affine()
-    # ------------------------------------------------------------------------
-    # Split brain image by masking with left or right labels:
-    # ------------------------------------------------------------------------
-    left_data = data * dataL
-    right_data = data * dataR
+    vol_labels = nb.load(label_file)
+    if vol.shape[:3] != vol_labels.shape[:3]:
+        raise IOError(image_file + " and " + label_file + " differ in shape")
+    xfm = vol.affine
+    nslices = vol.shape[2]
+    if not slab_size:
+        slab_size = nslices
     # ------------------------------------------------------------------------
-    # Save relabeled file:
+    # Split brain image by masking with left or right labels
+    # (one half at a time, to hold only one output volume in memory):
     # ------------------------------------------------------------------------
-    left_data = np.reshape(left_data, volL.shape)
-    right_data = np.reshape(right_data, volR.shape)
-    img1 = nb.Nifti1Image(left_data, xfm)
-    img1.to_filename(left_brain)
-    img2 = nb.Nifti1Image(right_data, xfm)
-    img2.to_filename(right_brain)
+    for output_file, side_labels in [(left_brain, left_labels),
+                                     (right_brain, right_labels)]:
+        side_data = None
+        for k0 in range(0, nslices, slab_size):
+            k1 = min(k0 + slab_size, nslices)
+            data = np.asanyarray(vol.dataobj[:, :, k0:k1])
+            mask = np.isin(np.asanyarray(vol_labels.dataobj[:, :, k0:k1]),
+                           side_labels)
+            if side_data is None:
+                side_data = np.zeros(vol.shape, dtype=data.dtype)
+            side_data[:, :, k0:k1][mask] = data[mask]
+        # --------------------------------------------------------------------
+        # Save masked file:
+        # --------------------------------------------------------------------
+        img = nb.Nifti1Image(side_data, xfm)
+        img.to_filename(output_file)
+        del side_data
 
     if not os.path.exists(right_brain) or not os.path.exists(left_brain):
         raise IOError(right_brain + " or " + left_brain + "not found")
@@ -113,6 +113,83 @@ def list_strings(string1='', string2='', string3='', string4=''):
     return string_list
 
 
+# Read-only arguments inherited by forked map_processes() worker processes:
+_shared = {}
+
+
+def map_processes(function, tasks, shared, n_processes=1):
+    """
+    Apply a function to each of a list of tasks, in forked processes if asked.
+
+    Each task is a tuple of arguments, and each call is
+    function(*task, **shared). With n_processes > 1, tasks are distributed
+    to a pool of forked processes in the order given (so list large tasks
+    first, for small ones to fill in at the end), and the processes inherit
+    the shared keyword arguments (copy-on-write) rather than receive a copy
+    with each task. Tasks are run in this process if fork is unavailable or
+    if this process is a daemon (such as a multiprocessing pool worker,
+    which cannot have child processes).
+
+    Parameters
+    ----------
+    function : function
+        module-level function (so that forked processes can find it)
+    tasks : list of tuples
+        positional arguments to function for each task
+    shared : dictionary
+        keyword arguments to function shared by all tasks
+    n_processes : integer
+        number of processes
+
+    Yields
+    ------
+    itask : integer
+        index to task
+    result : object
+        result of function for the task (yielded in order of completion)
+
+    Examples
+    --------
+    >>> from mindboggle.guts.utilities import map_processes
+    >>> tasks = [(1.234,), (5.678,), (9.012,)]
+    >>> sorted(map_processes(round, tasks, {'ndigits': 1}, n_processes=2))
+    [(0, 1.2), (1, 5.7), (2, 9.0)]
+
+    """
+    import multiprocessing as mp
+
+    from mindboggle.guts.utilities import _shared, _map_processes_worker
+
+    if n_processes > 1 and len(tasks) > 1 and \
+            'fork' in mp.get_all_start_methods() and \
+            not mp.current_process().daemon:
+
+        # Forked workers inherit the shared arguments (copy-on-write):
+        _shared.update(shared)
+        try:
+            pool = mp.get_context('fork').Pool(min(n_processes, len(tasks)))
+            try:
+                for itask, result in pool.imap_unordered(
+                        _map_processes_worker,
+                        [(itask, function, task)
+                         for itask, task in enumerate(tasks)]):
+                    yield itask, result
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _shared.clear()
+    else:
+        for itask, task in enumerate(tasks):
+            yield itask, function(*task, **shared)
+
+
+def _map_processes_worker(args):
+    """Apply a function to a numbered task with the shared arguments."""
+    itask, function, task = args
+    return itask, function(*task, **_shared)
+
+
 # ============================================================================
 # Doctests
 # ============================================================================
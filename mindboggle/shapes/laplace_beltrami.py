@@ -45,6 +45,9 @@ Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 """
 
+# Version of cached label spectra (increment when their numerics change):
+_spectrum_cache_version = 1
+
 
 def computeAB(points, faces):
     """
@@ -100,13 +103,57 @@ def computeAB(points, faces):
      [0.      0.      0.      0.04167 0.      0.04167 0.08333 0.     ]
      [0.04167 0.04167 0.      0.      0.      0.      0.      0.08333]]
 
+    """
+    from mindboggle.shapes.laplace_beltrami import local_AB, assemble_AB
+
+    localA, localB = local_AB(points, faces)
+    A, B = assemble_AB(faces, localA, localB)
+
+    return A, B
+
+
+def local_AB(points, faces):
+    """
+    Compute the local (per-face) matrices for the Laplace-Beltrami operator.
+
+    Entry [r,c] of a face's local matrix contributes to entry
+    [faces[c], faces[r]] of A or B (see assemble_AB).
+
+    Parameters
+    ----------
+    points : list of lists of 3 floats
+        x,y,z coordinates for each vertex
+
+    faces : list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+
+    Returns
+    -------
+    localA : numpy array of floats
+        nfaces x 3 x 3 local stiffness matrices
+    localB : numpy array of floats
+        nfaces x 3 x 3 local mass matrices
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import local_AB
+    >>> points = [[0,0,0], [1,0,0], [0,0,1], [0,1,1],
+    ...           [1,0,1], [0,1,0], [1,1,1], [1,1,0]]
+    >>> faces = [[0,2,4], [0,1,4], [2,3,4], [3,4,5], [3,5,6], [0,1,7]]
+    >>> localA, localB = local_AB(points, faces)
+    >>> localA.shape
+    (6, 3, 3)
+    >>> print(np.array_str(localA[0], precision=5, suppress_small=True))
+    [[ 0.5 -0.5  0. ]
+     [-0.5  1.  -0.5]
+     [ 0.  -0.5  0.5]]
+
     """
     import numpy as np
-    from scipy import sparse
 
-    points = np.array(points)
-    faces = np.array(faces)
-    nfaces = faces.shape[0]
+    points = np.asarray(points, dtype=np.float64)
+    faces = np.asarray(faces, dtype=int)
 
     # Linear local matrices on unit triangle:
     tB = (np.ones((3,3)) + np.eye(3)) / 24.0
@@ -123,13 +170,6 @@ def computeAB(points, faces):
                        [-0.5, 0.0, 0.5],
                        [-0.5, 0.5, 0.0]])
 
-    # Replicate into third dimension for each triangle
-    # (for tB, 1st index is the 3rd index in MATLAB):
-    tB = np.array([np.tile(tB, (1, 1)) for i in range(nfaces)])
-    tA00 = np.array([np.tile(tA00, (1, 1)) for i in range(nfaces)])
-    tA11 = np.array([np.tile(tA11, (1, 1)) for i in range(nfaces)])
-    tA0110 = np.array([np.tile(tA0110,(1, 1)) for i in range(nfaces)])
-
     # Compute vertex coordinates and a difference vector for each triangle:
     v1 = points[faces[:, 0], :]
     v2 = points[faces[:, 1], :]
@@ -137,60 +177,174 @@ def computeAB(points, faces):
     v2mv1 = v2 - v1
     v3mv1 = v3 - v1
 
-    def reshape_and_repeat(A):
-        """
-        For a given 1-D array A, run the MATLAB code below.
-
-            M = reshape(M,1,1,nfaces);
-            M = repmat(M,3,3);
-
-        Please note that a0 is a 3-D matrix, but the 3rd index in NumPy
-        is the 1st index in MATLAB.  Fortunately, nfaces is the size of A.
-
-        """
-        return np.array([np.ones((3,3))*x for x in A])
-
+    # Per-triangle values are broadcast against the 3x3 local matrices
+    # as (nfaces, 1, 1) arrays (MATLAB: reshape(M,1,1,nfaces)).
     # Compute length^2 of v3mv1 for each triangle:
-    a0 = np.sum(v3mv1 * v3mv1, axis=1)
-    a0 = reshape_and_repeat(a0)
+    a0 = np.sum(v3mv1 * v3mv1, axis=1)[:, np.newaxis, np.newaxis]
 
     # Compute length^2 of v2mv1 for each triangle:
-    a1 = np.sum(v2mv1 * v2mv1, axis=1)
-    a1 = reshape_and_repeat(a1)
+    a1 = np.sum(v2mv1 * v2mv1, axis=1)[:, np.newaxis, np.newaxis]
 
     # Compute dot product (v2mv1*v3mv1) for each triangle:
-    a0110 = np.sum(v2mv1 * v3mv1, axis=1)
-    a0110 = reshape_and_repeat(a0110)
+    a0110 = np.sum(v2mv1 * v3mv1, axis=1)[:, np.newaxis, np.newaxis]
 
     # Compute cross product and 2*vol for each triangle:
     cr  = np.cross(v2mv1,v3mv1)
     vol = np.sqrt(np.sum(cr*cr, axis=1))
     # zero vol will cause division by zero below, so set to small value:
-    vol_mean = 0.001*np.mean(vol)
-    vol = [vol_mean if x == 0 else x for x in vol]
-    vol = reshape_and_repeat(vol)
+    if vol.size:
+        vol[vol == 0] = 0.001*np.mean(vol)
+    vol = vol[:, np.newaxis, np.newaxis]
 
-    # Construct all local A and B matrices (guess: for each triangle):
+    # Construct all local A and B matrices (one 3x3 matrix per triangle):
     localB = vol * tB
     localA = (1.0/vol) * (a0*tA00 + a1*tA11 - a0110*tA0110)
 
-    # Construct row and col indices.
-    # (Note: J in numpy is I in MATLAB after flattening,
-    #  because numpy is row-major while MATLAB is column-major.)
-    J = np.array([np.tile(x, (3,1)) for x in faces])
-    I = np.array([np.transpose(np.tile(x, (3,1))) for x in faces])
+    return localA, localB
+
+
+def assemble_AB(faces, localA, localB, select_faces=None, reindex=False):
+    """
+    Assemble Laplace-Beltrami matrices from local (per-face) matrices.
+
+    Local matrices can be computed once for a whole surface (see local_AB)
+    and then assembled for any subset of its faces, without recomputing
+    geometry.
+
+    Parameters
+    ----------
+    faces : numpy array or list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+    localA : numpy array of floats
+        nfaces x 3 x 3 local stiffness matrices (see local_AB)
+    localB : numpy array of floats
+        nfaces x 3 x 3 local mass matrices (see local_AB)
+    select_faces : numpy array or list of integers (or None)
+        indices to the faces to assemble (None: all faces)
+    reindex : bool
+        compress vertex indices to those of the selected faces?
+
+    Returns
+    -------
+    A : csr_matrix
+    B : csr_matrix
+    original_indices : numpy array of integers (only if reindex)
+        original vertex index for each row of A and B
 
-    # Flatten arrays and swap I and J:
-    J_new = I.flatten()
-    I_new = J.flatten()
-    localA = localA.flatten()
-    localB = localB.flatten()
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import computeAB
+    >>> from mindboggle.shapes.laplace_beltrami import local_AB, assemble_AB
+    >>> points = [[0,0,0], [1,0,0], [0,0,1], [0,1,1],
+    ...           [1,0,1], [0,1,0], [1,1,1], [1,1,0]]
+    >>> faces = [[0,2,4], [0,1,4], [2,3,4], [3,4,5], [3,5,6], [0,1,7]]
+    >>> localA, localB = local_AB(points, faces)
+    >>> A, B, I = assemble_AB(faces, localA, localB, [2, 3, 4], True)
+    >>> I
+    array([2, 3, 4, 5, 6])
+    >>> A2, B2 = computeAB(np.array(points)[I], [[0,1,2], [1,2,3], [1,3,4]])
+    >>> np.allclose(A.toarray(), A2.toarray())
+    True
+    >>> np.allclose(B.toarray(), B2.toarray())
+    True
+
+    """
+    import numpy as np
+    from scipy import sparse
+
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+    if select_faces is not None:
+        faces = faces[select_faces]
+        localA = localA[select_faces]
+        localB = localB[select_faces]
+    if reindex:
+        original_indices, faces = np.unique(faces, return_inverse=True)
+        faces = faces.reshape(-1, 3)
+        shape = (original_indices.size, original_indices.size)
+    else:
+        shape = None
+
+    # Construct row and col indices: entry [r,c] of a triangle's local
+    # matrix goes to row faces[c] and column faces[r] (numpy is row-major
+    # while MATLAB is column-major, so I and J are swapped).
+    I = np.broadcast_to(faces[:, np.newaxis, :], localA.shape).ravel()
+    J = np.broadcast_to(faces[:, :, np.newaxis], localA.shape).ravel()
 
     # Construct sparse matrix:
-    A = sparse.csr_matrix((localA, (I_new, J_new)))
-    B = sparse.csr_matrix((localB, (I_new, J_new)))
+    A = sparse.csr_matrix((localA.ravel(), (I, J)), shape=shape)
+    B = sparse.csr_matrix((localB.ravel(), (I, J)), shape=shape)
 
-    return A, B
+    if reindex:
+        return A, B, original_indices
+    else:
+        return A, B
+
+
+def cached_local_AB(points, faces, cache_directory=''):
+    """
+    Return local (per-face) matrices of a surface, computing them once.
+
+    See local_AB. With a cache_directory, local matrices are stored under a
+    hash of the points and faces (see mindboggle.guts.cache), so that
+    spectra of different files on the same surface (such as labels and
+    sulci, computed in separate processes) reuse one computation.
+
+    Parameters
+    ----------
+    points : list of lists of 3 floats
+        x,y,z coordinates for each vertex
+    faces : list of lists of 3 integers
+        each list contains indices to vertices that form a triangle on a mesh
+    cache_directory : string
+        directory for cached local matrices ('' for no caching)
+
+    Returns
+    -------
+    localA : numpy array of floats
+        nfaces x 3 x 3 local stiffness matrices
+    localB : numpy array of floats
+        nfaces x 3 x 3 local mass matrices
+
+    Examples
+    --------
+    >>> import os
+    >>> import tempfile
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import cached_local_AB
+    >>> points = [[0,0,0], [1,0,0], [0,0,1], [0,1,1],
+    ...           [1,0,1], [0,1,0], [1,1,1], [1,1,0]]
+    >>> faces = [[0,2,4], [0,1,4], [2,3,4], [3,4,5], [3,5,6], [0,1,7]]
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> localA, localB = cached_local_AB(points, faces, cache_directory)
+    >>> len(os.listdir(cache_directory))
+    1
+    >>> localA2, localB2 = cached_local_AB(points, faces, cache_directory)
+    >>> np.array_equal(localA2, localA) and np.array_equal(localB2, localB)
+    True
+
+    """
+    import numpy as np
+
+    from mindboggle.shapes.laplace_beltrami import local_AB, \
+        _spectrum_cache_version
+    from mindboggle.guts.cache import cache_key, load_cached, save_cached
+
+    points = np.asarray(points, dtype=np.float64)
+    faces = np.asarray(faces, dtype=int)
+
+    found = False
+    if cache_directory:
+        key = cache_key([points, faces],
+                        dict(matrices='local_AB',
+                             version=_spectrum_cache_version))
+        found, local_matrices = load_cached(key, cache_directory)
+    if not found:
+        local_matrices = local_AB(points, faces)
+        if cache_directory:
+            save_cached(key, local_matrices, cache_directory)
+
+    return local_matrices
 
 
 def area_normalize(points, faces, spectrum):
@@ -312,7 +466,23 @@ def wesd(EVAL1, EVAL2, Vol1, Vol2, show_error=False, N=3):
     N : integer
         The length of spetrum used (N>=3, default: 3)
 
+    Returns
+    -------
+    WESD : float
+        weighted spectral distance
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import wesd
+    >>> EVAL1 = [0, 0.2, 0.5, 0.8, 1.2]
+    >>> EVAL2 = [0, 0.25, 0.5, 0.9, 1.0]
+    >>> np.float("{0:.{1}f}".format(wesd(EVAL1, EVAL2, 1.0, 1.2), 5))
+    1.02326
+
     """
+    import numpy as np
+    from scipy.special import zeta
 
     # Martin Reuter: "a surface is a 2d manifold.
     # It doesn't matter that it is usually embedded in 3d Euclidean space."
@@ -321,7 +491,7 @@ def wesd(EVAL1, EVAL2, Vol1, Vol2, show_error=False, N=3):
     p = 2.0
 
     Vol = np.amax((Vol1, Vol2))
-    mu = np.amax(EVAL1[1], EVAL2[1])
+    mu = np.amax((EVAL1[1], EVAL2[1]))
 
     C = ((d+2)/(d*4*np.pi**2)*(Ball*Vol)**(2/d) - 1/mu)**p + \
         ((d+2)/(d*4*np.pi**2)*(Ball*Vol/2)**(2/d) - 1/mu*(d/(d+4)))**p
@@ -347,8 +517,135 @@ def wesd(EVAL1, EVAL2, Vol1, Vol2, show_error=False, N=3):
     return WESD
 
 
+def wesd_matrix(spectra, volumes=None, normalize=False, upper_triangle=False,
+                chunk_size=256, n_processes=1):
+    """
+    Weighted spectral distances between all pairs of a stack of spectra.
+
+    This computes wesd() for each pair of rows of an S x k array of spectra.
+    Distances are computed for blocks of chunk_size x chunk_size pairs at a
+    time (chunk_size x chunk_size x k arrays), so memory use is bounded
+    regardless of the number of spectra. Since the distance is symmetric,
+    only blocks on or above the diagonal are computed; with n_processes > 1
+    the blocks are computed in forked worker processes.
+
+    Parameters
+    ----------
+    spectra : S x k numpy array (or list of S lists) of floats
+        LB spectra, each beginning with the zero eigenvalue, which is
+        ignored as in wesd()
+    volumes : list or numpy array of S floats
+        volumes (areas for 2D) of the shapes (only used to normalize)
+    normalize : bool
+        divide each distance by its upper bound (W in Konukoglu et al. 2012)?
+    upper_triangle : bool
+        only fill in the upper triangle (leave zeros below the diagonal)?
+    chunk_size : integer
+        number of spectra per block
+    n_processes : integer
+        number of processes for computing blocks in parallel
+
+    Returns
+    -------
+    distances : S x S numpy array of floats
+        weighted spectral distances
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import wesd, wesd_matrix
+    >>> spectra = [[0, 0.2, 0.5, 0.8, 1.2],
+    ...            [0, 0.25, 0.5, 0.9, 1.0],
+    ...            [0, 0.1, 0.4, 0.7, 1.1]]
+    >>> distances = wesd_matrix(spectra)
+    >>> [np.float("{0:.{1}f}".format(x, 5)) for x in distances[0]]
+    [0.0, 1.02326, 5.02868]
+    >>> np.allclose(distances[0, 1], wesd(spectra[0], spectra[1], 1.0, 1.0))
+    True
+    >>> np.allclose(distances, distances.T)
+    True
+    >>> distances = wesd_matrix(spectra, upper_triangle=True, chunk_size=2)
+    >>> distances[2, 0]
+    0.0
+
+    """
+    import numpy as np
+
+    from mindboggle.guts.utilities import map_processes
+    from mindboggle.shapes.laplace_beltrami import _wesd_block
+
+    spectra = np.asarray(spectra, dtype=float)
+    if spectra.ndim != 2 or spectra.shape[1] < 2:
+        raise IOError("Spectra should be an S x k array with k >= 2.")
+    if normalize:
+        if volumes is None:
+            raise IOError("Volumes are required to normalize distances.")
+        volumes = np.asarray(volumes, dtype=float)
+    nspectra = spectra.shape[0]
+    chunk_size = max(int(chunk_size), 1)
+
+    # Blocks on or above the diagonal:
+    blocks = [(i0, min(i0 + chunk_size, nspectra),
+               j0, min(j0 + chunk_size, nspectra))
+              for i0 in range(0, nspectra, chunk_size)
+              for j0 in range(i0, nspectra, chunk_size)]
+
+    shared = dict(spectra=spectra, volumes=volumes, normalize=normalize)
+
+    distances = np.zeros((nspectra, nspectra))
+
+    def fill(block, distance):
+        i0, i1, j0, j1 = block
+        if i0 == j0:
+            distance = np.triu(distance)
+        distances[i0:i1, j0:j1] = distance
+        if not upper_triangle:
+            distances[j0:j1, i0:i1] += np.triu(distance, 1).T \
+                if i0 == j0 else distance.T
+
+    for iblock, distance in map_processes(_wesd_block, blocks, shared,
+                                          n_processes):
+        fill(blocks[iblock], distance)
+
+    return distances
+
+
+def _wesd_block(i0, i1, j0, j1, spectra, volumes, normalize):
+    """
+    Compute weighted spectral distances between two blocks of spectra.
+
+    Rows i0:i1 of spectra are compared with rows j0:j1.
+    See wesd_matrix() for a description of the other parameters.
+
+    """
+    import numpy as np
+    from scipy.special import zeta
+
+    p = 2.0
+    EVAL1 = spectra[i0:i1, None, 1:]
+    EVAL2 = spectra[None, j0:j1, 1:]
+    distance = np.sum((np.abs(EVAL1 - EVAL2) / (EVAL1 * EVAL2))**p,
+                      axis=2)**(1/p)
+
+    # Normalize by the upper bound of each distance (see wesd()):
+    if normalize:
+        d = 2.0
+        Ball = 4.0 / 3 * np.pi
+        Vol = np.maximum(volumes[i0:i1, None], volumes[None, j0:j1])
+        mu = np.maximum(spectra[i0:i1, None, 1], spectra[None, j0:j1, 1])
+        C = ((d+2)/(d*4*np.pi**2)*(Ball*Vol)**(2/d) - 1/mu)**p + \
+            ((d+2)/(d*4*np.pi**2)*(Ball*Vol/2)**(2/d) - 1/mu*(d/(d+4)))**p
+        K = ((d+2)/(d*4*np.pi**2)*(Ball*Vol)**(2/d) -
+             (1/mu)*(d/(d+2.64)))**p
+        W = (C + K*(zeta(2*p/d, 1) - 1 - .5**(2*p/d)))**(1/p)
+        distance /= W
+
+    return distance
+
+
 def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
-                  verbose=False):
+                  verbose=False, solver="eigsh", tol=0, maxiter=None,
+                  sigma=-0.01, matrices=None):
     """
     Compute linear finite-element method Laplace-Beltrami spectrum
     after Martin Reuter's MATLAB code.
@@ -416,7 +713,30 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
         if "index", divide eigenvalue by index to account for linear trend
         if "areaindex", do both (default)
     verbose : bool
-        print statements?
+        print statements (including timings)?
+    solver : string
+        eigensolver strategy:
+        if "eigsh", let ARPACK factorize the shift-inverted problem
+        (falling back to lobpcg on failure; default)
+        if "splu", factorize A - sigma*B once with a sparse LU (or a
+        Cholesky factorization if scikit-sparse is installed), pass it to
+        ARPACK, and reuse it to precondition lobpcg if ARPACK fails
+        if "amg", run lobpcg with an algebraic multigrid preconditioner
+        (requires pyamg; for very large meshes whose factorization
+        does not fit in memory; falls back to "splu" if pyamg is not
+        installed or if lobpcg fails or does not converge)
+    tol : float
+        relative accuracy of the eigenvalues (0: machine precision for
+        ARPACK, a default tolerance for lobpcg)
+    maxiter : integer or None
+        maximum number of solver iterations (None: solver default)
+    sigma : float
+        shift for the shift-invert mode, and for the preconditioner
+        (Martin Reuter: "small sigma shift helps prevent numerical
+        instabilities with zero eigenvalue")
+    matrices : tuple of two csr_matrix (or None)
+        precomputed A and B matrices for points and faces
+        (see computeAB and assemble_AB)
 
     Returns
     -------
@@ -440,6 +760,11 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     ...                          normalization="area", verbose=False)
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum[1::]]
     [27.50155, 28.8]
+    >>> spectrum = fem_laplacian(points, faces, spectrum_size=3,
+    ...                          normalization=None, verbose=False,
+    ...                          solver="splu")
+    >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum[1::]]
+    [4.58359, 4.8]
     >>> # Spectrum for entire left hemisphere of Twins-2-1:
     >>> from mindboggle.mio.vtks import read_vtk
     >>> from mindboggle.mio.fetch_data import prep_tests
@@ -450,6 +775,11 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     ...                          normalization=None, verbose=False)
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum[1::]]
     [0.00013, 0.00027, 0.00032, 0.00047, 0.00058]
+    >>> spectrum = fem_laplacian(points, faces, spectrum_size=6,
+    ...                          normalization=None, verbose=False,
+    ...                          solver="amg", tol=1e-8) # doctest: +SKIP
+    >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum[1::]] # doctest: +SKIP
+    [0.00013, 0.00027, 0.00032, 0.00047, 0.00058]
     >>> # Spectrum for Twins-2-1 left postcentral pial surface (22):
     >>> from mindboggle.guts.mesh import keep_faces, reindex_faces_points
     >>> I22 = [i for i,x in enumerate(labels) if x==1022] # postcentral
@@ -466,56 +796,108 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     [2.69259, 8.97865, 20.44857, 32.74477, 36.739]
 
     """
+    from time import time
     from scipy.sparse.linalg import eigsh, lobpcg
     import numpy as np
 
-    from mindboggle.shapes.laplace_beltrami import computeAB
+    from mindboggle.shapes.laplace_beltrami import computeAB, \
+        shift_invert_operator, amg_lobpcg
+
+    if solver not in ["eigsh", "splu", "amg"]:
+        raise IOError("Unknown eigensolver: {0}".format(solver))
 
     # ----------------------------------------------------------------
     # Compute A and B matrices (from Reuter et al., 2009):
     # ----------------------------------------------------------------
-    A, B = computeAB(points, faces)
+    t0 = time()
+    if matrices is None:
+        A, B = computeAB(points, faces)
+    else:
+        A, B = matrices
     if A.shape[0] <= spectrum_size:
         if verbose:
             print("The 3D shape has too few vertices ({0} <= {1}). Skip.".
                   format(A.shape[0], spectrum_size))
         return None
+    t1 = time()
 
     # ----------------------------------------------------------------
-    # Use the eigsh eigensolver:
+    # Use lobpcg with an algebraic multigrid preconditioner:
     # ----------------------------------------------------------------
-    try :
-
-        # eigs is for nonsymmetric matrices while
-        # eigsh is for real-symmetric or complex-Hermitian matrices:
-        # Martin Reuter: "small sigma shift helps prevent numerical
-        #   instabilities with zero eigenvalue"
-        eigenvalues, eigenvectors = eigsh(A, k=spectrum_size, M=B,
-                                          sigma=-0.01)
-        spectrum = eigenvalues.tolist()
+    if solver == "amg":
+        try:
+            spectrum = amg_lobpcg(A, B, spectrum_size, sigma, tol, maxiter)
+        except ImportError:
+            if verbose:
+                print("pyamg is not installed. Use the splu solver.")
+            solver = "splu"
+        except Exception as error:
+            if verbose:
+                print("amg_lobpcg() failed ({0}). Use the splu solver.".
+                      format(error))
+            solver = "splu"
 
     # ----------------------------------------------------------------
-    # Use the lobpcg eigensolver:
+    # Use the eigsh eigensolver:
     # ----------------------------------------------------------------
-    except RuntimeError:     
-           
-        if verbose:
-            print("eigsh() failed. Now try lobpcg.")
-            print("Warning: lobpcg can produce different results from "
-                  "Reuter (2006) shapeDNA-tria software.")
-        # Initial eigenvector values:
-        init_eigenvecs = np.random.random((A.shape[0], spectrum_size))
-
-        # maxiter = 40 forces lobpcg to use 20 iterations.
-        # Strangely, largest=false finds largest eigenvalues
-        # and largest=True gives the smallest eigenvalues:
-        eigenvalues, eigenvectors = lobpcg(A, init_eigenvecs, B=B,
-                                           largest=True, maxiter=40)
-        # Extract the real parts:
-        spectrum = [value.real for value in eigenvalues]
-
-        # For some reason, the eigenvalues from lobpcg are not sorted:
-        spectrum.sort()
+    if solver in ["eigsh", "splu"]:
+
+        # Factorize A - sigma*B once, for eigsh and for a lobpcg fallback:
+        if solver == "splu":
+            OPinv = shift_invert_operator(A, B, sigma)
+        else:
+            OPinv = None
+        try:
+
+            # eigs is for nonsymmetric matrices while
+            # eigsh is for real-symmetric or complex-Hermitian matrices:
+            # Martin Reuter: "small sigma shift helps prevent numerical
+            #   instabilities with zero eigenvalue"
+            eigenvalues, eigenvectors = eigsh(A, k=spectrum_size, M=B,
+                                              sigma=sigma, OPinv=OPinv,
+                                              tol=tol, maxiter=maxiter)
+            spectrum = eigenvalues.tolist()
+
+        # ----------------------------------------------------------------
+        # Use the lobpcg eigensolver:
+        # ----------------------------------------------------------------
+        except RuntimeError:
+
+            # Precondition lobpcg with the factorization:
+            if OPinv is not None:
+                if verbose:
+                    print("eigsh() failed. Now try lobpcg, preconditioned "
+                          "by the factorization.")
+                init_eigenvecs = np.random.RandomState(0).random_sample(
+                    (A.shape[0], spectrum_size))
+                eigenvalues, eigenvectors = lobpcg(
+                    A, init_eigenvecs, B=B, M=OPinv, largest=False,
+                    tol=tol if tol else None,
+                    maxiter=maxiter if maxiter else 500)
+                spectrum = sorted(np.real(eigenvalues).tolist())
+            else:
+                if verbose:
+                    print("eigsh() failed. Now try lobpcg.")
+                    print("Warning: lobpcg can produce different results from "
+                          "Reuter (2006) shapeDNA-tria software.")
+                # Initial eigenvector values:
+                init_eigenvecs = np.random.random((A.shape[0], spectrum_size))
+
+                # maxiter = 40 forces lobpcg to use 20 iterations.
+                # Strangely, largest=false finds largest eigenvalues
+                # and largest=True gives the smallest eigenvalues:
+                eigenvalues, eigenvectors = lobpcg(A, init_eigenvecs, B=B,
+                                                   largest=True, maxiter=40)
+                # Extract the real parts:
+                spectrum = [value.real for value in eigenvalues]
+
+                # For some reason, the eigenvalues from lobpcg are not sorted:
+                spectrum.sort()
+
+    if verbose:
+        print("{0} eigenvalues for {1} vertices: assembly {2:.2f} s, "
+              "{3} solver {4:.2f} s".format(spectrum_size, A.shape[0],
+                                            t1 - t0, solver, time() - t1))
 
     # ----------------------------------------------------------------
     # Normalize by area:
@@ -543,8 +925,126 @@ def fem_laplacian(points, faces, spectrum_size=10, normalization="areaindex",
     return spectrum
 
 
+def shift_invert_operator(A, B, sigma=-0.01):
+    """
+    Return a shift-invert operator (A - sigma*B)^-1 for eigsh.
+
+    The matrix A - sigma*B is factorized with a Cholesky factorization
+    if scikit-sparse is installed or else with a sparse LU decomposition
+    (scipy.sparse.linalg.splu).
+
+    Parameters
+    ----------
+    A : csr_matrix
+        stiffness matrix (see computeAB)
+    B : csr_matrix
+        mass matrix (see computeAB)
+    sigma : float
+        shift
+
+    Returns
+    -------
+    OPinv : LinearOperator
+        solves (A - sigma*B) x = b
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import computeAB
+    >>> from mindboggle.shapes.laplace_beltrami import shift_invert_operator
+    >>> points = [[0,0,0], [0,1,0], [1,1,0], [1,0,0],
+    ...           [0,0,1], [0,1,1], [1,1,1], [1,0,1]]
+    >>> faces = [[0,1,2], [2,3,0], [4,5,6], [6,7,4], [0,4,7], [7,3,0],
+    ...          [0,4,5], [5,1,0], [1,5,6], [6,2,1], [3,7,6], [6,2,3]]
+    >>> A, B = computeAB(points, faces)
+    >>> OPinv = shift_invert_operator(A, B)
+    >>> x = np.arange(8.0)
+    >>> np.allclose((A + 0.01*B).dot(OPinv.matvec(x)), x)
+    True
+
+    """
+    from scipy.sparse.linalg import LinearOperator, splu
+
+    C = (A - sigma * B).tocsc()
+    try:
+        from sksparse.cholmod import cholesky
+        solve = cholesky(C)
+    except ImportError:
+        solve = splu(C).solve
+
+    return LinearOperator(C.shape, matvec=solve, dtype=C.dtype)
+
+
+def amg_lobpcg(A, B, spectrum_size=10, sigma=-0.01, tol=0, maxiter=None):
+    """
+    Compute the smallest eigenvalues of A x = lambda B x with lobpcg
+    preconditioned by smoothed aggregation algebraic multigrid.
+
+    The preconditioner is built on A - sigma*B, and initial vectors are
+    seeded, so results are repeatable. Requires pyamg. Raises
+    RuntimeError if lobpcg does not converge.
+
+    Parameters
+    ----------
+    A : csr_matrix
+        stiffness matrix (see computeAB)
+    B : csr_matrix
+        mass matrix (see computeAB)
+    spectrum_size : integer
+        number of eigenvalues to be computed
+    sigma : float
+        shift for the preconditioner
+    tol : float
+        lobpcg tolerance (0: default)
+    maxiter : integer or None
+        maximum number of lobpcg iterations (None: 500)
+
+    Returns
+    -------
+    spectrum : list
+        smallest spectrum_size eigenvalues, sorted
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from mindboggle.shapes.laplace_beltrami import computeAB, amg_lobpcg
+    >>> points = [[x,y,0] for x in range(8) for y in range(8)]
+    >>> faces = [[8*x+y, 8*x+y+1, 8*x+y+8] for x in range(7) for y in range(7)]
+    >>> faces += [[8*x+y+1, 8*x+y+9, 8*x+y+8] for x in range(7) for y in range(7)]
+    >>> A, B = computeAB(points, faces)
+    >>> spectrum = amg_lobpcg(A, B, 3, tol=1e-8) # doctest: +SKIP
+    >>> [np.float("{0:.{1}f}".format(x, 3)) for x in spectrum[1::]] # doctest: +SKIP
+    [0.205, 0.205]
+
+    """
+    import warnings
+    import numpy as np
+    from scipy.sparse.linalg import lobpcg
+    from pyamg import smoothed_aggregation_solver
+
+    ml = smoothed_aggregation_solver((A - sigma * B).tocsr())
+    M = ml.aspreconditioner()
+
+    X = np.random.RandomState(0).random_sample((A.shape[0], spectrum_size))
+    # lobpcg only warns if it does not converge:
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", UserWarning)
+        try:
+            eigenvalues, eigenvectors = lobpcg(A, X, B=B, M=M, largest=False,
+                                               tol=tol if tol else None,
+                                               maxiter=maxiter if maxiter
+                                               else 500)
+        except UserWarning as warning:
+            raise RuntimeError("lobpcg failed: {0}".format(warning))
+    if not np.all(np.isfinite(eigenvalues)):
+        raise RuntimeError("lobpcg returned non-finite eigenvalues.")
+
+    return sorted(np.real(eigenvalues).tolist())
+
+
 def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
-                        normalization="areaindex", areas=None, verbose=False):
+                        normalization="areaindex", areas=None, verbose=False,
+                        solver="eigsh", tol=0, maxiter=None):
     """
     Compute Laplace-Beltrami spectrum on largest connected segment.
 
@@ -571,6 +1071,12 @@ def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
         surface area scalar values for all vertices
     verbose : bool
         print statements?
+    solver : string
+        eigensolver strategy (see fem_laplacian)
+    tol : float
+        eigensolver tolerance (see fem_laplacian)
+    maxiter : integer or None
+        maximum number of eigensolver iterations (see fem_laplacian)
 
     Returns
     -------
@@ -652,7 +1158,8 @@ def spectrum_of_largest(points, faces, spectrum_size=10, exclude_labels=[-1],
             # Compute spectrum:
             # ----------------------------------------------------------------
             spectrum = fem_laplacian(points, faces, spectrum_size,
-                                     normalization, verbose)
+                                     normalization, verbose, solver, tol,
+                                     maxiter)
             return spectrum
         else:
             return None
@@ -727,10 +1234,27 @@ def spectrum_from_file(vtk_file, spectrum_size=10, exclude_labels=[-1],
 
 def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
                        normalization='areaindex', area_file='',
-                       largest_segment=True, verbose=False):
+                       largest_segment=True, verbose=False, solver="eigsh",
+                       tol=0, maxiter=None, n_processes=1,
+                       global_assembly=False, cache_directory=''):
     """
     Compute Laplace-Beltrami spectrum per labeled region in a file.
 
+    The mesh is partitioned into label submeshes in one pass over the faces.
+    Label spectra are independent of one another, so with n_processes > 1
+    they are computed (largest labels first) in forked worker processes
+    that share the surface; results are returned in label order either way.
+
+    With global_assembly, the local (per-face) FEM matrices are computed
+    once for the whole surface (and stored in cache_directory, if given,
+    for other files with the same surface, such as labels and sulci), and
+    each label's A and B matrices are assembled from its faces' local
+    matrices.
+
+    With a cache_directory, each label's spectrum is stored under a hash of
+    its submesh and the spectrum parameters (see mindboggle.guts.cache),
+    and spectra of unchanged labels are read from the cache.
+
     Parameters
     ----------
     vtk_file : string
@@ -750,7 +1274,19 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
     largest_segment :  bool
         compute spectrum only for largest segment with a given label?
     verbose : bool
-        print statements?
+        print statements (including timings per label)?
+    solver : string
+        eigensolver strategy (see fem_laplacian)
+    tol : float
+        eigensolver tolerance (see fem_laplacian)
+    maxiter : integer or None
+        maximum number of eigensolver iterations (see fem_laplacian)
+    n_processes : integer
+        number of processes for computing label spectra in parallel
+    global_assembly : bool
+        assemble label matrices from local matrices of the whole surface?
+    cache_directory : string
+        directory for cached label spectra ('' for no caching)
 
     Returns
     -------
@@ -780,12 +1316,34 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
     [0.00054, 0.00244, 0.00291, 0.00456, 0.00575]
     >>> label_list[0:10]
     [1029, 1005, 1011, 1021, 1008, 1025, 999, 1013, 1007, 1022]
+    >>> spectrum_lists2, label_list2 = spectrum_per_label(vtk_file,
+    ...     spectrum_size, exclude_labels, None, area_file, largest_segment,
+    ...     verbose, n_processes=4) # doctest: +SKIP
+    >>> label_list2 == label_list # doctest: +SKIP
+    True
+    >>> spectrum_lists3, label_list3 = spectrum_per_label(vtk_file,
+    ...     spectrum_size, exclude_labels, None, area_file, largest_segment,
+    ...     verbose, global_assembly=True)
+    >>> [np.float("{0:.{1}f}".format(x, 5)) for x in spectrum_lists3[0][1::]]
+    [0.00054, 0.00244, 0.00291, 0.00456, 0.00575]
+    >>> import tempfile
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> spectrum_lists4, label_list4 = spectrum_per_label(vtk_file,
+    ...     spectrum_size, exclude_labels, None, area_file, largest_segment,
+    ...     verbose, cache_directory=cache_directory)
+    >>> spectrum_lists5, label_list5 = spectrum_per_label(vtk_file,
+    ...     spectrum_size, exclude_labels, None, area_file, largest_segment,
+    ...     verbose, cache_directory=cache_directory)
+    >>> spectrum_lists5 == spectrum_lists4
+    True
 
     """
+    import numpy as np
     from mindboggle.mio.vtks import read_vtk, read_scalars
-    from mindboggle.guts.mesh import keep_faces, reindex_faces_points
-    from mindboggle.shapes.laplace_beltrami import fem_laplacian,\
-        spectrum_of_largest
+    from mindboggle.guts.utilities import map_processes
+    from mindboggle.shapes.laplace_beltrami import _spectrum_of_label, \
+        cached_local_AB, _spectrum_cache_version
+    from mindboggle.guts.cache import cache_key, load_cached, save_cached
 
     # Read VTK surface mesh file:
     points, indices, lines, faces, labels, scalar_names, npoints, \
@@ -797,41 +1355,186 @@ def spectrum_per_label(vtk_file, spectrum_size=10, exclude_labels=[-1],
     else:
         areas = None
 
-    # Loop through labeled regions:
-    ulabels = []
-    [ulabels.append(int(x)) for x in labels if x not in ulabels
-     if x not in exclude_labels]
-    label_list = []
-    spectrum_lists = []
+    # Unique labels, in order of first appearance:
+    labels = np.asarray(labels)
+    ulabels, ifirst = np.unique(labels, return_index=True)
+    ulabels = [int(x) for x in ulabels[np.argsort(ifirst)]
+               if x not in exclude_labels]
+
+    # ------------------------------------------------------------------------
+    # Partition the faces by label in one pass (keep faces whose vertices
+    # all have the same label, in their original order):
+    # ------------------------------------------------------------------------
+    faces = np.asarray(faces, dtype=int).reshape(-1, 3)
+    face_labels = labels[faces]
+    same = (face_labels[:, 0] == face_labels[:, 1]) & \
+           (face_labels[:, 0] == face_labels[:, 2])
+    same_faces = np.flatnonzero(same)
+    same_labels = face_labels[same, 0]
+    order = np.argsort(same_labels, kind='mergesort')
+    sorted_labels = same_labels[order]
+    face_lists = []
     for label in ulabels:
-      #if label == 22:
-      #  print("DEBUG: COMPUTE FOR ONLY ONE LABEL")
+        start = np.searchsorted(sorted_labels, label, side='left')
+        stop = np.searchsorted(sorted_labels, label, side='right')
+        face_lists.append(same_faces[order[start:stop]])
 
-        # Determine the indices per label:
-        Ilabel = [i for i,x in enumerate(labels) if x == label]
-        if verbose:
-          print('{0} vertices for label {1}'.format(len(Ilabel), label))
+    # Local matrices for the whole surface:
+    if global_assembly:
+        local_matrices = cached_local_AB(points, faces, cache_directory)
+    else:
+        local_matrices = None
+
+    shared = dict(faces=faces, points=np.asarray(points),
+                  spectrum_size=spectrum_size, normalization=normalization,
+                  areas=areas, largest_segment=largest_segment,
+                  verbose=verbose, solver=solver, tol=tol, maxiter=maxiter,
+                  local_matrices=local_matrices)
+
+    # ------------------------------------------------------------------------
+    # Read cached spectra of unchanged label submeshes:
+    # ------------------------------------------------------------------------
+    spectrum_lists = [None] * len(ulabels)
+    keys = [None] * len(ulabels)
+    compute = list(range(len(ulabels)))
+    if cache_directory:
+        parameters = dict(spectrum_size=spectrum_size,
+                          normalization=normalization,
+                          largest_segment=largest_segment,
+                          solver=solver, tol=tol, maxiter=maxiter,
+                          global_assembly=global_assembly,
+                          version=_spectrum_cache_version)
+        if areas is not None and largest_segment:
+            areas_key = cache_key([np.asarray(areas, dtype=float)], {})
+        else:
+            areas_key = None
+        points = np.asarray(points)
+        compute = []
+        for ilabel, label_faces in enumerate(face_lists):
+            original_indices = np.unique(faces[label_faces])
+            keys[ilabel] = cache_key(
+                [points[original_indices],
+                 np.searchsorted(original_indices, faces[label_faces]),
+                 areas_key], parameters)
+            found, spectrum = load_cached(keys[ilabel], cache_directory)
+            if found:
+                spectrum_lists[ilabel] = spectrum
+                if verbose:
+                    print('Spectrum for label {0} read from cache'.
+                          format(ulabels[ilabel]))
+            else:
+                compute.append(ilabel)
+
+    # ------------------------------------------------------------------------
+    # Compute Laplace-Beltrami spectrum for each remaining label:
+    # ------------------------------------------------------------------------
+    if n_processes > 1:
+        # Largest labels first, so that small ones fill in at the end:
+        compute.sort(key=lambda i: len(face_lists[i]), reverse=True)
+    tasks = [(ulabels[i], face_lists[i]) for i in compute]
+    for itask, spectrum in map_processes(_spectrum_of_label, tasks, shared,
+                                         n_processes):
+        ilabel = compute[itask]
+        spectrum_lists[ilabel] = spectrum
+        if cache_directory:
+            save_cached(keys[ilabel], spectrum, cache_directory)
+    label_list = ulabels
 
-        # Remove background faces:
-        pick_faces = keep_faces(faces, Ilabel)
-        pick_faces, pick_points, o1 = reindex_faces_points(pick_faces, points)
+    return spectrum_lists, label_list
+
+
+def _spectrum_of_label(label, label_faces, faces, points, spectrum_size,
+                       normalization, areas, largest_segment, verbose,
+                       solver, tol, maxiter, local_matrices):
+    """
+    Compute the Laplace-Beltrami spectrum of one label's faces.
+
+    label_faces are indices to the label's faces. See spectrum_per_label()
+    for a description of the other parameters.
+
+    """
+    import numpy as np
+    from time import time
+    from scipy.sparse.csgraph import connected_components
 
-        # Compute Laplace-Beltrami spectrum for the label:
+    from mindboggle.guts.segment import select_largest
+    from mindboggle.shapes.laplace_beltrami import fem_laplacian, \
+        spectrum_of_largest, assemble_AB
+
+    t0 = time()
+
+    # Reindex the label's faces and points:
+    original_indices = np.unique(faces[label_faces])
+    pick_faces = np.searchsorted(original_indices, faces[label_faces])
+    pick_points = points[original_indices]
+    if verbose:
+        print('{0} vertices for label {1}'.format(len(pick_points), label))
+
+    # ------------------------------------------------------------------------
+    # Compute Laplace-Beltrami spectrum for the label:
+    # ------------------------------------------------------------------------
+    if local_matrices is None:
         if largest_segment:
             exclude_labels_inner = [-1]
-            spectrum = spectrum_of_largest(pick_points, pick_faces,
+            spectrum = spectrum_of_largest(pick_points.tolist(),
+                                           pick_faces.tolist(),
                                            spectrum_size,
                                            exclude_labels_inner,
-                                           normalization, areas, verbose)
+                                           normalization, areas, verbose,
+                                           solver, tol, maxiter)
         else:
-            spectrum = fem_laplacian(pick_points, pick_faces, spectrum_size,
-                                     normalization, verbose)
-
-        # Append to a list of lists of spectra:
-        spectrum_lists.append(spectrum)
-        label_list.append(label)
+            spectrum = fem_laplacian(pick_points.tolist(),
+                                     pick_faces.tolist(), spectrum_size,
+                                     normalization, verbose, solver, tol,
+                                     maxiter)
+
+    # ------------------------------------------------------------------------
+    # Assemble the label's matrices from local matrices of the surface:
+    # ------------------------------------------------------------------------
+    else:
+        localA, localB = local_matrices
+        A, B, original_indices = assemble_AB(faces, localA, localB,
+                                             label_faces, reindex=True)
+        if largest_segment:
+            if len(pick_points) < spectrum_size or \
+                    len(pick_faces) < spectrum_size:
+                raise IOError("The input size {0} ({1} faces) should be "
+                              "much larger than spectrum_size ({2})".
+                              format(len(pick_points), len(pick_faces),
+                                     spectrum_size))
+
+            # Select the largest connected segment, as spectrum_of_largest()
+            # does (so that both modes select the same segment):
+            nsegments, segments = connected_components(B, directed=False)
+            if nsegments > 1:
+                largest = select_largest(pick_points.tolist(),
+                                         pick_faces.tolist(), [-1], areas,
+                                         reindex=False)
+                if largest is None:
+                    raise IOError("The input size {0} is too small.".
+                                  format(len(pick_points)))
+                keep = np.all(np.isin(pick_faces, np.unique(largest[1])),
+                              axis=1)
+                label_faces = label_faces[keep]
+                A, B, original_indices = assemble_AB(faces, localA, localB,
+                                                     label_faces,
+                                                     reindex=True)
+                pick_faces = np.searchsorted(original_indices,
+                                             faces[label_faces])
+                pick_points = points[original_indices]
+                if len(pick_points) < spectrum_size:
+                    raise IOError("The input size {0} is too small.".
+                                  format(len(pick_points)))
+
+        spectrum = fem_laplacian(pick_points, pick_faces, spectrum_size,
+                                 normalization, verbose, solver, tol,
+                                 maxiter, matrices=(A, B))
+
+    if verbose:
+        print('Spectrum for label {0} in {1:.2f} seconds'.
+              format(label, time() - t0))
 
-    return spectrum_lists, label_list
+    return spectrum
 
 
 # ============================================================================
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+"""
+Benchmark the Zernike moment pipelines.
+
+Each pipeline in mindboggle.shapes.zernike.pipelines.PIPELINES is run on
+synthetic surface patches and/or labeled regions of a VTK surface, across
+orders and mesh sizes, recording wall time, peak memory, and agreement
+with a reference pipeline.
+
+Run from the command line, for example::
+
+    python -m mindboggle.shapes.zernike.benchmark --orders 5 10 \
+        --faces 1000 10000 --pipelines vectorized koehl -o zernike.csv
+
+Authors:
+    - Arno Klein, 2016  (arno@mindboggle.info)  http://binarybottle.com
+
+Copyright 2016,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
+
+"""
+
+
+def synthetic_mesh(n_faces):
+    """
+    Construct a wavy rectangular surface patch with about n_faces faces.
+
+    Parameters
+    ----------
+    n_faces : integer
+        approximate number of triangular faces
+
+    Returns
+    -------
+    points : numpy array of floats
+        x,y,z coordinates for each vertex
+    faces : numpy array of integers
+        indices to the three vertices of each triangle
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.zernike.benchmark import synthetic_mesh
+    >>> points, faces = synthetic_mesh(1000)
+    >>> points.shape, faces.shape
+    ((540, 3), (988, 3))
+
+    """
+    import numpy as np
+
+    # Two faces per grid cell, with rows:columns of 3:4:
+    nrows = max(2, int(round(np.sqrt(n_faces * 3 / 8.0))) + 1)
+    ncols = max(2, int(round((n_faces / 2.0) / (nrows - 1))) + 1)
+
+    x, y = np.meshgrid(np.arange(ncols, dtype=float),
+                       np.arange(nrows, dtype=float))
+    z = 0.1 * ncols * np.sin(2 * np.pi * x / ncols) * \
+        np.cos(np.pi * y / nrows)
+    points = np.column_stack([x.ravel(), y.ravel(), z.ravel()])
+
+    corners = (np.arange(nrows - 1)[:, None] * ncols +
+               np.arange(ncols - 1)[None, :]).ravel()
+    faces = np.concatenate([
+        np.column_stack([corners, corners + 1, corners + ncols]),
+        np.column_stack([corners + 1, corners + ncols + 1, corners + ncols])])
+
+    return points, faces
+
+
+def benchmark_pipelines(pipelines=None, orders=[5, 10, 15, 20],
+                        face_counts=[1000, 10000, 100000], vtk_file='',
+                        labels=[], reference='koehl', time_limit=600,
+                        measure_memory=True, n_processes=1, verbose=False):
+    """
+    Time Zernike moment pipelines on synthetic and labeled meshes.
+
+    For each mesh and order, the reference pipeline is run first, then each
+    pipeline, recording its wall time, its peak memory (memory allocated in
+    this process, traced with tracemalloc, so not including worker
+    processes), and the maximum difference between its descriptors and the
+    reference descriptors, relative to the largest reference descriptor.
+    Meshes are run from smallest to largest; a pipeline that takes longer
+    than time_limit seconds for an order is skipped for larger meshes of
+    that order (if the reference pipeline is skipped, differences are not
+    recorded).
+
+    Parameters
+    ----------
+    pipelines : list of strings
+        names of pipelines (keys of PIPELINES; None for all)
+    orders : list of integers
+        orders of the moments
+    face_counts : list of integers
+        approximate numbers of faces of synthetic meshes
+    vtk_file : string
+        name of VTK surface mesh file containing index scalars (labels)
+    labels : list of integers
+        labels of regions in vtk_file to benchmark
+    reference : string
+        name of the pipeline to compare against (by default 'koehl', which
+        does not share code with the 'vectorized' pipelines)
+    time_limit : float
+        maximum time (seconds) before skipping larger meshes of an order
+    measure_memory : bool
+        trace peak memory (slows pipelines with Python loops)?
+    n_processes : integer
+        number of processes for multiprocessing pipelines
+    verbose : bool
+        print a line per run?
+
+    Returns
+    -------
+    results : list of dictionaries
+        mesh, faces, order, pipeline, seconds, peak_memory (bytes), and
+        difference per run (None if skipped)
+
+    Examples
+    --------
+    >>> from mindboggle.shapes.zernike.benchmark import benchmark_pipelines
+    >>> results = benchmark_pipelines(['koehl', 'vectorized'], orders=[3],
+    ...     face_counts=[200], reference='serial')
+    >>> [(x['pipeline'], x['faces'], x['difference'] < 1e-12)
+    ...  for x in results]
+    [('koehl', 198, True), ('vectorized', 198, True)]
+
+    """
+    import time
+    import tracemalloc
+    import numpy as np
+
+    from mindboggle.shapes.zernike.zernike import zernike_moments
+    from mindboggle.shapes.zernike.pipelines import PIPELINES
+    from mindboggle.shapes.zernike.benchmark import synthetic_mesh
+
+    if pipelines is None:
+        pipelines = sorted(PIPELINES)
+
+    # ------------------------------------------------------------------------
+    # Synthetic and labeled meshes, from smallest to largest:
+    # ------------------------------------------------------------------------
+    meshes = []
+    for n_faces in face_counts:
+        points, faces = synthetic_mesh(n_faces)
+        meshes.append(('synthetic', points, faces))
+    if vtk_file and labels:
+        from mindboggle.mio.vtks import read_vtk
+        from mindboggle.guts.mesh import keep_faces
+
+        points, indices, lines, faces, scalars, scalar_names, npoints, \
+            input_vtk = read_vtk(vtk_file)
+        for label in labels:
+            indices = [i for i, x in enumerate(scalars) if x == label]
+            label_faces = keep_faces(faces, indices)
+            if label_faces:
+                meshes.append(('label {0}'.format(label), np.array(points),
+                               np.array(label_faces)))
+    meshes.sort(key=lambda x: len(x[2]))
+
+    # ------------------------------------------------------------------------
+    # Run each pipeline per order and mesh:
+    # ------------------------------------------------------------------------
+    results = []
+    too_slow = set()
+    for order in orders:
+        for mesh, points, faces in meshes:
+            reference_descriptors = None
+            if (reference, order) not in too_slow:
+                t0 = time.time()
+                reference_descriptors = np.array(zernike_moments(
+                    points, faces, order, n_processes=n_processes,
+                    pipeline=reference))
+                if time.time() - t0 > time_limit:
+                    too_slow.add((reference, order))
+                scale = np.max(np.abs(reference_descriptors))
+            for name in pipelines:
+                seconds = None
+                peak_memory = None
+                difference = None
+                if (name, order) not in too_slow:
+                    if measure_memory:
+                        tracemalloc.start()
+                    t0 = time.time()
+                    descriptors = zernike_moments(points, faces, order,
+                                                  n_processes=n_processes,
+                                                  pipeline=name)
+                    seconds = time.time() - t0
+                    if measure_memory:
+                        peak_memory = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    if reference_descriptors is not None:
+                        difference = np.max(np.abs(
+                            np.array(descriptors) -
+                            reference_descriptors)) / scale
+                    if seconds > time_limit:
+                        too_slow.add((name, order))
+
+                results.append(dict(mesh=mesh, faces=len(faces), order=order,
+                                    pipeline=name, seconds=seconds,
+                                    peak_memory=peak_memory,
+                                    difference=difference))
+                if verbose:
+                    print('{mesh}, {faces} faces, order {order}, {pipeline}: '
+                          '{seconds} s, {peak_memory} bytes, '
+                          'difference {difference}'.format(**results[-1]))
+
+    return results
+
+
+def main():
+    """Run benchmark_pipelines() from the command line, saving a CSV file."""
+    import csv
+    import argparse
+
+    from mindboggle.shapes.zernike.pipelines import PIPELINES
+    from mindboggle.shapes.zernike.benchmark import benchmark_pipelines
+
+    parser = argparse.ArgumentParser(description="Benchmark the Zernike "
+                                                 "moment pipelines.")
+    parser.add_argument('--pipelines', nargs='+', choices=sorted(PIPELINES),
+                        default=None, help='pipelines (all)')
+    parser.add_argument('--orders', nargs='+', type=int,
+                        default=[5, 10, 15, 20], help='orders (5 10 15 20)')
+    parser.add_argument('--faces', nargs='+', type=int,
+                        default=[1000, 10000, 100000],
+                        help='faces of synthetic meshes (1000 10000 100000)')
+    parser.add_argument('--vtk_file', default='',
+                        help='VTK surface file with labels')
+    parser.add_argument('--labels', nargs='+', type=int, default=[],
+                        help='labels of regions in the VTK file')
+    parser.add_argument('--reference', choices=sorted(PIPELINES),
+                        default='koehl', help='reference (koehl)')
+    parser.add_argument('--time_limit', type=float, default=600,
+                        help='seconds before skipping larger meshes (600)')
+    parser.add_argument('--no_memory', action='store_true',
+                        help='do not trace peak memory')
+    parser.add_argument('-c', '--cpus', type=int, default=1,
+                        help='number of processors to use (1)')
+    parser.add_argument('-o', '--output', default='zernike_benchmark.csv',
+                        help='output CSV file (zernike_benchmark.csv)')
+    args = parser.parse_args()
+
+    results = benchmark_pipelines(args.pipelines, args.orders, args.faces,
+                                  args.vtk_file, args.labels, args.reference,
+                                  args.time_limit, not args.no_memory,
+                                  args.cpus, verbose=True)
+
+    with open(args.output, 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=['mesh', 'faces', 'order',
+                                               'pipeline', 'seconds',
+                                               'peak_memory', 'difference'])
+        writer.writeheader()
+        writer.writerows(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -360,10 +360,418 @@ class KoehlMultiproc(KoehlOptimizations):
         return self.factorial_scalar(N) * moments_array
 
 
+# Recursion indices of KoehlVectorized, keyed by order:
+_koehl_indices = {}
+
+
+class KoehlVectorized(KoehlOptimizations):
+    """
+    Koehl's recursion for blocks of faces at once.
+
+    Only the terms (i,j,k) with i+j+k <= N are nonzero, so each term array
+    is stored compactly as a (T+1) x F array (T terms, ordered by i+j+k,
+    and a row of zeros), with one column per face of a block. Each step of
+    the recursion computes all terms of the next order for all faces of
+    the block from precomputed indices to the terms of the previous order.
+    Blocks of faces are sized so that their term arrays fit within
+    memory_budget bytes, and each block's contribution is the sum of its
+    faces' terms weighted by their facet volumes.
+    """
+    memory_budget = 2**27
+
+    def geometric_moments_exact(self, points_array, faces_array, N):
+        n_facets, n_vertices = faces_array.shape[:2]
+        assert n_vertices == 3
+        moments_array = self.block_moments(points_array, faces_array, N)
+        return self.factorial_scalar(N) * moments_array
+
+    def block_moments(self, points_array, faces_array, N):
+        """Sum the facet contributions of faces, a block at a time."""
+        i, j, k = self.recursion_indices(N)[:3]
+        n_facets = faces_array.shape[0]
+        block_size = self.block_size(N)
+        moments = np.zeros(len(i))
+        for start in range(0, n_facets, block_size):
+            vertices = points_array[faces_array[start:start + block_size]]
+            moments += self.block_contribution(vertices, N)
+        moments_array = np.zeros([N+1, N+1, N+1])
+        moments_array[i, j, k] = moments
+        return moments_array
+
+    def block_size(self, N):
+        n_terms = len(self.recursion_indices(N)[0]) + 1
+        # Three term arrays and a temporary array per face:
+        return max(1, int(self.memory_budget // (4 * 8 * n_terms)))
+
+    def recursion_indices(self, N):
+        """
+        Index the terms i+j+k <= N, and their predecessors along each axis.
+
+        Returns the i, j, k exponents of the T terms (ordered by i+j+k),
+        the start of each order, and for each term the index of the term
+        with i-1, j-1, or k-1 (T, the row of zeros, if the exponent is 0).
+        """
+        if N in _koehl_indices:
+            return _koehl_indices[N]
+        i, j, k = np.mgrid[:N+1, :N+1, :N+1].reshape(3, -1)
+        keep = np.flatnonzero(i + j + k <= N)
+        keep = keep[np.argsort((i + j + k)[keep], kind='mergesort')]
+        i, j, k = i[keep], j[keep], k[keep]
+        n_terms = len(keep)
+        starts = np.searchsorted(i + j + k, np.arange(N + 2))
+        index = -np.ones([N+2, N+2, N+2], dtype=int)
+        index[i, j, k] = np.arange(n_terms)
+        previous = []
+        for di, dj, dk in [(1, 0, 0), (0, 1, 0), (0, 0, 1)]:
+            prev = index[i - di, j - dj, k - dk]
+            prev[prev < 0] = n_terms
+            previous.append(prev)
+        _koehl_indices[N] = (i, j, k, starts) + tuple(previous)
+        return _koehl_indices[N]
+
+    def block_contribution(self, vertices, N):
+        """Sum the volume-weighted terms of a block of F x 3 x 3 vertices."""
+        Vf = self.block_facet_volumes(vertices)
+        Cf = self.block_work_loop(vertices[:, 2], N)
+        Df = self.block_work_loop(vertices[:, 1], N, Cf)
+        del Cf
+        Sf = self.block_work_loop(vertices[:, 0], N, Df)
+        return np.dot(Sf[:-1], Vf)
+
+    def block_facet_volumes(self, vertices):
+        # Vertices are the columns of each matrix, as in facet_volume():
+        return np.linalg.det(np.transpose(vertices, (0, 2, 1)))
+
+    def block_work_loop(self, vertices, N, prev=None):
+        """Run work_loop() for a block of F x 3 vertices."""
+        i, j, k, starts, prev_i, prev_j, prev_k = self.recursion_indices(N)
+        x, y, z = vertices.T
+        Q = np.zeros([len(i) + 1, vertices.shape[0]])
+        Q[0] = 1.0
+        for n in range(1, N + 1):
+            terms = slice(starts[n], starts[n + 1])
+            Q[terms] = Q[prev_i[terms]]*x + Q[prev_j[terms]]*y + \
+                Q[prev_k[terms]]*z
+            if prev is not None:
+                Q[terms] += prev[terms]
+        return Q
+
+
+# Long-lived process pool shared by KoehlVectorizedMultiproc pipelines:
+_executor = None
+_executor_workers = 0
+
+
+def get_executor(n_processes=None):
+    """
+    Return a long-lived process pool, creating it on first use.
+
+    The pool is reused by all calls (and labels) with the same number of
+    processes, and shut down at exit.
+    """
+    import atexit
+    from concurrent.futures import ProcessPoolExecutor
+
+    global _executor, _executor_workers
+    if n_processes is None:
+        n_processes = mp.cpu_count()
+    if _executor is not None and _executor_workers != n_processes:
+        shutdown_executor()
+    if _executor is None:
+        if 'fork' in mp.get_all_start_methods():
+            context = mp.get_context('fork')
+        else:
+            context = mp.get_context()
+        _executor = ProcessPoolExecutor(n_processes, mp_context=context)
+        _executor_workers = n_processes
+        atexit.register(shutdown_executor)
+    return _executor
+
+
+def shutdown_executor():
+    """Shut down the long-lived process pool, if any."""
+    global _executor, _executor_workers
+    if _executor is not None:
+        _executor.shutdown()
+        _executor = None
+        _executor_workers = 0
+
+
+def _shared_array(array):
+    """Copy an array to shared memory; return the block and a descriptor."""
+    from multiprocessing import shared_memory
+
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _kvmp_block_moments_worker(points_info, faces_info, start, stop, N,
+                               memory_budget):
+    """Sum the facet contributions of a chunk of faces in shared memory."""
+    from multiprocessing import shared_memory
+
+    blocks = [shared_memory.SharedMemory(name=info[0])
+              for info in (points_info, faces_info)]
+    try:
+        points_array, faces_array = [
+            np.ndarray(info[1], info[2], buffer=block.buf)
+            for info, block in zip((points_info, faces_info), blocks)]
+        pipeline = KoehlVectorized()
+        pipeline.memory_budget = memory_budget
+        moments_array = pipeline.block_moments(points_array,
+                                               faces_array[start:stop], N)
+        del points_array, faces_array
+    finally:
+        for block in blocks:
+            block.close()
+    return moments_array
+
+
+class KoehlVectorizedMultiproc(KoehlVectorized):
+    """
+    KoehlVectorized with chunks of faces spread across processes.
+
+    Points and faces are copied once to shared memory, and the faces are
+    split into chunks_per_worker large chunks per worker; each chunk
+    returns its partial moment array. Chunks are submitted to executor (any
+    concurrent.futures executor supplied by the caller) or else to a
+    long-lived pool of n_processes processes (see get_executor()).
+    With n_processes = 1 and no executor, or a mesh of no more than one
+    block of faces, moments are computed in this process.
+    """
+    executor = None
+    n_processes = 1
+    chunks_per_worker = 2
+
+    def geometric_moments_exact(self, points_array, faces_array, N):
+        n_facets, n_vertices = faces_array.shape[:2]
+        assert n_vertices == 3
+        executor = self.executor
+        if executor is None and self.n_processes != 1 and \
+                not mp.current_process().daemon:
+            executor = get_executor(self.n_processes)
+        if executor is None or n_facets <= self.block_size(N):
+            return super(KoehlVectorizedMultiproc,
+                         self).geometric_moments_exact(points_array,
+                                                       faces_array, N)
+
+        n_workers = getattr(executor, '_max_workers', None) or \
+            self.n_processes or mp.cpu_count()
+        n_chunks = min(n_workers * self.chunks_per_worker,
+                       int(np.ceil(n_facets / self.block_size(N))))
+        bounds = np.linspace(0, n_facets, n_chunks + 1).astype(int)
+
+        points_block, points_info = _shared_array(
+            np.ascontiguousarray(points_array, dtype=float))
+        try:
+            faces_block, faces_info = _shared_array(
+                np.ascontiguousarray(faces_array, dtype=np.int64))
+            try:
+                futures = [executor.submit(_kvmp_block_moments_worker,
+                                           points_info, faces_info,
+                                           start, stop, N,
+                                           self.memory_budget)
+                           for start, stop in zip(bounds[:-1], bounds[1:])]
+                moments_array = np.zeros([N+1, N+1, N+1])
+                for future in futures:
+                    moments_array += future.result()
+            finally:
+                faces_block.close()
+                faces_block.unlink()
+        finally:
+            points_block.close()
+            points_block.unlink()
+
+        return self.factorial_scalar(N) * moments_array
+
+
+# Sparse maps from geometric to Zernike moments, keyed by order:
+_zernike_transforms = {}
+
+# Version of saved Zernike maps (increment when compile_zernike() changes):
+_zernike_transform_version = 1
+
+
+class ZernikeTransform(Pipeline):
+    """
+    Zernike moments as a sparse linear map of the geometric moments.
+
+    The V, W, X, Y and Z steps of SerialPipeline.zernike() are linear, with
+    coefficients that depend only on the order N. The map from (real)
+    geometric moments G to Z is compiled once per order into a sparse
+    matrix, so that zernike() is a single sparse matrix-vector product.
+    Maps are kept in memory, and saved to (and loaded from) the cache in
+    tables_directory if it is set (see mindboggle.guts.cache).
+    """
+    tables_directory = ''
+
+    def zernike(self, G, N):
+        T = self.zernike_transform(N)
+        Z = T.dot(np.asarray(G, dtype=float).ravel())
+        return Z.reshape([N + 1, N + 1, N + 1])
+
+    def zernike_transform(self, N):
+        from mindboggle.guts.cache import cache_key, load_cached, \
+            save_cached
+
+        if N in _zernike_transforms:
+            return _zernike_transforms[N]
+
+        found = False
+        if self.tables_directory:
+            key = cache_key([], {'table': 'zernike_transform', 'order': N,
+                                 'version': _zernike_transform_version})
+            found, T = load_cached(key, self.tables_directory)
+        if not found:
+            T = self.compile_zernike(N)
+            if self.tables_directory:
+                save_cached(key, T, self.tables_directory)
+
+        _zernike_transforms[N] = T
+        return T
+
+    def compile_zernike(self, N):
+        """
+        Compile the index loops of SerialPipeline.zernike() for order N.
+
+        Each step is a sparse matrix acting on the flattened array of the
+        previous step. Since G is real, conj(Y) = conj(P) G for P, the map
+        from G to Y. The final loop conjugates (and negates, for odd
+        n+l+m) the moments it visits; it is replayed here on the sign and
+        conjugation of each moment.
+        """
+        from scipy import sparse
+
+        size = (N + 1)**3
+
+        def flat(a, b, c):
+            return (a * (N + 1) + b) * (N + 1) + c
+
+        def step(terms):
+            rows, cols, values = zip(*terms)
+            return sparse.coo_matrix((np.array(values, dtype=complex),
+                                      (rows, cols)),
+                                     shape=(size, size)).tocsr()
+
+        V = step((flat(a, b, c), flat(2 * a + c - alpha, alpha, b),
+                  np.power(IMAG_CONST, alpha) * nchoosek(a + c, alpha))
+                 for a, b, c, alpha in nest(
+                     lambda: range(int(N / 2) + 1),
+                     lambda _a: range(N - 2 * _a + 1),
+                     lambda _a, _b: range(N - 2 * _a - _b + 1),
+                     lambda _a, _b, _c: range(_a + _c + 1),
+                 ))
+        W = step((flat(a, b, c), flat(a - alpha, b, c + 2 * alpha),
+                  np.power(-1, alpha) * np.power(2, a - alpha) *
+                  nchoosek(a, alpha))
+                 for a, b, c, alpha in nest(
+                     lambda: range(int(N / 2) + 1),
+                     lambda _a: range(N - 2 * _a + 1),
+                     lambda _a, _b: range(N - 2 * _a - _b + 1),
+                     lambda _a, _b, _c: range(_a + 1),
+                 ))
+        X = step((flat(a, b, c), flat(a - alpha, b + 2 * alpha, c),
+                  nchoosek(a, alpha))
+                 for a, b, c, alpha in nest(
+                     lambda: range(int(N / 2) + 1),
+                     lambda _a: range(N - 2 * _a + 1),
+                     lambda _a, _b: range(N - 2 * _a - _b + 1),
+                     lambda _a, _b, _c: range(_a + 1),
+                 ))
+        Y = step((flat(l, nu, m), flat(nu + j, l - m - 2 * j, m),
+                  self.Yljm(l, j, m))
+                 for l, nu, m, j in nest(
+                     lambda: range(N + 1),
+                     lambda _l: range(int((N - _l) / 2) + 1),
+                     lambda _l, _nu: range(_l + 1),
+                     lambda _l, _nu, _m: range(int((_l - _m) / 2) + 1),
+                 ))
+        terms = []
+        for n, l, m, nu, in nest(lambda: range(N + 1),
+                                 lambda _n: range(_n + 1),
+                                 lambda _n, _l: range(_l + 1),
+                                 lambda _n, _l, _m: range(int((_n - _l) / 2) + 1),
+                                 ):
+            k = int((n - l) / 2)
+            terms.append((flat(n, l, m), flat(l, nu, m),
+                          (3 / (4 * PI_CONST)) * self.Qklnu(k, l, nu)))
+        Z = step(terms)
+
+        # Replay the final loop (with the loop variables of the last one):
+        sign = np.ones(size)
+        conjugate = np.zeros(size, dtype=bool)
+        for n, l, m in nest(lambda: range(N + 1),
+                            lambda _n: range(n + 1),
+                            lambda _n, _l: range(l + 1),
+                            ):
+            if np.mod(np.sum([n, l, m]), 2) != 0:
+                sign[flat(n, l, m)] *= -1
+            conjugate[flat(n, l, m)] ^= True
+
+        P = Y.dot(X.dot(W.dot(V)))
+        T = sparse.diags(sign * ~conjugate).dot(Z.dot(P.conj())) + \
+            sparse.diags(sign * conjugate).dot(Z.conj().dot(P))
+        T = T.tocsr()
+        T.eliminate_zeros()
+        return T
+
+
 #DefaultPipeline = type('DefaultPipeline', (SerialPipeline,), {})
 #DefaultPipeline = type(
 #     'DefaultPipeline', (NumpyOptimizations, MultiprocPipeline,), {})
 #DefaultPipeline = type(
 #    'DefaultPipeline', (KoehlOptimizations, SerialPipeline), {})
+#DefaultPipeline = type(
+#    'DefaultPipeline', (KoehlMultiproc, SerialPipeline), {})
 DefaultPipeline = type(
-    'DefaultPipeline', (KoehlMultiproc, SerialPipeline), {})
+    'DefaultPipeline', (KoehlVectorizedMultiproc, ZernikeTransform,
+                        SerialPipeline), {})
+
+# Pipelines that can be selected by name (see select_pipeline()), defined
+# at module level so that multiprocessing pipelines can be pickled:
+NumpyPipeline = type('NumpyPipeline', (NumpyOptimizations, SerialPipeline), {})
+KoehlPipeline = type('KoehlPipeline', (KoehlOptimizations, SerialPipeline), {})
+KoehlMultiprocPipeline = type('KoehlMultiprocPipeline',
+                              (KoehlMultiproc, SerialPipeline), {})
+VectorizedPipeline = type('VectorizedPipeline',
+                          (KoehlVectorized, ZernikeTransform,
+                           SerialPipeline), {})
+PIPELINES = {
+    'serial': SerialPipeline,
+    'numpy': NumpyPipeline,
+    'multiproc': MultiprocPipeline,
+    'koehl': KoehlPipeline,
+    'koehl_multiproc': KoehlMultiprocPipeline,
+    'vectorized': VectorizedPipeline,
+    'vectorized_multiproc': DefaultPipeline,
+}
+
+# Meshes with at least this many faces use the multiprocessing pipeline
+# (below this, starting processes and copying chunks to them cost about as
+# much as they save; at order 10, 30000 faces take under a second):
+MULTIPROC_MIN_FACES = 100000
+
+
+def select_pipeline(n_faces=0, name=None):
+    """
+    Return a pipeline class by name, or else by the size of the mesh.
+
+    The name is one of the keys of PIPELINES, and may also be set with the
+    MINDBOGGLE_ZERNIKE_PIPELINE environment variable. Otherwise, meshes
+    with at least MULTIPROC_MIN_FACES faces use 'vectorized_multiproc',
+    and smaller meshes 'vectorized'. Raises ValueError for an unknown name.
+    """
+    import os
+
+    if not name:
+        name = os.environ.get('MINDBOGGLE_ZERNIKE_PIPELINE', '')
+    if not name:
+        if n_faces >= MULTIPROC_MIN_FACES:
+            name = 'vectorized_multiproc'
+        else:
+            name = 'vectorized'
+    if name not in PIPELINES:
+        raise ValueError("Unknown Zernike pipeline {0}; choose from: {1}".
+                      format(name, ', '.join(sorted(PIPELINES))))
+    return PIPELINES[name]
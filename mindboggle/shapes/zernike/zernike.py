@@ -12,9 +12,14 @@ Copyright 2013,  Mindboggle team (http://mindboggle.info), Apache v2.0 License
 
 """
 
+# Version of cached Zernike moments (increment when their numerics change):
+_zernike_cache_version = 1
+
 
 def zernike_moments(points, faces, order=10, scale_input=True,
-                    decimate_fraction=0, decimate_smooth=0, verbose=False):
+                    decimate_fraction=0, decimate_smooth=0, verbose=False,
+                    cache_directory='', n_processes=1, executor=None,
+                    pipeline=None):
     """
     Compute the Zernike moments of a surface patch of points and faces.
 
@@ -41,6 +46,19 @@ def zernike_moments(points, faces, order=10, scale_input=True,
         number of smoothing steps for decimation
     verbose : bool
         print statements?
+    cache_directory : string
+        directory for the table of coefficients that maps geometric to
+        Zernike moments for this order ('' to keep it in memory only)
+    n_processes : integer
+        number of processes for computing geometric moments
+        (chunks of faces are computed in a pool that is reused across calls)
+    executor : concurrent.futures executor (optional)
+        executor to use instead of the pool of n_processes processes
+    pipeline : string (optional)
+        name of the pipeline implementation (see
+        mindboggle.shapes.zernike.pipelines.select_pipeline(); by default,
+        chosen by the MINDBOGGLE_ZERNIKE_PIPELINE environment variable or
+        by the number of faces)
 
     Returns
     -------
@@ -120,7 +138,7 @@ def zernike_moments(points, faces, order=10, scale_input=True,
 
     from mindboggle.guts.mesh import reindex_faces_0to1
     from mindboggle.guts.mesh import decimate
-    from mindboggle.shapes.zernike.pipelines import DefaultPipeline as Pipeline
+    from mindboggle.shapes.zernike.pipelines import select_pipeline
 
     # Convert 0-indices (Python) to 1-indices (Matlab) for all face indices:
     index1 = False  # already done elsewhere in the code
@@ -155,9 +173,15 @@ def zernike_moments(points, faces, order=10, scale_input=True,
         faces = np.array(faces)
 
     # ------------------------------------------------------------------------
-    # Multiprocessor pipeline:
+    # Pipeline (multiprocessor for large meshes):
     # ------------------------------------------------------------------------
+    Pipeline = select_pipeline(len(faces), pipeline)
+    if verbose:
+        print("Zernike pipeline: {0}".format(Pipeline.__name__))
     pl = Pipeline()
+    pl.tables_directory = cache_directory
+    pl.n_processes = n_processes
+    pl.executor = executor
 
     # ------------------------------------------------------------------------
     # Geometric moments:
@@ -181,12 +205,20 @@ def zernike_moments(points, faces, order=10, scale_input=True,
 
 def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
                               scale_input=True, decimate_fraction=0,
-                              decimate_smooth=25, verbose=False):
+                              decimate_smooth=25, verbose=False,
+                              cache_directory='', n_processes=1):
     """
     Compute the Zernike moments per labeled region in a file.
 
     Optionally decimate the input mesh.
 
+    With a cache_directory, each label's descriptors are stored under a
+    hash of the surface points, the label's faces and the moment parameters
+    (see mindboggle.guts.cache), and descriptors of unchanged labels are
+    read from the cache. (All points are hashed, since scale_input centers
+    and scales a label with respect to all of the points.) The directory
+    also holds the coefficient tables used by zernike_moments().
+
     Parameters
     ----------
     vtk_file : string
@@ -204,6 +236,10 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
         number of smoothing steps for decimation
     verbose : bool
         print statements?
+    cache_directory : string
+        directory for cached label descriptors ('' for no caching)
+    n_processes : integer
+        number of processes for computing each label's geometric moments
 
     Returns
     -------
@@ -240,12 +276,24 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
     [0.00393, 0.006, 0.00371, 0.00852, 0.00251, 0.00153]
     >>> [np.float("{0:.{1}f}".format(x, 5)) for x in descriptors_lists[4]]
     [0.00043, 0.0003, 0.00095, 0.00051, 0.00115, 0.00116]
+    >>> import tempfile
+    >>> cache_directory = tempfile.mkdtemp()
+    >>> descriptors_lists2, label_list2 = zernike_moments_per_label(vtk_file,
+    ...     order, exclude_labels, scale_input, verbose=verbose,
+    ...     cache_directory=cache_directory) # doctest: +SKIP
+    >>> descriptors_lists3, label_list3 = zernike_moments_per_label(vtk_file,
+    ...     order, exclude_labels, scale_input, verbose=verbose,
+    ...     cache_directory=cache_directory) # doctest: +SKIP
+    >>> descriptors_lists3 == descriptors_lists2 # doctest: +SKIP
+    True
 
     """
     import numpy as np
     from mindboggle.mio.vtks import read_vtk
     from mindboggle.guts.mesh import keep_faces
-    from mindboggle.shapes.zernike.zernike import zernike_moments
+    from mindboggle.shapes.zernike.zernike import zernike_moments, \
+        _zernike_cache_version
+    from mindboggle.guts.cache import cache_key, load_cached, save_cached
 
     min_points_faces = 4
 
@@ -255,6 +303,13 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
     points, indices, lines, faces, labels, scalar_names, npoints, \
             input_vtk = read_vtk(vtk_file)
 
+    if cache_directory:
+        parameters = dict(order=order, scale_input=scale_input,
+                          decimate_fraction=decimate_fraction,
+                          decimate_smooth=decimate_smooth,
+                          version=_zernike_cache_version)
+        points_key = cache_key([np.asarray(points, dtype=float)], {})
+
     # ------------------------------------------------------------------------
     # Loop through labeled regions:
     # ------------------------------------------------------------------------
@@ -280,13 +335,29 @@ def zernike_moments_per_label(vtk_file, order=10, exclude_labels=[-1],
             pick_faces = keep_faces(faces, Ilabel)
             if len(pick_faces) > min_points_faces:
 
+                # ------------------------------------------------------------
+                # Read cached Zernike moments for the label:
+                # ------------------------------------------------------------
+                found = False
+                if cache_directory:
+                    key = cache_key([points_key, pick_faces], parameters)
+                    found, descriptors = load_cached(key, cache_directory)
+                    if found and verbose:
+                        print('  Zernike moments for label {0} read from '
+                              'cache'.format(label))
+
                 # ------------------------------------------------------------
                 # Compute Zernike moments for the label:
                 # ------------------------------------------------------------
-                descriptors = zernike_moments(points, pick_faces,
-                                              order, scale_input,
-                                              decimate_fraction,
-                                              decimate_smooth, verbose)
+                if not found:
+                    descriptors = zernike_moments(points, pick_faces,
+                                                  order, scale_input,
+                                                  decimate_fraction,
+                                                  decimate_smooth, verbose,
+                                                  cache_directory,
+                                                  n_processes)
+                    if cache_directory:
+                        save_cached(key, descriptors, cache_directory)
 
                 # ------------------------------------------------------------
                 # Append to a list of lists of spectra: